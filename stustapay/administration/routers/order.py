@@ -1,6 +1,7 @@
-from typing import Optional
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 
 from stustapay.core.http.auth_user import CurrentAuthToken
 from stustapay.core.http.context import ContextOrderService
@@ -15,8 +16,19 @@ router = APIRouter(
 
 
 @router.get("/by-till/{till_id}", response_model=NormalizedList[Order, int])
-async def list_orders_by_till(token: CurrentAuthToken, till_id: int, order_service: ContextOrderService, node_id: int):
-    return normalize_list(await order_service.list_orders_by_till(token=token, till_id=till_id, node_id=node_id))
+async def list_orders_by_till(
+    token: CurrentAuthToken,
+    till_id: int,
+    order_service: ContextOrderService,
+    node_id: int,
+    before_id: Optional[int] = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
+):
+    return normalize_list(
+        await order_service.list_orders_by_till(
+            token=token, till_id=till_id, node_id=node_id, before_id=before_id, limit=limit
+        )
+    )
 
 
 @router.get("", response_model=NormalizedList[Order, int])
@@ -25,12 +37,33 @@ async def list_orders(
     order_service: ContextOrderService,
     node_id: int,
     customer_account_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
 ):
+    """
+    orders are returned newest first, the next page starts before the smallest order id of the previous page
+    """
     return normalize_list(
-        await order_service.list_orders(token=token, customer_account_id=customer_account_id, node_id=node_id)
+        await order_service.list_orders(
+            token=token, customer_account_id=customer_account_id, node_id=node_id, before_id=before_id, limit=limit
+        )
     )
 
 
+@router.get("/export", response_class=StreamingResponse)
+async def export_orders(token: CurrentAuthToken, order_service: ContextOrderService, node_id: int):
+    """
+    all orders at or below the given node as newline delimited json, oldest first
+    """
+    node = await order_service.get_order_export_node(token=token, node_id=node_id)
+
+    async def ndjson():
+        async for order in order_service.stream_orders(node=node):
+            yield order.model_dump_json() + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
 @router.get("/{order_id}", response_model=Order)
 async def get_order(token: CurrentAuthToken, order_id: int, order_service: ContextOrderService, node_id: int):
     order = await order_service.get_order(token=token, order_id=order_id, node_id=node_id)
@@ -2,6 +2,7 @@ from datetime import datetime
 from typing import Optional
 
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 
 from stustapay.core.http.auth_user import CurrentAuthToken
 from stustapay.core.http.context import ContextOrderService
@@ -34,6 +35,20 @@ async def get_product_stats(
     )
 
 
+@router.get("/live", response_class=StreamingResponse)
+async def stream_live_stats(token: CurrentAuthToken, order_service: ContextOrderService, node_id: int):
+    """
+    server-sent events with the sales booked at or below the given node.
+    'update' events carry newly booked line items, 'resync' events signal that updates were dropped.
+    """
+    node = await order_service.stats.get_live_stats_node(token=token, node_id=node_id)
+    return StreamingResponse(
+        order_service.stats.live.stream(node=node),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/vouchers", response_model=VoucherStats)
 async def get_voucher_stats(
     token: CurrentAuthToken,
@@ -1,9 +1,11 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 
 from stustapay.core.http.auth_user import CurrentAuthToken
 from stustapay.core.http.context import ContextTseService
 from stustapay.core.http.normalize_data import NormalizedList, normalize_list
-from stustapay.core.schema.tse import NewTse, Tse, UpdateTse
+from stustapay.core.schema.tse import NewTse, Tse, TseMetrics, UpdateTse
+from stustapay.core.service.tse import render_prometheus_metrics
 
 router = APIRouter(
     prefix="/tses",
@@ -17,6 +19,17 @@ async def list_tses(token: CurrentAuthToken, tse_service: ContextTseService, nod
     return normalize_list(await tse_service.list_tses(token=token, node_id=node_id))
 
 
+@router.get("/metrics", response_model=list[TseMetrics])
+async def list_tse_metrics(token: CurrentAuthToken, tse_service: ContextTseService, node_id: int):
+    return await tse_service.list_tse_metrics(token=token, node_id=node_id)
+
+
+@router.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def export_tse_metrics(token: CurrentAuthToken, tse_service: ContextTseService, node_id: int):
+    metrics = await tse_service.list_tse_metrics(token=token, node_id=node_id)
+    return PlainTextResponse(render_prometheus_metrics(metrics), media_type="text/plain; version=0.0.4")
+
+
 @router.post("/", response_model=Tse)
 async def create_tse(token: CurrentAuthToken, tse_service: ContextTseService, new_tse: NewTse, node_id: int):
     return await tse_service.create_tse(token=token, new_tse=new_tse, node_id=node_id)
@@ -12,16 +12,23 @@ from stustapay.core.healthcheck import run_healthcheck
 from stustapay.core.http.context import Context
 from stustapay.core.service.account import AccountService
 from stustapay.core.service.cashier import CashierService
+from stustapay.core.service.common.cache import (
+    run_cache_stats_logging,
+    run_node_cache_invalidation,
+    run_token_cache_invalidation,
+)
 from stustapay.core.service.config import ConfigService
 from stustapay.core.service.customer.customer import CustomerService
 from stustapay.core.service.mail import MailService
 from stustapay.core.service.order import OrderService
+from stustapay.core.service.order.stats_rollup import run_order_stats_rollup
 from stustapay.core.service.product import ProductService
 from stustapay.core.service.sumup import SumUpService
 from stustapay.core.service.tax_rate import TaxRateService
 from stustapay.core.service.terminal import TerminalService
 from stustapay.core.service.ticket import TicketService
 from stustapay.core.service.till import TillService
+from stustapay.core.service.tree.common import run_node_tree_cache
 from stustapay.core.service.tree.service import TreeService
 from stustapay.core.service.tse import TseService
 from stustapay.core.service.user import AuthService, UserService
@@ -136,6 +143,12 @@ class Api:
         )
         try:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="administration")))
+            self.server.add_task(asyncio.create_task(run_node_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_node_tree_cache(db_pool)))
+            self.server.add_task(asyncio.create_task(run_token_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_order_stats_rollup(db_pool)))
+            self.server.add_task(asyncio.create_task(order_service.stats.live.run()))
+            self.server.add_task(asyncio.create_task(run_cache_stats_logging()))
             self.server.add_task(asyncio.create_task(mail_service.run_mail_service()))
             await self.server.run(context)
         finally:
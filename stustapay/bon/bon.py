@@ -1,9 +1,9 @@
 import uuid
+from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional
 
-import asyncpg
 from pydantic import BaseModel, computed_field
 from sftkit.database import Connection
 
@@ -61,23 +61,20 @@ class BonJson(BaseModel):
     currency_identifier: str
 
 
-async def fetch_order(*, conn: Connection, order_id: int) -> Optional[OrderWithTse]:
-    return await conn.fetch_maybe_one(
-        OrderWithTse,
-        "select "
-        "   o.*, "
-        "   sig.*, "
-        "   tse.hashalgo as tse_hashalgo, "
-        "   tse.time_format as tse_time_format, "
-        "   tse.public_key as tse_public_key, "
-        "   t.node_id as node_id "
-        "from order_value o "
-        "join tse_signature sig on sig.id = o.id "
-        "join till t on o.till_id = t.id "
-        "join tse on tse.id = sig.tse_id "
-        "where o.id = $1",
-        order_id,
-    )
+class _TseSignatureData(BaseModel):
+    id: int
+    node_id: int
+    signature_status: str
+    transaction_process_type: Optional[str] = None
+    transaction_process_data: Optional[str] = None
+    tse_transaction: Optional[str] = None
+    tse_signaturenr: Optional[str] = None
+    tse_start: Optional[str] = None
+    tse_end: Optional[str] = None
+    tse_hashalgo: Optional[str] = None
+    tse_time_format: Optional[str] = None
+    tse_signature: Optional[str] = None
+    tse_public_key: Optional[str] = None
 
 
 @dataclass
@@ -94,6 +91,7 @@ def gen_dummy_order(node_id: int):
         total_price=16.00,
         total_tax=1.23,
         total_no_tax=14.77,
+        item_count=3,
         booked_at=datetime.fromisoformat("2023-04-24T14:46:54.550316"),
         payment_method=PaymentMethod.tag,
         order_type=OrderType.sale,
@@ -178,6 +176,10 @@ def gen_dummy_order(node_id: int):
     )
 
 
+def _make_bon_config(event: RestrictedEventSettings) -> BonConfig:
+    return BonConfig(title=event.bon_title, issuer=event.bon_issuer, address=event.bon_address, ust_id=event.ust_id)
+
+
 async def generate_dummy_bon_json(node_id: int, event: RestrictedEventSettings) -> BonJson:
     """Generate a dummy bon for the given event and return the pdf as bytes"""
     return BonJson(
@@ -205,41 +207,75 @@ async def generate_dummy_bon_json(node_id: int, event: RestrictedEventSettings)
                 total_no_tax=8.10,
             ),
         ],
-        config=BonConfig(
-            title=event.bon_title,
-            issuer=event.bon_issuer,
-            address=event.bon_address,
-            ust_id=event.ust_id,
-        ),
+        config=_make_bon_config(event),
         currency_identifier=event.currency_identifier,
     )
 
 
-async def generate_bon_json(db_pool: asyncpg.Pool, order_id: int) -> BonJson | None:
-    async with db_pool.acquire() as conn:
-        order = await fetch_order(conn=conn, order_id=order_id)
-        if order is None:
-            return None
-
-        event = await fetch_restricted_event_settings_for_node(conn=conn, node_id=order.node_id)
-        config = BonConfig(
-            ust_id=event.ust_id, address=event.bon_address, issuer=event.bon_issuer, title=event.bon_title
+async def generate_bon_jsons(*, conn: Connection, order_ids: list[int]) -> dict[int, BonJson]:
+    """
+    Assembles the bon data of all given orders with one query each for the orders, their tse signatures and their
+    tax rate aggregations. Orders without signature or without line items are missing in the result.
+    """
+    orders = await conn.fetch_many(Order, "select * from order_value_prefiltered($1)", order_ids)
+    signatures = {
+        signature.id: signature
+        for signature in await conn.fetch_many(
+            _TseSignatureData,
+            "select "
+            "   sig.id, "
+            "   t.node_id, "
+            "   sig.signature_status, "
+            "   sig.transaction_process_type, "
+            "   sig.transaction_process_data, "
+            "   sig.tse_transaction, "
+            "   sig.tse_signaturenr, "
+            "   sig.tse_start, "
+            "   sig.tse_end, "
+            "   sig.tse_signature, "
+            "   tse.hashalgo as tse_hashalgo, "
+            "   tse.time_format as tse_time_format, "
+            "   tse.public_key as tse_public_key "
+            "from tse_signature sig "
+            "join ordr o on sig.id = o.id "
+            "join till t on o.till_id = t.id "
+            "join tse on tse.id = sig.tse_id "
+            "where sig.id = any($1)",
+            order_ids,
         )
+    }
+    aggregations: dict[int, list[TaxRateAggregation]] = defaultdict(list)
+    for row in await conn.fetch(
+        "select id, tax_name, tax_rate, total_price, total_tax, total_no_tax "
+        "from order_tax_rates "
+        "where id = any($1) "
+        "order by id, tax_rate",
+        order_ids,
+    ):
+        aggregations[row["id"]].append(TaxRateAggregation.model_validate(dict(row)))
 
-        aggregations = await conn.fetch_many(
-            TaxRateAggregation,
-            "select tax_name, tax_rate, total_price, total_tax, total_no_tax "
-            "from order_tax_rates "
-            "where id = $1 "
-            "order by tax_rate",
-            order_id,
+    # all bons of a node share the event settings
+    events: dict[int, RestrictedEventSettings] = {}
+    bon_jsons = {}
+    for order in orders:
+        signature = signatures.get(order.id)
+        if signature is None or len(aggregations[order.id]) == 0:
+            continue
+        event = events.get(signature.node_id)
+        if event is None:
+            event = await fetch_restricted_event_settings_for_node(conn=conn, node_id=signature.node_id)
+            events[signature.node_id] = event
+        # the line items are aggregated in no particular order, a bon lists them in the order they were booked
+        order.line_items.sort(key=lambda line_item: line_item.item_id)
+        bon_jsons[order.id] = BonJson(
+            order=OrderWithTse(**order.model_dump(), **signature.model_dump(exclude={"id"})),
+            config=_make_bon_config(event),
+            tax_rate_aggregations=aggregations[order.id],
+            currency_identifier=event.currency_identifier,
         )
-        if len(aggregations) == 0:
-            return None
+    return bon_jsons
 
-    return BonJson(
-        order=order,
-        config=config,
-        tax_rate_aggregations=aggregations,
-        currency_identifier=event.currency_identifier,
-    )
+
+async def generate_bon_json(*, conn: Connection, order_id: int) -> BonJson | None:
+    bon_jsons = await generate_bon_jsons(conn=conn, order_ids=[order_id])
+    return bon_jsons.get(order_id)
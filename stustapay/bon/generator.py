@@ -1,28 +1,39 @@
 # pylint: disable=attribute-defined-outside-init
 import asyncio
-import json
 import logging
-import sys
+import traceback
 
 from asyncpg.exceptions import PostgresError
 from sftkit.database import Connection, DatabaseHook
 
-from stustapay.bon.bon import generate_bon_json
+from stustapay.bon.bon import BonJson, generate_bon_jsons
 from stustapay.core.config import Config
 from stustapay.core.database import get_database
-from stustapay.core.healthcheck import run_healthcheck
+from stustapay.core.healthcheck import get_healthcheck_dir, run_healthcheck
 
 
 class GeneratorWorker:
-    def __init__(self, config: Config):
+    """
+    Generates the pending bons with n_workers concurrent workers, each on its own database connection.
+    The workers claim the bons in batches of batch_size, bons claimed by another worker are skipped.
+    """
+
+    def __init__(self, config: Config, n_workers: int = 4, batch_size: int = 20, metrics_interval: float = 30):
         self.config = config
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.metrics_interval = metrics_interval
         self.logger = logging.getLogger(__name__)
 
         # set, once run is called
-        self.db_conn: Connection | None = None
         self.db_hook: DatabaseHook | None = None
 
         self.tasks: list[asyncio.Task] = []
+        # set when there might be bons to generate, the workers clear it before claiming
+        self.bons_pending = asyncio.Event()
+        # bons for which no bon data could be generated, they are not retried until a restart
+        self.failed_bons = set[int]()
+        self.n_generated = 0
 
     async def stop(self):
         if self.db_hook:
@@ -34,16 +45,19 @@ class GeneratorWorker:
         # start all database connections and start the hook to listen for bon requests
         self.logger.info("Starting Bon Generator")
         db = get_database(self.config.database)
-        self.pool = await db.create_pool()
+        # one connection per worker, one for the hook and one for the metrics
+        self.pool = await db.create_pool(n_connections=self.n_workers + 2)
 
         # initial processing of pending bons
-        await self.cleanup_pending_bons()
+        self.bons_pending.set()
 
         self.db_hook = DatabaseHook(self.pool, "bon", self.handle_hook, hook_timeout=30)
 
         self.tasks = [
             asyncio.create_task(self.db_hook.run()),
             asyncio.create_task(run_healthcheck(db, service_name="bon")),
+            asyncio.create_task(self.run_metrics()),
+            *(asyncio.create_task(self.run_worker()) for _ in range(self.n_workers)),
         ]
 
         try:
@@ -55,60 +69,150 @@ class GeneratorWorker:
             pass
 
     async def cleanup_pending_bons(self):
+        """
+        Generates all pending bons right away
+        """
         self.logger.info("Generating not generated bons")
-        missing_bons = await self.pool.fetch(
-            "select bon.id, o.uuid "
-            "from bon "
-            "join ordr o on bon.id = o.id "
-            "join till t on o.till_id = t.id "
-            "join node n on t.node_id = n.id "
-            "where generated_at is null and not n.read_only",
-        )
-        for row in missing_bons:
-            await self.process_bon(order_id=row["id"])
-
+        await asyncio.gather(*(self._drain_pending_bons() for _ in range(self.n_workers)))
         self.logger.info("Finished generating left-over bons")
 
+    async def _drain_pending_bons(self):
+        while await self.process_pending_bons() == self.batch_size:
+            pass
+
     async def handle_hook(self, payload):
         self.logger.debug(f"Received hook with payload {payload}")
+        # the workers claim all pending bons, the notified bon does not matter
+        self.bons_pending.set()
+
+    async def run_worker(self):
+        while True:
+            await self.bons_pending.wait()
+            # cleared before claiming, so a bon notified in the meantime is not missed
+            self.bons_pending.clear()
+            try:
+                n_claimed = await self.process_pending_bons()
+            except PostgresError as e:
+                self.logger.error(f"Database error while processing bons: {e}")
+                await asyncio.sleep(1)
+                self.bons_pending.set()
+                continue
+            except Exception:  # pylint: disable=broad-except
+                self.logger.error(f"Unexpected error while processing bons: {traceback.format_exc()}")
+                await asyncio.sleep(1)
+                self.bons_pending.set()
+                continue
+            if n_claimed == self.batch_size:
+                # there are probably more, let the other workers help as well
+                self.bons_pending.set()
+
+    async def process_pending_bons(self) -> int:
+        """
+        Claims up to batch_size pending bons, generates them and saves the results back to the database.
+        Returns the number of claimed bons.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # the row locks are held until the results are written, concurrent workers skip these bons
+                order_ids = await conn.fetch(
+                    "select bon.id "
+                    "from bon "
+                    "join ordr o on bon.id = o.id "
+                    "join till t on o.till_id = t.id "
+                    "join node n on t.node_id = n.id "
+                    "where bon.generated_at is null and not n.read_only and bon.id <> all($2) "
+                    "order by bon.id "
+                    "limit $1 "
+                    "for update of bon skip locked",
+                    self.batch_size,
+                    list(self.failed_bons),
+                )
+                self.logger.debug(f"Generating Bons for orders {[row['id'] for row in order_ids]}...")
+                bon_jsons = await self._generate_bon_jsons(conn=conn, order_ids=[row["id"] for row in order_ids])
+                results = []
+                for row in order_ids:
+                    order_id = row["id"]
+                    bon_json = bon_jsons.get(order_id)
+                    if bon_json is None:
+                        self.logger.error(
+                            f"Error while generating bon data for order {order_id}. This is an internal stustapay error and should not occur naturally"
+                        )
+                        self.failed_bons.add(order_id)
+                        continue
+                    results.append((order_id, bon_json.model_dump_json()))
+
+                await conn.executemany(
+                    "update bon set bon_json = $2, generated_at = now() where id = $1",
+                    results,
+                )
+        self.n_generated += len(results)
+        return len(order_ids)
+
+    async def _generate_bon_jsons(self, conn: Connection, order_ids: list[int]) -> dict[int, BonJson]:
+        """
+        Generates the bon data of the whole batch at once. If that fails, the orders are generated one by one,
+        so a broken order does not hold back the others. The broken orders are missing in the result.
+        """
         try:
-            decoded = json.loads(payload)
-            bon_id = decoded["bon_id"]
-            bon_exists = await self.pool.fetchval("select exists (select from ordr where id = $1)", bon_id)
-            assert bon_exists is not None
-            await self.process_bon(order_id=bon_id)
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Error while trying to decode database payload for bon notification: {e}")
-        except PostgresError as e:
-            self.logger.error(f"Database error while processing bon: {e}")
+            # savepoint, a failed query must not abort the transaction holding the bon locks
+            async with conn.transaction():
+                return await generate_bon_jsons(conn=conn, order_ids=order_ids)
         except Exception:  # pylint: disable=broad-except
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            import traceback
-
+            if conn.is_closed():
+                raise
             self.logger.error(
-                f"Unexpected error while processing bon: {traceback.format_exception(exc_type, exc_value, exc_traceback)}"
+                f"Error while generating bon data for orders {order_ids}, generating them one by one: "
+                f"{traceback.format_exc()}"
             )
 
-    async def process_bon(self, order_id: int):
+        bon_jsons: dict[int, BonJson] = {}
+        for order_id in order_ids:
+            try:
+                async with conn.transaction():
+                    bon_jsons.update(await generate_bon_jsons(conn=conn, order_ids=[order_id]))
+            except Exception:  # pylint: disable=broad-except
+                if conn.is_closed():
+                    raise
+                self.logger.error(f"Error while generating bon data for order {order_id}: {traceback.format_exc()}")
+        return bon_jsons
+
+    async def fetch_backlog(self) -> int:
+        return await self.pool.fetchval(
+            "select count(*) "
+            "from bon "
+            "join ordr o on bon.id = o.id "
+            "join till t on o.till_id = t.id "
+            "join node n on t.node_id = n.id "
+            "where bon.generated_at is null and not n.read_only",
+        )
+
+    async def run_metrics(self):
         """
-        Queries the database for the bon data and generates it.
-        Then saves the result back to the database
+        Writes the generator metrics in the prometheus text format next to the healthcheck status,
+        to be picked up by the textfile collector of the node exporter.
         """
-        self.logger.debug(f"Generating Bon for order {order_id}...")
-        bon_json = await generate_bon_json(db_pool=self.pool, order_id=order_id)
-        if bon_json is None:
-            self.logger.error(
-                f"Error while generating bon data for order {order_id}. This is an internal stustapay error and should not occur naturally"
-            )
-            return
-
-        async with self.pool.acquire() as conn:
-            async with conn.transaction(isolation="serializable"):
-                await conn.execute(
-                    "update bon set bon_json = $2, generated_at = now() where id = $1",
-                    order_id,
-                    bon_json.model_dump_json(),
+        while True:
+            try:
+                metrics_file = get_healthcheck_dir() / "bon.prom"
+                backlog = await self.fetch_backlog()
+                self.logger.info(f"Bon backlog: {backlog} pending bons")
+                tmp_file = metrics_file.with_suffix(".prom.tmp")
+                tmp_file.write_text(
+                    "# HELP stustapay_bon_backlog Bons which still need to be generated.\n"
+                    "# TYPE stustapay_bon_backlog gauge\n"
+                    f"stustapay_bon_backlog {backlog}\n"
+                    "# HELP stustapay_bons_generated_total Bons generated by this bon generator.\n"
+                    "# TYPE stustapay_bons_generated_total counter\n"
+                    f"stustapay_bons_generated_total {self.n_generated}\n"
+                    "# HELP stustapay_bon_generation_failures Bons for which no bon data could be generated.\n"
+                    "# TYPE stustapay_bon_generation_failures gauge\n"
+                    f"stustapay_bon_generation_failures {len(self.failed_bons)}\n"
                 )
+                # atomic replace, the collector never reads a partial file
+                tmp_file.replace(metrics_file)
+            except (PostgresError, OSError) as e:
+                self.logger.error(f"Error while writing the bon metrics: {e}")
+            await asyncio.sleep(self.metrics_interval)
 
 
 class Generator:
@@ -116,13 +220,15 @@ class Generator:
     Command which listens for database changes on bons and generates the bons immediately as pdf
     """
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, n_workers: int = 4, batch_size: int = 20):
         self.config = config
+        self.n_workers = n_workers
+        self.batch_size = batch_size
         self.logger = logging.getLogger(__name__)
 
     def run(self):
         self.logger.info("Starting Bon Generator...")
 
-        worker = GeneratorWorker(config=self.config)
+        worker = GeneratorWorker(config=self.config, n_workers=self.n_workers, batch_size=self.batch_size)
         asyncio.run(worker.run())
         self.logger.info("Stopping Bon Generator...")
@@ -3,13 +3,20 @@ Helper Functions to generate pdfs from latex templates and store the result as f
 """
 
 import asyncio
+import contextlib
+import functools
 import logging
 import os
 import re
+import shutil
+import signal
 import subprocess
+from collections import OrderedDict
 from datetime import datetime
+from hashlib import sha256
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Optional
 
 import jinja2
 from pydantic import BaseModel
@@ -52,6 +59,7 @@ def jfilter_datetime(t: datetime):
     return LatexEncoder.unicode_to_latex(t.strftime("%Y-%m-%d %H:%M:%S"))
 
 
+@functools.lru_cache(maxsize=None)
 def setup_jinja_env(currency_symbol: str):
     def jfilter_money(value: float):
         # how are the money values printed in the pdf
@@ -98,47 +106,135 @@ class PdfRenderResult(BaseModel):
     bon: RenderedPdf | None = None
 
 
-async def pdflatex(file_content: str) -> PdfRenderResult:
+class LatexRenderer:
     """
-    renders the given latex template with the context and saves the resulting pdf to out_file
-    returns <True, ""> if the pdf was compiled successfully
-    returns <False, error_msg> on a latex compile error
+    Compiles latex documents with at most max_concurrent latex processes at a time.
+
+    Each worker slot keeps its build directory, so latexmk can reuse the auxiliary files of the previous run.
+    Compiled pdfs are cached by the hash of their source, identical documents are only compiled once,
+    even if they are requested concurrently.
     """
 
-    with TemporaryDirectory() as tmp_dir:
-        main_tex = os.path.join(tmp_dir, "main.tex")
-        with open(main_tex, "w") as f:
-            f.write(file_content)
+    def __init__(self, max_concurrent: int = 2, cache_size: int = 32):
+        self.max_concurrent = max_concurrent
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, RenderedPdf] = OrderedDict()
+        self._in_progress: dict[str, asyncio.Task[PdfRenderResult]] = {}
+        self._build_root: Optional[TemporaryDirectory] = None
+        # build directories of the idle worker slots, bound to the event loop they were created in
+        self._free_slots: Optional[asyncio.Queue[Path]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_free_slots(self) -> asyncio.Queue[Path]:
+        loop = asyncio.get_running_loop()
+        if self._free_slots is None or self._loop is not loop:
+            if self._build_root is None:
+                self._build_root = TemporaryDirectory(prefix="stustapay-latex-")
+            self._free_slots = asyncio.Queue()
+            for i in range(self.max_concurrent):
+                slot = Path(self._build_root.name) / f"slot{i}"
+                slot.mkdir(exist_ok=True)
+                self._free_slots.put_nowait(slot)
+            self._loop = loop
+        return self._free_slots
+
+    async def render(self, file_content: str) -> PdfRenderResult:
+        key = sha256(file_content.encode("utf-8")).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return PdfRenderResult(success=True, bon=cached)
+
+        compilation = self._in_progress.get(key)
+        if compilation is None:
+            # the compilation runs on its own, a cancelled request does not abort it for the others
+            compilation = asyncio.get_running_loop().create_task(self._compile_and_cache(key, file_content))
+            # nobody might wait for the result of a failed compilation
+            compilation.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._in_progress[key] = compilation
+        return await asyncio.shield(compilation)
+
+    async def _compile_and_cache(self, key: str, file_content: str) -> PdfRenderResult:
+        try:
+            result = await self._compile(file_content)
+        finally:
+            del self._in_progress[key]
+
+        if result.success and result.bon is not None:
+            self._cache[key] = result.bon
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    async def _compile(self, file_content: str) -> PdfRenderResult:
+        free_slots = self._get_free_slots()
+        build_dir = await free_slots.get()
+        result = None
+        try:
+            result = await _latexmk(build_dir, file_content)
+            return result
+        finally:
+            if result is None or not result.success:
+                # don't let the leftovers of a failed or aborted run break the next one
+                shutil.rmtree(build_dir, ignore_errors=True)
+                build_dir.mkdir()
+            free_slots.put_nowait(build_dir)
+
+
+async def _latexmk(build_dir: Path, file_content: str) -> PdfRenderResult:
+    main_tex = build_dir / "main.tex"
+    main_tex.write_text(file_content)
+
+    newenv = os.environ.copy()
+    newenv["TEXINPUTS"] = os.pathsep.join([TEX_PATH]) + os.pathsep
+
+    latexmk = ["latexmk", "-xelatex", "-halt-on-error", str(main_tex)]
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *latexmk,
+            env=newenv,
+            cwd=build_dir,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # own process group, so the latex runs started by latexmk can be killed along with it
+            start_new_session=True,
+        )
+        try:
+            stdout, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            # don't leave latex running in the build directory, which is handed to the next compilation
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            await proc.wait()
+            raise
+        # latex failed
+        if proc.returncode != 0:
+            msg = stdout.decode("utf-8")[-800:]
+            logger.debug(f"Error generating latex pdf: {msg}")
+            return PdfRenderResult(success=False, msg=msg)
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.debug(f"Error generating latex pdf: {e}")
+        return PdfRenderResult(success=False, msg=f"latex failed with error {e}")
 
-        newenv = os.environ.copy()
-        newenv["TEXINPUTS"] = os.pathsep.join([TEX_PATH]) + os.pathsep
+    output_pdf = build_dir / "main.pdf"
 
-        latexmk = ["latexmk", "-xelatex", "-halt-on-error", main_tex]
+    try:
+        pdf_content = output_pdf.read_bytes()
+    except Exception as e:
+        logger.debug(f"Error generating latex pdf: {e}")
+        return PdfRenderResult(success=False, msg=str(e))
 
-        try:
-            proc = await asyncio.create_subprocess_exec(
-                *latexmk,
-                env=newenv,
-                cwd=tmp_dir,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            stdout, _ = await proc.communicate()
-            # latex failed
-            if proc.returncode != 0:
-                msg = stdout.decode("utf-8")[-800:]
-                logger.debug(f"Error generating latex pdf: {msg}")
-                return PdfRenderResult(success=False, msg=msg)
-        except subprocess.SubprocessError as e:
-            logger.debug(f"Error generating latex pdf: {e}")
-            return PdfRenderResult(success=False, msg=f"latex failed with error {e}")
+    return PdfRenderResult(success=True, bon=RenderedPdf(mime_type="application/pdf", content=pdf_content))
 
-        output_pdf = Path(tmp_dir) / "main.pdf"
 
-        try:
-            pdf_content = output_pdf.read_bytes()
-        except Exception as e:
-            logger.debug(f"Error generating latex pdf: {e}")
-            return PdfRenderResult(success=False, msg=str(e))
+latex_renderer = LatexRenderer()
 
-        return PdfRenderResult(success=True, bon=RenderedPdf(mime_type="application/pdf", content=pdf_content))
+
+async def pdflatex(file_content: str) -> PdfRenderResult:
+    """
+    compiles the given latex document with the shared renderer
+    returns <True, ""> if the pdf was compiled successfully
+    returns <False, error_msg> on a latex compile error
+    """
+    return await latex_renderer.render(file_content)
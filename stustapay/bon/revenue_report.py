@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from pydantic import BaseModel
 from sftkit.database import Connection
@@ -6,7 +6,7 @@ from sftkit.database import Connection
 from stustapay.bon.bon import BonConfig, gen_dummy_order
 from stustapay.bon.pdflatex import PdfRenderResult, pdflatex, render_template
 from stustapay.core.currency import get_currency_symbol
-from stustapay.core.schema.order import Order
+from stustapay.core.schema.order import OrderSummary
 from stustapay.core.schema.tree import Node, RestrictedEventSettings
 from stustapay.core.service.order.stats import (
     Timeseries,
@@ -27,7 +27,7 @@ class DailyRevenue(BaseModel):
 
 class NodeReportContext(BaseModel):
     config: BonConfig
-    orders: list[Order]
+    orders: list[OrderSummary]
     daily_revenue_stats: list[DailyRevenue]
     from_time: datetime
     to_time: datetime
@@ -41,7 +41,7 @@ class NodeReportContext(BaseModel):
     currency_symbol: str
 
 
-class OrderWithFees(Order):
+class OrderWithFees(OrderSummary):
     fees: float
     total_price_minus_fees: float
 
@@ -102,8 +102,9 @@ async def generate_dummy_report(node_id: int, event: RestrictedEventSettings) ->
                 revenue_minus_fees=3000.23 - 3000.23 * fee,
             ),
         ],
-        from_time=datetime.now() - timedelta(days=3),
-        to_time=datetime.now(),
+        # fixed times keep the dummy report identical between requests, so its pdf is only compiled once
+        from_time=datetime.fromisoformat("2024-10-10T08:00:00"),
+        to_time=datetime.fromisoformat("2024-10-11T23:00:00"),
         total_revenue=13212.23,
         fees=13212.23 * fee,
         fees_percent=fee,
@@ -138,7 +139,7 @@ async def generate_report(conn: Connection, node_id: int, fees=0.01) -> PdfRende
     orders = await conn.fetch_many(
         OrderWithFees,
         "select o.*, o.total_price * $2 as fees, o.total_price - o.total_price * $2 as total_price_minus_fees "
-        "from orders_at_node_and_children($1) o where o.payment_method = 'tag' order by o.booked_at",
+        "from order_summaries_at_node_and_children($1) o where o.payment_method = 'tag' order by o.booked_at",
         node_id,
         fees,
     )
@@ -68,3 +68,17 @@ def create_tills(
             dry_run=dry_run,
         )
     )
+
+
+@admin_cli.command()
+def backfill_order_stats(ctx: typer.Context):
+    """Recompute the hourly order stats from all booked orders."""
+    asyncio.run(admin.backfill_order_stats(config=ctx.obj.config))
+
+
+@admin_cli.command()
+def check_order_stats(ctx: typer.Context):
+    """Check the hourly order stats against the booked orders."""
+    consistent = asyncio.run(admin.check_order_stats(config=ctx.obj.config))
+    if not consistent:
+        raise typer.Exit(code=1)
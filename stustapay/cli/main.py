@@ -44,9 +44,11 @@ def get_config(
 @cli.command()
 def bon(
     ctx: typer.Context,
+    workers: Annotated[int, typer.Option("--workers", help="number of bons generated concurrently")] = 4,
+    batch_size: Annotated[int, typer.Option("--batch-size", help="number of bons claimed at once by a worker")] = 20,
 ):
     """Run the bon generator."""
-    generator = Generator(config=ctx.obj.config)
+    generator = Generator(config=ctx.obj.config, n_workers=workers, batch_size=batch_size)
     generator.run()
 
 
@@ -64,6 +66,16 @@ def dsfinvk_export(
         "./stustapay/dsfinvk/assets/gdpdu-01-09-2004.dtd"
     ),
     dry_run: bool = False,
+    jobs: Annotated[
+        int, typer.Option("--jobs", "-j", min=1, help="number of database connections exporting tills in parallel")
+    ] = 1,
+    since_last: Annotated[
+        bool, typer.Option("--since-last", help="only export closures which were not exported before")
+    ] = False,
+    verify: Annotated[
+        bool,
+        typer.Option("--verify", help="check that the already exported closures did not change, writes no file"),
+    ] = False,
 ):
     """Export all data required by dsfinvk to the given zip file."""
     generator = DsfinvkGenerator(
@@ -73,8 +85,13 @@ def dsfinvk_export(
         dtd=str(dtd_file),
         simulate=dry_run,
         event_node_id=node_id,
+        jobs=jobs,
+        since_last=since_last,
+        verify=verify,
     )
     asyncio.run(generator.run())
+    if generator.drifted_closures:
+        raise typer.Exit(1)
 
 
 @cli.command()
@@ -6,6 +6,8 @@ import typer
 from stustapay.festivalsimulator.database_setup import DatabaseSetup
 from stustapay.festivalsimulator.festivalsetup import FestivalSetup
 from stustapay.festivalsimulator.festivalsimulator import Simulator
+from stustapay.festivalsimulator.order_benchmark import OrderBenchmark
+from stustapay.festivalsimulator.tree_benchmark import TreeBenchmark
 
 simulate_cli = typer.Typer()
 
@@ -57,3 +59,29 @@ def start(
     config = ctx.obj.config
     simulator = Simulator(config=config, bookings_per_second=bookings_per_second)
     asyncio.run(simulator.run())
+
+
+@simulate_cli.command()
+def tree_benchmark(
+    ctx: typer.Context,
+    node_counts: Annotated[list[int], typer.Option("--nodes", help="node tree sizes to measure")] = [100, 1000, 5000],
+    branching: Annotated[int, typer.Option(help="number of children per node")] = 5,
+    n_lookups: Annotated[int, typer.Option(help="number of node lookups per tree size")] = 500,
+):
+    """Measure the node lookup cost for growing node trees, all changes are rolled back afterwards."""
+    config = ctx.obj.config
+    benchmark = TreeBenchmark(config=config, node_counts=node_counts, branching=branching, n_lookups=n_lookups)
+    asyncio.run(benchmark.run())
+
+
+@simulate_cli.command()
+def order_benchmark(
+    ctx: typer.Context,
+    node_id: Annotated[int, typer.Option(help="node whose orders are listed, usually the event node")],
+    n_orders: Annotated[int, typer.Option(help="number of orders at the node to measure with")] = 1_000_000,
+    n_repetitions: Annotated[int, typer.Option(help="number of order listings per projection")] = 3,
+):
+    """Compare listing orders with and without line items, all changes are rolled back afterwards."""
+    config = ctx.obj.config
+    benchmark = OrderBenchmark(config=config, node_id=node_id, n_orders=n_orders, n_repetitions=n_repetitions)
+    asyncio.run(benchmark.run())
@@ -11,8 +11,18 @@ tse_cli = typer.Typer()
 
 
 @tse_cli.command()
-def signature_processor(ctx: typer.Context):
-    processor = SignatureProcessor(config=ctx.obj.config)
+def signature_processor(
+    ctx: typer.Context,
+    max_in_flight: Annotated[
+        int, typer.Option("--max-in-flight", help="concurrent signatures per TSE, each for a different till")
+    ] = 1,
+    rebalance: Annotated[
+        bool, typer.Option(help="move idle tills from the most loaded TSE to the least loaded one")
+    ] = False,
+):
+    processor = SignatureProcessor(
+        config=ctx.obj.config, max_signatures_in_flight=max_in_flight, rebalance_idle_tills=rebalance
+    )
     asyncio.run(processor.run())
 
 
@@ -32,6 +42,13 @@ def simulator(
     ] = None,
     gen_key: Annotated[bool, typer.Option("--gen_key", "-g", help="generate new secret key")] = False,
     broken: Annotated[bool, typer.Option("--broken", "-b", help="simulator with error")] = False,
+    count: Annotated[
+        int, typer.Option("--count", "-n", help="number of simulated TSEs, listening on consecutive ports")
+    ] = 1,
+    signing_workers: Annotated[
+        Optional[int],
+        typer.Option(help="processes computing the real signatures, default one per cpu, 0 signs in the event loop"),
+    ] = None,
 ):
     sim = Simulator(
         host,
@@ -42,6 +59,8 @@ def simulator(
         secret_key,
         gen_key,
         broken,
+        n_tses=count,
+        signing_workers=signing_workers,
     )
     asyncio.run(sim.run())
 
@@ -6,6 +6,7 @@ from .config import Config
 from .database import get_database
 from .schema.user import NewUser, RoleToNode, User
 from .service.auth import AuthService
+from .service.order import stats_rollup
 from .service.tree.common import fetch_node
 from .service.user import UserService, fetch_user, list_user_roles, update_user
 
@@ -80,3 +81,30 @@ async def register_tag_with_user(config: Config, user_id: int, tag_pin: str, tag
             pprint(final_user)
     finally:
         await db_pool.close()
+
+
+async def backfill_order_stats(config: Config):
+    db = get_database(config.database)
+    db_pool = await db.create_pool(n_connections=1)
+    try:
+        await database.check_revision_version(db)
+        async with db_pool.acquire() as conn:
+            await stats_rollup.backfill_order_stats(conn=conn)
+        print("recomputed the hourly order stats")
+    finally:
+        await db_pool.close()
+
+
+async def check_order_stats(config: Config) -> bool:
+    db = get_database(config.database)
+    db_pool = await db.create_pool(n_connections=1)
+    try:
+        await database.check_revision_version(db)
+        async with db_pool.acquire() as conn:
+            mismatches = await stats_rollup.check_order_stats(conn=conn)
+        for mismatch in mismatches:
+            pprint(mismatch)
+        print(f"found {len(mismatches)} inconsistent hourly order stats")
+        return len(mismatches) == 0
+    finally:
+        await db_pool.close()
@@ -27,6 +27,9 @@ class CoreConfig(BaseModel):
     sumup_enabled: bool = False
     sumup_max_check_interval: int = 300
 
+    # book sales with the fused book_sale database function instead of the python booking logic
+    fused_sale_booking: bool = False
+
 
 class CustomerPortalApiConfig(HTTPServerConfig):
     base_url: str
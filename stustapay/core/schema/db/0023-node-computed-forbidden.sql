@@ -0,0 +1,63 @@
+-- migration: 2641a8b7
+-- requires: 7e81cbb1
+
+-- materialized version of the recursively computed forbidden objects per node, kept up to date by triggers
+create table node_computed_forbidden (
+    node_id bigint primary key references node(id) on delete cascade,
+    computed_forbidden_in_subtree varchar(255) array not null,
+    computed_forbidden_at_node varchar(255) array not null,
+    forbidden_in_subtree varchar(255) array not null,
+    forbidden_at_node varchar(255) array not null
+);
+
+insert into node_computed_forbidden (
+    node_id, computed_forbidden_in_subtree, computed_forbidden_at_node, forbidden_in_subtree, forbidden_at_node
+)
+with recursive fan as (
+    select
+        n.id as node_id,
+        coalesce(
+            (select array_agg(f.object_name order by f.object_name) from forbidden_objects_at_node f where f.node_id = n.id),
+            '{}'::varchar(255) array
+        ) as forbidden_objects_at_node,
+        coalesce(
+            (select array_agg(f.object_name order by f.object_name) from forbidden_objects_in_subtree_at_node f where f.node_id = n.id),
+            '{}'::varchar(255) array
+        ) as forbidden_objects_in_subtree
+    from node n
+), graph (
+    node_id, path, cycle, computed_forbidden_at_node, computed_forbidden_in_subtree, forbidden_at_node,
+    forbidden_in_subtree
+) as (
+    select
+        0::bigint,
+        '{0}'::bigint[],
+        false,
+        '{}'::varchar(255) array,
+        '{}'::varchar(255) array,
+        '{}'::varchar(255) array,
+        '{}'::varchar(255) array
+    union all
+    select
+        node.id,
+        g.path || node.parent,
+        node.id = any(g.path),
+        (g.computed_forbidden_in_subtree || fan.forbidden_objects_at_node)::varchar(255) array,
+        (g.computed_forbidden_in_subtree || fan.forbidden_objects_in_subtree)::varchar(255) array,
+        fan.forbidden_objects_at_node::varchar(255) array,
+        fan.forbidden_objects_in_subtree::varchar(255) array
+    from
+        graph g
+        join node on g.node_id = node.parent
+        join fan on node.id = fan.node_id
+    where
+        node.id != 0
+        and not g.cycle
+)
+select
+    g.node_id,
+    g.computed_forbidden_in_subtree,
+    g.computed_forbidden_at_node,
+    g.forbidden_in_subtree,
+    g.forbidden_at_node
+from graph g;
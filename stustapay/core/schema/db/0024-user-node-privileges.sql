@@ -0,0 +1,52 @@
+-- migration: 499ac559
+-- requires: 2641a8b7
+
+-- materialized privileges of users at all nodes at or below nodes where they have roles assigned,
+-- kept up to date by triggers. Nodes without an entry for a user grant no privileges.
+create table user_node_privileges (
+    user_id bigint not null references usr(id) on delete cascade,
+    node_id bigint not null references node(id) on delete cascade,
+    role_ids bigint array not null,
+    privileges text array not null,
+    primary key (user_id, node_id)
+);
+
+insert into user_node_privileges (user_id, node_id, role_ids, privileges)
+with recursive own as (
+    select
+        utr.user_id,
+        utr.node_id,
+        array_agg(utr.role_id) as role_ids,
+        coalesce(
+            (
+                select array_agg(urtp.privilege)
+                from user_role_to_privilege urtp join user_to_role utr2 on urtp.role_id = utr2.role_id
+                where utr2.node_id = utr.node_id and utr2.user_id = utr.user_id
+            ),
+            '{}'::text array
+        ) as privileges
+    from user_to_role utr
+    group by utr.user_id, utr.node_id
+), graph (user_id, node_id, role_ids, privileges) as (
+    -- base case: the topmost nodes where a user has roles assigned
+    select own.user_id, own.node_id, own.role_ids, own.privileges
+    from own join node n on own.node_id = n.id
+    where not exists (
+        select from own o2 where o2.user_id = own.user_id and o2.node_id = any(n.parent_ids) and o2.node_id != n.id
+    )
+    union all
+    -- inherit the privileges to all children, adding the roles assigned there
+    select
+        g.user_id,
+        n.id,
+        g.role_ids || coalesce(own.role_ids, '{}'::bigint array),
+        g.privileges || coalesce(own.privileges, '{}'::text array)
+    from
+        graph g
+        join node n on n.parent = g.node_id
+        left join own on own.user_id = g.user_id and own.node_id = n.id
+    where
+        n.id != 0
+)
+select g.user_id, g.node_id, g.role_ids, g.privileges
+from graph g;
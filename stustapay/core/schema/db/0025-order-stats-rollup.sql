@@ -0,0 +1,22 @@
+-- migration: c5e19a3d
+-- requires: 499ac559
+
+-- hourly sums of booked line items, grouped by the node of the till an order was booked at
+create table order_stats_hourly (
+    node_id bigint not null references node(id),
+    hour timestamptz not null,
+    product_id bigint not null references product(id),
+    order_type text not null references order_type(name),
+    payment_method text not null references payment_method(name),
+    count bigint not null,
+    revenue numeric not null,
+    primary key (node_id, hour, product_id, order_type, payment_method)
+);
+
+-- orders which are not yet contained in order_stats_hourly
+create table order_stats_pending (
+    order_id bigint primary key references ordr(id)
+);
+
+insert into order_stats_pending (order_id)
+select o.id from ordr o where o.till_id is not null;
@@ -0,0 +1,10 @@
+-- migration: 8d2f6b1e
+-- requires: c5e19a3d
+
+-- order listings are paginated by descending order id, these serve each page with a single index range scan
+drop index ordr_till_id_idx;
+drop index ordr_customer_account_id_idx;
+drop index ordr_cashier_id_idx;
+create index on ordr (till_id, id);
+create index on ordr (customer_account_id, id);
+create index on ordr (cashier_id, till_id, id);
@@ -0,0 +1,9 @@
+-- migration: 3f7a90c4
+-- requires: 8d2f6b1e
+
+-- latest metrics snapshot of each TSE, written periodically by the signature processor
+create table tse_metrics (
+    tse_id     bigint primary key references tse (id) on delete cascade,
+    metrics    jsonb       not null,
+    updated_at timestamptz not null default now()
+);
@@ -0,0 +1,13 @@
+-- migration: 57769673
+-- requires: 3f7a90c4
+
+-- closed till closures (z_nr) which were already included in a DSFinV-K export of a node,
+-- with a hash of their exported csv rows to detect later changes
+create table dsfinvk_exported_closure (
+    node_id      bigint      not null references node (id) on delete cascade,
+    till_id      bigint      not null references till (id) on delete cascade,
+    z_nr         bigint      not null,
+    content_hash text        not null,
+    exported_at  timestamptz not null default now(),
+    primary key (node_id, till_id, z_nr)
+);
@@ -304,6 +304,28 @@ create view order_value as
         left join account a on ordr.customer_account_id = a.id
         left join user_tag ut on a.user_tag_id = ut.id;
 
+-- order totals without the line items, for listings and reports which do not need the products
+create view order_summary as
+    select
+        ordr.*,
+        ut.uid                          as customer_tag_uid,
+        ut.id                           as customer_tag_id,
+        coalesce(li.total_price, 0)     as total_price,
+        coalesce(li.total_tax, 0)       as total_tax,
+        coalesce(li.total_no_tax, 0)    as total_no_tax
+    from
+        ordr
+        left join lateral (
+            select
+                sum(l.total_price)               as total_price,
+                sum(l.total_tax)                 as total_tax,
+                sum(l.total_price - l.total_tax) as total_no_tax
+            from line_item l
+            where l.order_id = ordr.id
+        ) li on true
+        left join account a on ordr.customer_account_id = a.id
+        left join user_tag ut on a.user_tag_id = ut.id;
+
 -- show all line items
 create view order_items as
     select
@@ -328,6 +350,22 @@ create view order_tax_rates as
     group by
         ordr.id, tax_rate, tax_name;
 
+-- line items of orders booked at tills, with the dimensions of the hourly stats rollup order_stats_hourly
+create view order_stats_line_items as
+    select
+        o.id                            as order_id,
+        t.node_id,
+        date_trunc('hour', o.booked_at) as hour,
+        li.product_id,
+        o.order_type,
+        o.payment_method,
+        li.quantity,
+        li.total_price
+    from
+        ordr o
+        join till t on o.till_id = t.id
+        join line_item li on o.id = li.order_id;
+
 create view event_with_translations as
     select
         e.*,
@@ -340,11 +378,11 @@ create view event_with_translations as
 
 create view _forbidden_at_node as
     with forbidden_at_node_as_list as (
-        select node_id, array_agg(object_name)::varchar(255) array as object_names
+        select node_id, array_agg(object_name order by object_name)::varchar(255) array as object_names
         from forbidden_objects_at_node
         group by node_id
     ), forbidden_in_tree_as_list as (
-        select node_id, array_agg(object_name)::varchar(255) array as object_names
+        select node_id, array_agg(object_name order by object_name)::varchar(255) array as object_names
         from forbidden_objects_in_subtree_at_node
         group by node_id
     )
@@ -356,48 +394,6 @@ create view _forbidden_at_node as
     left join forbidden_at_node_as_list obj_at on n.id = obj_at.node_id
     left join forbidden_in_tree_as_list obj_tree on n.id = obj_tree.node_id;
 
-create view _forbidden_at_node_computed as
-    with recursive graph (
-        node_id, depth, path, cycle, computed_forbidden_at_node, computed_forbidden_in_subtree, forbidden_at_node,
-        forbidden_in_subtree
-    ) as (
-        -- base case: start at the requested node
-        select
-            0::bigint, -- root node ID
-            1,
-            '{0}'::bigint[],
-            false,
-            '{}'::varchar(255) array,
-            '{}'::varchar(255) array,
-            '{}'::varchar(255) array,
-            '{}'::varchar(255) array
-        union all
-        -- add the node's children result set (find the parents for all so-far evaluated nodes)
-        select
-            node.id,
-            g.depth + 1,
-            g.path || node.parent,
-            node.id = any(g.path),
-            (g.computed_forbidden_in_subtree || fan.forbidden_objects_at_node)::varchar(255) array,
-            (g.computed_forbidden_in_subtree || fan.forbidden_objects_in_subtree)::varchar(255) array,
-            fan.forbidden_objects_at_node,
-            fan.forbidden_objects_in_subtree
-        from
-            graph g
-            join node on g.node_id = node.parent
-            join _forbidden_at_node fan ON node.id = fan.node_id
-        where
-            node.id != 0
-            and not g.cycle
-    )
-    select
-        g.node_id,
-        g.computed_forbidden_in_subtree,
-        g.computed_forbidden_at_node,
-        g.forbidden_in_subtree,
-        g.forbidden_at_node
-    from graph g;
-
 create view node_with_allowed_objects as
     with event_as_json as (
         select id, row_to_json(event_with_translations) as json_row
@@ -427,7 +423,7 @@ create view node_with_allowed_objects as
         end as computed_forbidden_objects_in_subtree,
         ev.json_row as event
     from node n
-    join _forbidden_at_node_computed fan on n.id = fan.node_id
+    join node_computed_forbidden fan on n.id = fan.node_id
     left join event_as_json ev on n.event_id = ev.id;
 
 create view mail_with_attachments as
@@ -132,6 +132,175 @@ create trigger check_node_update
     when (OLD.event_id is distinct from NEW.event_id)
 execute function check_node_update();
 
+-- recompute the materialized forbidden objects of a node and its complete subtree.
+-- the computed forbidden objects of a node only depend on its parent, so only the subtree has to be updated.
+create or replace function update_node_computed_forbidden(
+    node_id bigint
+) returns void as
+$$
+begin
+    with recursive graph (
+        node_id, computed_forbidden_at_node, computed_forbidden_in_subtree, forbidden_at_node, forbidden_in_subtree
+    ) as (
+        -- base case: the changed node, based on the already materialized state of its parent.
+        -- the root node has no forbidden objects by definition.
+        select
+            n.id,
+            case when n.id = 0 then '{}'::varchar(255) array
+                else (p.computed_forbidden_in_subtree || fan.forbidden_objects_at_node)::varchar(255) array end,
+            case when n.id = 0 then '{}'::varchar(255) array
+                else (p.computed_forbidden_in_subtree || fan.forbidden_objects_in_subtree)::varchar(255) array end,
+            case when n.id = 0 then '{}'::varchar(255) array
+                else fan.forbidden_objects_at_node::varchar(255) array end,
+            case when n.id = 0 then '{}'::varchar(255) array
+                else fan.forbidden_objects_in_subtree::varchar(255) array end
+        from
+            node n
+            join _forbidden_at_node fan on n.id = fan.node_id
+            left join node_computed_forbidden p on p.node_id = n.parent
+        where n.id = update_node_computed_forbidden.node_id
+        union all
+        -- add the children of all so-far evaluated nodes
+        select
+            node.id,
+            (g.computed_forbidden_in_subtree || fan.forbidden_objects_at_node)::varchar(255) array,
+            (g.computed_forbidden_in_subtree || fan.forbidden_objects_in_subtree)::varchar(255) array,
+            fan.forbidden_objects_at_node::varchar(255) array,
+            fan.forbidden_objects_in_subtree::varchar(255) array
+        from
+            graph g
+            join node on g.node_id = node.parent
+            join _forbidden_at_node fan on node.id = fan.node_id
+        where
+            node.id != 0
+    )
+    insert into node_computed_forbidden (
+        node_id, computed_forbidden_in_subtree, computed_forbidden_at_node, forbidden_in_subtree, forbidden_at_node
+    )
+    select
+        g.node_id,
+        g.computed_forbidden_in_subtree,
+        g.computed_forbidden_at_node,
+        g.forbidden_in_subtree,
+        g.forbidden_at_node
+    from graph g
+    on conflict on constraint node_computed_forbidden_pkey do update set
+        computed_forbidden_in_subtree = excluded.computed_forbidden_in_subtree,
+        computed_forbidden_at_node = excluded.computed_forbidden_at_node,
+        forbidden_in_subtree = excluded.forbidden_in_subtree,
+        forbidden_at_node = excluded.forbidden_at_node;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+create or replace function node_inserted_update_computed_forbidden() returns trigger as
+$$
+begin
+    perform update_node_computed_forbidden(NEW.id);
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+create trigger node_inserted_update_computed_forbidden_trigger
+    after insert
+    on node
+    for each row
+execute function node_inserted_update_computed_forbidden();
+
+create or replace function node_inserted_inherit_user_privileges() returns trigger as
+$$
+begin
+    insert into user_node_privileges (user_id, node_id, role_ids, privileges)
+    select p.user_id, NEW.id, p.role_ids, p.privileges
+    from user_node_privileges p
+    where p.node_id = NEW.parent;
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+create trigger node_inserted_inherit_user_privileges_trigger
+    after insert
+    on node
+    for each row
+execute function node_inserted_inherit_user_privileges();
+
+create or replace function forbidden_objects_update_computed_forbidden() returns trigger as
+$$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        perform update_node_computed_forbidden(OLD.node_id);
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') and (TG_OP = 'INSERT' or OLD.node_id != NEW.node_id) then
+        perform update_node_computed_forbidden(NEW.node_id);
+    end if;
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+create trigger forbidden_objects_at_node_update_computed_forbidden_trigger
+    after insert or update or delete
+    on forbidden_objects_at_node
+    for each row
+execute function forbidden_objects_update_computed_forbidden();
+
+create trigger forbidden_objects_in_subtree_update_computed_forbidden_trigger
+    after insert or update or delete
+    on forbidden_objects_in_subtree_at_node
+    for each row
+execute function forbidden_objects_update_computed_forbidden();
+
+create or replace function update_user_node_privileges(
+    user_id bigint
+) returns void as
+$$
+begin
+    delete from user_node_privileges unp where unp.user_id = update_user_node_privileges.user_id;
+
+    with recursive own as (
+        select
+            utr.node_id,
+            array_agg(utr.role_id) as role_ids,
+            coalesce(
+                (
+                    select array_agg(urtp.privilege)
+                    from user_role_to_privilege urtp join user_to_role utr2 on urtp.role_id = utr2.role_id
+                    where utr2.node_id = utr.node_id and utr2.user_id = update_user_node_privileges.user_id
+                ),
+                '{}'::text array
+            ) as privileges
+        from user_to_role utr
+        where utr.user_id = update_user_node_privileges.user_id
+        group by utr.node_id
+    ), graph (node_id, role_ids, privileges) as (
+        -- base case: the topmost nodes where the user has roles assigned
+        select own.node_id, own.role_ids, own.privileges
+        from own join node n on own.node_id = n.id
+        where not exists (select from own o2 where o2.node_id = any(n.parent_ids) and o2.node_id != n.id)
+        union all
+        -- inherit the privileges to all children, adding the roles assigned there
+        select
+            n.id,
+            g.role_ids || coalesce(own.role_ids, '{}'::bigint array),
+            g.privileges || coalesce(own.privileges, '{}'::text array)
+        from
+            graph g
+            join node n on n.parent = g.node_id
+            left join own on own.node_id = n.id
+        where
+            n.id != 0
+    )
+    insert into user_node_privileges (user_id, node_id, role_ids, privileges)
+    select update_user_node_privileges.user_id, g.node_id, g.role_ids, g.privileges
+    from graph g;
+
+    perform pg_notify('auth_session', 'user:' || update_user_node_privileges.user_id);
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
 create or replace function user_to_role_updated() returns trigger
     set search_path = "$user", public
     language plpgsql as
@@ -145,6 +314,8 @@ $$
     cashier_account_id    bigint;
     transport_account_id  bigint;
 begin
+    perform update_user_node_privileges(NEW.user_id);
+
     select
         ur.privileges
     into locals.role_privileges
@@ -222,6 +393,52 @@ create trigger user_to_role_updated_trigger
     for each row
 execute function user_to_role_updated();
 
+create or replace function user_to_role_removed() returns trigger as
+$$
+begin
+    perform update_user_node_privileges(OLD.user_id);
+    if TG_OP = 'UPDATE' and NEW.user_id != OLD.user_id then
+        perform update_user_node_privileges(NEW.user_id);
+    end if;
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists user_to_role_removed_trigger on user_to_role;
+create trigger user_to_role_removed_trigger
+    after update or delete
+    on user_to_role
+    for each row
+execute function user_to_role_removed();
+
+create or replace function user_role_privileges_updated() returns trigger as
+$$
+<<locals>> declare
+    role_id bigint;
+    user_id bigint;
+begin
+    locals.role_id := case when TG_OP = 'DELETE' then OLD.role_id else NEW.role_id end;
+    for user_id in select distinct utr.user_id from user_to_role utr where utr.role_id = locals.role_id loop
+        perform update_user_node_privileges(user_id);
+    end loop;
+    if TG_OP = 'UPDATE' and NEW.role_id != OLD.role_id then
+        for user_id in select distinct utr.user_id from user_to_role utr where utr.role_id = OLD.role_id loop
+            perform update_user_node_privileges(user_id);
+        end loop;
+    end if;
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists user_role_privileges_updated_trigger on user_role_to_privilege;
+create trigger user_role_privileges_updated_trigger
+    after insert or update or delete
+    on user_role_to_privilege
+    for each row
+execute function user_role_privileges_updated();
+
 create or replace function check_account_balance() returns trigger as
 $$
 <<locals>> declare
@@ -424,6 +641,24 @@ create trigger new_order_trigger
     for each row
 execute function new_order_added();
 
+-- queue orders booked at tills for the hourly stats rollup, see rollup_order_stats
+create or replace function order_stats_enqueue() returns trigger as
+$$
+begin
+    insert into order_stats_pending (order_id) values (NEW.id);
+    return null;
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists order_stats_enqueue_trigger on ordr;
+create trigger order_stats_enqueue_trigger
+    after insert
+    on ordr
+    for each row
+    when (NEW.till_id is not null)
+execute function order_stats_enqueue();
+
 create or replace function tse_signature_update_trigger_procedure() returns trigger as
 $$
 begin
@@ -549,3 +784,197 @@ create trigger create_customer_info_trigger
     for each row
     when (NEW.type = 'private')
 execute function create_customer_info();
+
+
+-- notify in-process caches of system accounts, products, till button catalogs and tree nodes about changes
+create or replace function notify_node_constants_changed() returns trigger as
+$$
+begin
+    perform pg_notify('node_constants', json_build_object('table', TG_TABLE_NAME)::text);
+    return null;
+end
+$$ language plpgsql set search_path = "$user", public;
+
+drop trigger if exists system_account_insert_notify_trigger on account;
+create trigger system_account_insert_notify_trigger
+    after insert
+    on account
+    for each row
+    when (NEW.type not in ('private', 'cashier', 'transport'))
+execute function notify_node_constants_changed();
+
+drop trigger if exists system_account_update_notify_trigger on account;
+create trigger system_account_update_notify_trigger
+    after update of type, node_id
+    on account
+    for each row
+    when (OLD.type not in ('private', 'cashier', 'transport') or NEW.type not in ('private', 'cashier', 'transport'))
+execute function notify_node_constants_changed();
+
+drop trigger if exists system_account_delete_notify_trigger on account;
+create trigger system_account_delete_notify_trigger
+    after delete
+    on account
+    for each row
+    when (OLD.type not in ('private', 'cashier', 'transport'))
+execute function notify_node_constants_changed();
+
+drop trigger if exists product_notify_trigger on product;
+create trigger product_notify_trigger
+    after insert or update or delete
+    on product
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists product_restriction_notify_trigger on product_restriction;
+create trigger product_restriction_notify_trigger
+    after insert or update or delete
+    on product_restriction
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists tax_rate_notify_trigger on tax_rate;
+create trigger tax_rate_notify_trigger
+    after insert or update or delete
+    on tax_rate
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists till_profile_notify_trigger on till_profile;
+create trigger till_profile_notify_trigger
+    after update of layout_id or delete
+    on till_profile
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists till_layout_to_button_notify_trigger on till_layout_to_button;
+create trigger till_layout_to_button_notify_trigger
+    after insert or update or delete
+    on till_layout_to_button
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists till_button_product_notify_trigger on till_button_product;
+create trigger till_button_product_notify_trigger
+    after insert or update or delete
+    on till_button_product
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists terminal_notify_trigger on terminal;
+create trigger terminal_notify_trigger
+    after update or delete
+    on terminal
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists node_notify_trigger on node;
+create trigger node_notify_trigger
+    after insert or update or delete
+    on node
+    for each statement
+execute function notify_node_constants_changed();
+
+drop trigger if exists event_notify_trigger on event;
+create trigger event_notify_trigger
+    after insert or update or delete
+    on event
+    for each statement
+execute function notify_node_constants_changed();
+
+
+-- notify the in-process node tree caches about changes of the tree, events and their translations
+create or replace function notify_node_changed() returns trigger as
+$$
+begin
+    perform pg_notify('node', json_build_object('table', TG_TABLE_NAME)::text);
+    return null;
+end
+$$ language plpgsql set search_path = "$user", public;
+
+drop trigger if exists node_tree_notify_trigger on node;
+create trigger node_tree_notify_trigger
+    after insert or update or delete
+    on node
+    for each statement
+execute function notify_node_changed();
+
+drop trigger if exists event_tree_notify_trigger on event;
+create trigger event_tree_notify_trigger
+    after insert or update or delete
+    on event
+    for each statement
+execute function notify_node_changed();
+
+drop trigger if exists translation_text_tree_notify_trigger on translation_text;
+create trigger translation_text_tree_notify_trigger
+    after insert or update or delete
+    on translation_text
+    for each statement
+execute function notify_node_changed();
+
+drop trigger if exists forbidden_objects_at_node_tree_notify_trigger on forbidden_objects_at_node;
+create trigger forbidden_objects_at_node_tree_notify_trigger
+    after insert or update or delete
+    on forbidden_objects_at_node
+    for each statement
+execute function notify_node_changed();
+
+drop trigger if exists forbidden_objects_in_subtree_at_node_tree_notify_trigger on forbidden_objects_in_subtree_at_node;
+create trigger forbidden_objects_in_subtree_at_node_tree_notify_trigger
+    after insert or update or delete
+    on forbidden_objects_in_subtree_at_node
+    for each statement
+execute function notify_node_changed();
+
+
+-- notify in-process token caches about ended sessions and changed users.
+-- trigger arguments: the kind of the logged in subject ('user', 'customer' or 'terminal')
+-- and the column of the changed row which holds the id of the subject
+create or replace function notify_auth_session_changed() returns trigger as
+$$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        perform pg_notify('auth_session', TG_ARGV[0] || ':' || (to_jsonb(OLD) ->> TG_ARGV[1]));
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        perform pg_notify('auth_session', TG_ARGV[0] || ':' || (to_jsonb(NEW) ->> TG_ARGV[1]));
+    end if;
+    return null;
+end
+$$ language plpgsql set search_path = "$user", public;
+
+drop trigger if exists usr_session_auth_notify_trigger on usr_session;
+create trigger usr_session_auth_notify_trigger
+    after update or delete
+    on usr_session
+    for each row
+execute function notify_auth_session_changed('user', 'usr');
+
+drop trigger if exists usr_auth_notify_trigger on usr;
+create trigger usr_auth_notify_trigger
+    after update or delete
+    on usr
+    for each row
+execute function notify_auth_session_changed('user', 'id');
+
+drop trigger if exists user_to_role_auth_notify_trigger on user_to_role;
+create trigger user_to_role_auth_notify_trigger
+    after insert or update or delete
+    on user_to_role
+    for each row
+execute function notify_auth_session_changed('user', 'user_id');
+
+drop trigger if exists customer_session_auth_notify_trigger on customer_session;
+create trigger customer_session_auth_notify_trigger
+    after update or delete
+    on customer_session
+    for each row
+execute function notify_auth_session_changed('customer', 'customer');
+
+drop trigger if exists terminal_auth_notify_trigger on terminal;
+create trigger terminal_auth_notify_trigger
+    after update or delete
+    on terminal
+    for each row
+execute function notify_auth_session_changed('terminal', 'id');
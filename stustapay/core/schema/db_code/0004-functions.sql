@@ -51,6 +51,82 @@ end;
 $$ language plpgsql
     set search_path = "$user", public;
 
+-- set based variant of book_transaction, books all given (source, target, amount, vouchers) tuples
+-- with a single transaction insert and a single account update.
+-- returns the new transaction ids in the order of the given bookings.
+create or replace function book_transactions(
+    order_id bigint,
+    description text,
+    source_account_ids bigint array,
+    target_account_ids bigint array,
+    amounts numeric array,
+    vouchers_amounts bigint array,
+    booked_at timestamptz default now(),
+    conducting_user_id bigint default null
+) returns setof bigint as
+$$
+begin
+    if exists(
+        select from unnest(book_transactions.amounts, book_transactions.vouchers_amounts) as b(amount, vouchers)
+        where b.amount * b.vouchers < 0
+    ) then
+        raise 'vouchers_amount and amount must have the same sign';
+    end if;
+
+    return query
+    with bookings as (
+        -- swap account on negative amount, as only non-negative transactions are allowed
+        select
+            b.idx,
+            case when b.amount < 0 or b.vouchers < 0 then b.target_account else b.source_account end as source_account,
+            case when b.amount < 0 or b.vouchers < 0 then b.source_account else b.target_account end as target_account,
+            abs(b.amount) as amount,
+            abs(b.vouchers) as vouchers
+        from unnest(
+            book_transactions.source_account_ids,
+            book_transactions.target_account_ids,
+            book_transactions.amounts,
+            book_transactions.vouchers_amounts
+        ) with ordinality as b(source_account, target_account, amount, vouchers, idx)
+    ), inserted as (
+        insert into transaction (
+            order_id, description, source_account, target_account, amount, vouchers, booked_at, conducting_user_id
+        )
+        select
+            book_transactions.order_id,
+            book_transactions.description,
+            b.source_account,
+            b.target_account,
+            b.amount,
+            b.vouchers,
+            book_transactions.booked_at,
+            book_transactions.conducting_user_id
+        from bookings b
+        order by b.idx
+        returning transaction.id, transaction.source_account, transaction.target_account, transaction.amount,
+            transaction.vouchers
+    ), account_deltas as (
+        select d.account_id, sum(d.amount) as amount, sum(d.vouchers) as vouchers
+        from (
+            select i.source_account as account_id, -i.amount as amount, -i.vouchers as vouchers from inserted i
+            union all
+            select i.target_account as account_id, i.amount as amount, i.vouchers as vouchers from inserted i
+        ) d
+        group by d.account_id
+    ), updated_accounts as (
+        -- update account values
+        update account set
+            balance = account.balance + account_deltas.amount,
+            vouchers = account.vouchers + account_deltas.vouchers
+        from account_deltas
+        where account.id = account_deltas.account_id
+    )
+    select i.id from inserted i order by i.id;
+
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
+
 create or replace function user_privileges_at_node(
     user_id bigint
 )
@@ -61,55 +137,15 @@ returns table (
 )
 as
 $$
-with recursive graph (node_id, path, cycle, role_ids, privileges_at_node) as (
-    -- base case: start at the requested node
+    -- privileges are materialized in user_node_privileges, nodes without an entry grant no privileges
     select
-        0::bigint, -- root node ID
-        '{0}'::bigint[],
-        false,
-        coalesce((
-            select array_agg(utr3.role_id)
-            from user_to_role utr3
-            where utr3.node_id = 0 and utr3.user_id = user_privileges_at_node.user_id),
-            '{}'::bigint array
-        ) as role_ids,
-        coalesce((
-            select array_agg(urtp.privilege)
-            from user_role_to_privilege urtp join user_to_role utr2 on urtp.role_id = utr2.role_id
-            where utr2.node_id = 0 and utr2.user_id = user_privileges_at_node.user_id),
-            '{}'::text array
-        ) as privileges_at_node
-    union all
-    -- add the node's children result set (find the parents for all so-far evaluated nodes)
-    select
-        node.id,
-        g.path || node.parent,
-        node.id = any(g.path),
-        g.role_ids || (
-            select coalesce(array_agg(utr2.role_id), '{}'::bigint array)
-            from user_to_role utr2
-            where utr2.node_id = node.id and utr2.user_id = user_privileges_at_node.user_id
-        )::bigint array,
-        g.privileges_at_node || (
-            select coalesce(array_agg(t.privileges), '{}'::text array)
-            from (
-                select unnest(urwp.privileges) as privileges
-                from user_role_with_privileges urwp join user_to_role utr3 on urwp.id = utr3.role_id
-                where utr3.node_id = node.id and utr3.user_id = user_privileges_at_node.user_id
-            ) t
-        )::text array
+        n.id,
+        coalesce(unp.role_ids, '{}'::bigint array),
+        coalesce(unp.privileges, '{}'::text array)
     from
-        graph g
-        join node on g.node_id = node.parent
-    where
-        node.id != 0
-        and not g.cycle
-)
-select
-    g.node_id,
-    g.role_ids,
-    g.privileges_at_node
-from graph g;
+        node n
+        left join user_node_privileges unp
+            on unp.node_id = n.id and unp.user_id = user_privileges_at_node.user_id;
 $$ language sql
     stable
     security invoker
@@ -156,3 +192,453 @@ $$ language sql
     stable
     security invoker
     set search_path = "$user", public;
+
+create or replace function order_summaries_at_node_and_children(
+    node_id bigint
+) returns setof order_summary as
+$$
+
+select
+    o.*
+from order_summary o
+    join till t on o.till_id = t.id
+    join node n on n.id = t.node_id
+where
+    order_summaries_at_node_and_children.node_id = any(n.parent_ids) or n.id = order_summaries_at_node_and_children.node_id;
+
+$$ language sql
+    stable
+    security invoker
+    set search_path = "$user", public;
+
+-- add up to max_orders queued orders to the hourly stats rollup, returns the number of processed orders.
+-- can be called concurrently, queued orders are claimed with skip locked.
+create or replace function rollup_order_stats(
+    max_orders integer
+) returns integer as
+$$
+<<locals>> declare
+    n_orders integer;
+begin
+    with batch as (
+        delete from order_stats_pending
+        where order_id in (
+            select p.order_id from order_stats_pending p
+            order by p.order_id
+            limit rollup_order_stats.max_orders
+            for update skip locked
+        )
+        returning order_id
+    ), buckets as (
+        insert into order_stats_hourly (node_id, hour, product_id, order_type, payment_method, count, revenue)
+        select li.node_id, li.hour, li.product_id, li.order_type, li.payment_method, sum(li.quantity), sum(li.total_price)
+        from batch b join order_stats_line_items li on b.order_id = li.order_id
+        group by li.node_id, li.hour, li.product_id, li.order_type, li.payment_method
+        -- a consistent order of row locks prevents deadlocks between concurrent rollups
+        order by li.node_id, li.hour, li.product_id, li.order_type, li.payment_method
+        on conflict on constraint order_stats_hourly_pkey do update set
+            count = order_stats_hourly.count + excluded.count,
+            revenue = order_stats_hourly.revenue + excluded.revenue
+    )
+    select count(*) into locals.n_orders from batch;
+
+    return locals.n_orders;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+-- fused booking of a sale, performs all checks and bookings of OrderService._book_sale within a single call.
+-- button_* arrays describe the booked till buttons (or products if button_is_product is set).
+-- validation errors are raised with the service exception id as detail and its arguments as json hint.
+create or replace function book_sale(
+    order_uuid uuid,
+    node_ids_to_root bigint array,
+    node_ids_to_event_node bigint array,
+    till_id bigint,
+    till_profile_id bigint,
+    cashier_id bigint,
+    cashier_account_id bigint,
+    cash_register_id bigint,
+    payment_method text,
+    customer_tag_uid numeric,
+    used_vouchers bigint,
+    button_ids bigint array,
+    button_is_product boolean array,
+    button_quantities bigint array,
+    button_prices numeric array,
+    max_account_balance numeric
+) returns json as
+$$
+<<locals>> declare
+    tag_payment             boolean;
+    customer_account_id     bigint;
+    customer_balance        numeric := 0;
+    customer_vouchers       bigint := 0;
+    customer_restriction    text;
+    product                 record;
+    n_products              int;
+    -- products resolved from the booked buttons, in booking order
+    booked_product_ids      bigint array := '{}';
+    booked_quantities       bigint array := '{}';
+    booked_prices           numeric array := '{}';
+    restricted_products     text array;
+    -- aggregated line items, in booking order
+    li_product_ids          bigint array;
+    li_quantities           bigint array;
+    li_prices               numeric array;
+    li_tax_rate_ids         bigint array;
+    li_tax_names            text array;
+    li_tax_rates            numeric array;
+    -- voucher computation
+    vouchers_to_use         bigint;
+    n_used_vouchers         bigint := 0;
+    vouchers_for_product    bigint;
+    discount_product_id     bigint;
+    discount_tax_rate_id    bigint;
+    discount_idx            int;
+    discount_tax_names      text array := '{}';
+    discount_tax_rates      numeric array := '{}';
+    discount_prices         numeric array := '{}';
+    total_price             numeric;
+    new_balance             numeric := 0;
+    new_voucher_balance     bigint := 0;
+    -- booking
+    cash_entry_account_id   bigint;
+    cash_topup_account_id   bigint;
+    sumup_entry_account_id  bigint;
+    sale_exit_account_id    bigint;
+    z_nr                    bigint;
+    order_id                bigint;
+    booked_at               timestamptz;
+begin
+    if book_sale.payment_method = 'sumup_online' then
+        raise 'Cannot pay sales online' using detail = 'InvalidArgument';
+    end if;
+
+    locals.tag_payment := book_sale.payment_method = 'tag';
+
+    if locals.tag_payment and book_sale.customer_tag_uid is null then
+        raise 'Tag UID required for tag payment' using detail = 'InvalidArgument';
+    end if;
+
+    if not locals.tag_payment and book_sale.customer_tag_uid is not null then
+        raise 'Tag UID given for cash or card payment' using detail = 'InvalidArgument';
+    end if;
+
+    if exists(select from ordr o where o.uuid = book_sale.order_uuid) then
+        raise 'Successfully booked order' using detail = 'AlreadyProcessed';
+    end if;
+
+    if locals.tag_payment then
+        select a.id, a.balance, a.vouchers, t.restriction
+        into locals.customer_account_id, locals.customer_balance, locals.customer_vouchers, locals.customer_restriction
+        from user_tag t join account a on t.id = a.user_tag_id
+        where t.uid = book_sale.customer_tag_uid and a.type = 'private' and a.node_id = any(book_sale.node_ids_to_root);
+
+        if locals.customer_account_id is null then
+            raise 'Customer not found' using
+                detail = 'CustomerNotFound',
+                hint = json_build_object('uid', book_sale.customer_tag_uid)::text;
+        end if;
+    end if;
+
+    -- resolve the booked buttons to products
+    for button_idx in 1 .. coalesce(array_length(book_sale.button_ids, 1), 0) loop
+        locals.n_products := 0;
+        for locals.product in
+            select p.id, p.name, p.fixed_price, p.is_returnable
+            from till_button_product tbp
+                join product p on tbp.product_id = p.id
+                join till_layout_to_button tltp on tltp.button_id = tbp.button_id
+                join till_profile tp on tp.layout_id = tltp.layout_id
+            where not book_sale.button_is_product[button_idx]
+                and tbp.button_id = book_sale.button_ids[button_idx]
+                and tp.id = book_sale.till_profile_id
+            union all
+            select p.id, p.name, p.fixed_price, p.is_returnable
+            from product p
+            where book_sale.button_is_product[button_idx] and p.id = book_sale.button_ids[button_idx]
+            order by id
+        loop
+            locals.n_products := locals.n_products + 1;
+
+            if (book_sale.button_prices[button_idx] is null) != locals.product.fixed_price then
+                raise 'cannot book a fixed price product with a variable price' using detail = 'InvalidArgument';
+            end if;
+            if book_sale.button_quantities[button_idx] < 0 and not locals.product.is_returnable then
+                raise 'Cannot return a non returnable product %', locals.product.name using detail = 'InvalidSale';
+            end if;
+
+            locals.booked_product_ids := locals.booked_product_ids || locals.product.id;
+            locals.booked_quantities := locals.booked_quantities || book_sale.button_quantities[button_idx];
+            locals.booked_prices := locals.booked_prices || book_sale.button_prices[button_idx];
+        end loop;
+
+        if locals.n_products = 0 then
+            raise 'this till profile is not allowed to use these buttons' using detail = 'InvalidArgument';
+        end if;
+    end loop;
+
+    -- check age restrictions
+    if locals.customer_restriction is not null then
+        select array_agg(distinct p.name)
+        into locals.restricted_products
+        from product_with_tax_and_restrictions p
+        where p.id = any(locals.booked_product_ids) and locals.customer_restriction = any(p.restrictions);
+
+        if locals.restricted_products is not null then
+            raise 'Too young for product: %', array_to_string(locals.restricted_products, ', ') using
+                detail = 'AgeRestriction',
+                hint = json_build_object('product_names', locals.restricted_products)::text;
+        end if;
+    end if;
+
+    -- group the booked products to line items by product and aggregate their quantity or price
+    select
+        coalesce(array_agg(g.product_id order by g.first_idx), '{}'),
+        coalesce(array_agg(g.quantity order by g.first_idx), '{}'),
+        coalesce(array_agg(g.price order by g.first_idx), '{}'),
+        coalesce(array_agg(g.tax_rate_id order by g.first_idx), '{}'),
+        coalesce(array_agg(g.tax_name order by g.first_idx), '{}'),
+        coalesce(array_agg(g.tax_rate order by g.first_idx), '{}')
+    into
+        locals.li_product_ids, locals.li_quantities, locals.li_prices,
+        locals.li_tax_rate_ids, locals.li_tax_names, locals.li_tax_rates
+    from (
+        select
+            p.id as product_id,
+            min(b.idx) as first_idx,
+            case when p.fixed_price then sum(b.quantity) else 1 end as quantity,
+            case when p.fixed_price then p.price else sum(b.price) end as price,
+            p.tax_rate_id,
+            p.tax_name,
+            p.tax_rate
+        from
+            unnest(locals.booked_product_ids, locals.booked_quantities, locals.booked_prices)
+                with ordinality as b(product_id, quantity, price, idx)
+            join product_with_tax_and_restrictions p on b.product_id = p.id
+        group by p.id, p.fixed_price, p.price, p.tax_rate_id, p.tax_name, p.tax_rate
+    ) g
+    -- quantity_not_zero constraint - skip empty items!
+    where g.quantity != 0;
+
+    if locals.tag_payment then
+        -- if an explicit voucher amount was requested - use that as the maximum.
+        locals.vouchers_to_use := locals.customer_vouchers;
+        if book_sale.used_vouchers is not null then
+            if book_sale.used_vouchers > locals.customer_vouchers then
+                raise 'Not enough vouchers. Available: %', locals.customer_vouchers using
+                    detail = 'NotEnoughVouchers',
+                    hint = json_build_object(
+                        'used_vouchers', book_sale.used_vouchers, 'available_vouchers', locals.customer_vouchers
+                    )::text;
+            end if;
+            locals.vouchers_to_use := book_sale.used_vouchers;
+        end if;
+
+        select p.id, p.tax_rate_id
+        into locals.discount_product_id, locals.discount_tax_rate_id
+        from product p
+        where p.type = 'discount' and p.node_id = any(book_sale.node_ids_to_event_node);
+        if locals.discount_product_id is null then
+            raise 'no product found in database';
+        end if;
+
+        -- apply vouchers to the line items with the highest price per voucher first
+        if locals.vouchers_to_use > 0 then
+            for locals.product in
+                select li.quantity, li.tax_name, li.tax_rate, p.price_in_vouchers, p.price_per_voucher
+                from
+                    unnest(locals.li_product_ids, locals.li_quantities, locals.li_tax_names, locals.li_tax_rates)
+                        with ordinality as li(product_id, quantity, tax_name, tax_rate, idx)
+                    join product_with_tax_and_restrictions p on li.product_id = p.id
+                order by p.price_per_voucher desc nulls first, li.idx
+            loop
+                exit when locals.n_used_vouchers >= locals.vouchers_to_use;
+                continue when locals.product.price_in_vouchers is null or locals.product.price_per_voucher is null;
+
+                locals.vouchers_for_product := least(
+                    locals.vouchers_to_use - locals.n_used_vouchers,
+                    locals.product.price_in_vouchers * locals.product.quantity
+                );
+
+                locals.discount_idx := array_position(locals.discount_tax_names, locals.product.tax_name);
+                if locals.discount_idx is null then
+                    locals.discount_tax_names := locals.discount_tax_names || locals.product.tax_name;
+                    locals.discount_tax_rates := locals.discount_tax_rates || locals.product.tax_rate;
+                    locals.discount_prices := locals.discount_prices
+                        || -(locals.product.price_per_voucher * locals.vouchers_for_product);
+                else
+                    locals.discount_prices[locals.discount_idx] := locals.discount_prices[locals.discount_idx]
+                        - locals.product.price_per_voucher * locals.vouchers_for_product;
+                end if;
+
+                locals.n_used_vouchers := locals.n_used_vouchers + locals.vouchers_for_product;
+            end loop;
+
+            for tax_idx in 1 .. coalesce(array_length(locals.discount_tax_names, 1), 0) loop
+                locals.li_product_ids := locals.li_product_ids || locals.discount_product_id;
+                locals.li_quantities := locals.li_quantities || 1::bigint;
+                locals.li_prices := locals.li_prices || locals.discount_prices[tax_idx];
+                locals.li_tax_rate_ids := locals.li_tax_rate_ids || locals.discount_tax_rate_id;
+                locals.li_tax_names := locals.li_tax_names || locals.discount_tax_names[tax_idx];
+                locals.li_tax_rates := locals.li_tax_rates || locals.discount_tax_rates[tax_idx];
+            end loop;
+        end if;
+    end if;
+
+    select coalesce(sum(li.price * li.quantity), 0)
+    into locals.total_price
+    from unnest(locals.li_prices, locals.li_quantities) as li(price, quantity);
+
+    if locals.tag_payment then
+        if locals.customer_balance < locals.total_price then
+            raise 'Not enough funds available' using
+                detail = 'NotEnoughFunds',
+                hint = json_build_object(
+                    'needed_fund', locals.total_price, 'available_fund', locals.customer_balance
+                )::text;
+        end if;
+        locals.new_balance := locals.customer_balance - locals.total_price;
+
+        if locals.new_balance > book_sale.max_account_balance then
+            raise 'More than %€ on accounts is disallowed! New balance would be %€, which is %€ too much.',
+                to_char(book_sale.max_account_balance, 'FM999999990.00'),
+                to_char(locals.new_balance, 'FM999999990.00'),
+                to_char(locals.new_balance - book_sale.max_account_balance, 'FM999999990.00')
+                using detail = 'InvalidArgument';
+        end if;
+
+        if locals.new_balance < 0 then
+            raise 'Account balance would be less than 0€. New balance would be %€',
+                to_char(locals.new_balance, 'FM999999990.00')
+                using detail = 'InvalidArgument';
+        end if;
+    end if;
+
+    select
+        max(a.id) filter (where a.type = 'cash_entry'),
+        max(a.id) filter (where a.type = 'cash_topup_source'),
+        max(a.id) filter (where a.type = 'sumup_entry'),
+        max(a.id) filter (where a.type = 'sale_exit')
+    into
+        locals.cash_entry_account_id, locals.cash_topup_account_id, locals.sumup_entry_account_id,
+        locals.sale_exit_account_id
+    from account a
+    where a.node_id = any(book_sale.node_ids_to_event_node)
+        and a.type in ('cash_entry', 'cash_topup_source', 'sumup_entry', 'sale_exit');
+
+    select t.z_nr into locals.z_nr from till t where t.id = book_sale.till_id;
+    if locals.z_nr is null then
+        raise 'Till does not exist' using detail = 'InvalidArgument';
+    end if;
+
+    insert into ordr (
+        uuid, item_count, payment_method, order_type, cashier_id, till_id, customer_account_id, cash_register_id, z_nr
+    )
+    values (
+        book_sale.order_uuid,
+        coalesce(array_length(locals.li_product_ids, 1), 0),
+        book_sale.payment_method,
+        'sale',
+        book_sale.cashier_id,
+        book_sale.till_id,
+        locals.customer_account_id,
+        case when book_sale.payment_method = 'cash' then book_sale.cash_register_id end,
+        locals.z_nr
+    )
+    returning ordr.id, ordr.booked_at into locals.order_id, locals.booked_at;
+
+    -- the stored tax name and rate are always the ones of the line item's tax rate id
+    insert into line_item (order_id, item_id, product_id, product_price, quantity, tax_rate_id, tax_name, tax_rate)
+    select locals.order_id, li.item_id - 1, li.product_id, li.price, li.quantity, li.tax_rate_id, t.name, t.rate
+    from unnest(
+        locals.li_product_ids, locals.li_prices, locals.li_quantities, locals.li_tax_rate_ids
+    ) with ordinality as li(product_id, price, quantity, tax_rate_id, item_id)
+        join tax_rate t on t.id = li.tax_rate_id
+    order by li.item_id;
+
+    -- combine bookings based on (source, target) -> amount
+    perform book_transactions(
+        order_id => locals.order_id,
+        description => '',
+        source_account_ids => array_agg(b.source_account order by b.first_idx),
+        target_account_ids => array_agg(b.target_account order by b.first_idx),
+        amounts => array_agg(b.amount order by b.first_idx),
+        vouchers_amounts => array_agg(0::bigint order by b.first_idx)
+    )
+    from (
+        select s.source_account, s.target_account, min(s.idx) as first_idx, sum(s.amount) as amount
+        from (
+            select
+                li.idx * 2 + 1 as idx,
+                case book_sale.payment_method
+                    when 'tag' then locals.customer_account_id
+                    when 'cash' then locals.cash_topup_account_id
+                    when 'sumup' then locals.sumup_entry_account_id
+                end as source_account,
+                coalesce(p.target_account_id, locals.sale_exit_account_id) as target_account,
+                li.price * li.quantity as amount
+            from unnest(locals.li_product_ids, locals.li_prices, locals.li_quantities)
+                with ordinality as li(product_id, price, quantity, idx)
+                join product p on li.product_id = p.id
+            union all
+            select
+                li.idx * 2 as idx,
+                locals.cash_entry_account_id as source_account,
+                book_sale.cashier_account_id as target_account,
+                li.price * li.quantity as amount
+            from unnest(locals.li_prices, locals.li_quantities) with ordinality as li(price, quantity, idx)
+            where book_sale.payment_method = 'cash'
+        ) s
+        group by s.source_account, s.target_account
+    ) b
+    having count(*) > 0;
+
+    if locals.n_used_vouchers > 0 then
+        perform book_transaction(
+            order_id => locals.order_id,
+            description => '',
+            source_account_id => locals.customer_account_id,
+            target_account_id => locals.sale_exit_account_id,
+            amount => 0,
+            vouchers_amount => locals.n_used_vouchers
+        );
+    end if;
+
+    if locals.tag_payment then
+        -- read back the real account values after booking
+        select a.balance, a.vouchers
+        into locals.new_balance, locals.new_voucher_balance
+        from account a
+        where a.id = locals.customer_account_id;
+    end if;
+
+    return json_build_object(
+        'id', locals.order_id,
+        'uuid', book_sale.order_uuid,
+        'booked_at', locals.booked_at,
+        'customer_account_id', locals.customer_account_id,
+        'old_balance', locals.customer_balance,
+        'new_balance', locals.new_balance,
+        'old_voucher_balance', locals.customer_vouchers,
+        'new_voucher_balance', locals.new_voucher_balance,
+        'line_items', (
+            select coalesce(json_agg(json_build_object(
+                'quantity', li.quantity,
+                'product_price', li.price,
+                'tax_rate_id', li.tax_rate_id,
+                'tax_name', li.tax_name,
+                'tax_rate', li.tax_rate,
+                'product', row_to_json(p)
+            ) order by li.idx), json_build_array())
+            from unnest(
+                locals.li_product_ids, locals.li_prices, locals.li_quantities,
+                locals.li_tax_rate_ids, locals.li_tax_names, locals.li_tax_rates
+            ) with ordinality as li(product_id, price, quantity, tax_rate_id, tax_name, tax_rate, idx)
+                join product_with_tax_and_restrictions p on li.product_id = p.id
+        )
+    );
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
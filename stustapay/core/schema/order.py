@@ -292,9 +292,9 @@ class LineItem(PendingLineItem):
     total_tax: float
 
 
-class Order(BaseModel):
+class OrderSummary(BaseModel):
     """
-    represents a completely finished order with all relevant data
+    a completely finished order with its totals, but without the booked line items
     """
 
     id: int
@@ -303,6 +303,7 @@ class Order(BaseModel):
     total_price: float
     total_tax: float
     total_no_tax: float
+    item_count: int
     cancels_order: Optional[int]
 
     booked_at: datetime.datetime
@@ -321,6 +322,12 @@ class Order(BaseModel):
     def customer_tag_uid_hex(self) -> Optional[str]:
         return format_user_tag_uid(self.customer_tag_uid)
 
+
+class Order(OrderSummary):
+    """
+    represents a completely finished order with all relevant data
+    """
+
     line_items: list[LineItem]
 
 
@@ -1,4 +1,5 @@
 import enum
+from datetime import datetime
 from typing import Optional
 
 from pydantic import BaseModel
@@ -36,3 +37,29 @@ class Tse(NewTse):
     public_key: Optional[str]
     certificate: Optional[str]
     process_data_encoding: Optional[str]
+
+
+class TseHistogram(BaseModel):
+    # upper bounds of the buckets in seconds, in ascending order
+    buckets: list[float]
+    # observations per bucket, not cumulative. The last entry counts the observations above the last bound.
+    counts: list[int]
+    count: int
+    sum: float
+
+
+class TseMetrics(BaseModel):
+    tse_id: int
+    tse_name: str
+    updated_at: datetime
+    # from the creation of the signature request until it is claimed by the TSE
+    queue_wait: TseHistogram
+    # round trip of each TSE command, e.g. StartTransaction or FinishTransaction
+    request_round_trip: dict[str, TseHistogram]
+    # from booking the order until its signature is stored
+    end_to_end: TseHistogram
+    signatures_done: int
+    signatures_failed: int
+    # failed and timed out requests per TSE command
+    request_failures: dict[str, int]
+    request_timeouts: dict[str, int]
@@ -11,6 +11,7 @@ from stustapay.core.schema.order import NewFreeTicketGrant
 from stustapay.core.schema.tree import Node
 from stustapay.core.schema.user import Privilege, User, format_user_tag_uid
 from stustapay.core.service.auth import AuthService
+from stustapay.core.service.common.cache import NodeCache
 from stustapay.core.service.common.decorators import (
     requires_node,
     requires_terminal,
@@ -20,6 +21,8 @@ from stustapay.core.service.common.error import InvalidArgument, NotFound
 from stustapay.core.service.customer.common import fetch_customer
 from stustapay.core.service.transaction import book_transaction
 
+_system_account_ids: NodeCache[AccountType, int] = NodeCache("system_account_ids")
+
 
 async def get_system_account_for_node(*, conn: Connection, node: Node, account_type: AccountType) -> Account:
     return await conn.fetch_one(
@@ -30,6 +33,23 @@ async def get_system_account_for_node(*, conn: Connection, node: Node, account_t
     )
 
 
+async def get_system_account_id_for_node(*, conn: Connection, node: Node, account_type: AccountType) -> int:
+    """
+    id of the system account of the given type, cached per event node as system accounts are static
+    """
+    account_id = _system_account_ids.get(node.event_node_id, account_type)
+    if account_id is None:
+        account_id = await conn.fetchval(
+            "select id from account where type = $1 and node_id = any($2)",
+            account_type.value,
+            node.ids_to_event_node,
+        )
+        if account_id is None:
+            raise NotFound(element_type="account")
+        _system_account_ids.set(node.event_node_id, account_type, account_id, version=NodeCache.transaction_version())
+    return account_id
+
+
 async def get_account_by_id(*, conn: Connection, node: Node, account_id: int) -> Optional[Account]:
     return await conn.fetch_maybe_one(
         Account,
@@ -1,4 +1,5 @@
 import uuid
+from functools import wraps
 from typing import Optional
 
 from jose import JWTError, jwt
@@ -11,6 +12,7 @@ from stustapay.core.schema.customer import Customer
 from stustapay.core.schema.terminal import CurrentTerminal, Terminal
 from stustapay.core.schema.till import Till
 from stustapay.core.schema.user import CurrentUser
+from stustapay.core.service.common.cache import TokenCache
 
 
 class UserTokenMetadata(BaseModel):
@@ -28,6 +30,53 @@ class TerminalTokenMetadata(BaseModel):
     session_uuid: uuid.UUID
 
 
+# validated tokens, sessions can only end through the database which triggers an eviction of the affected tokens.
+# customers are always read freshly as their account balance is part of them, only their session is cached.
+# the till of a terminal is also always read freshly, as it can be reassigned at any time.
+_user_tokens: TokenCache[str, CurrentUser] = TokenCache("user_tokens")
+_customer_tokens: TokenCache[str, CustomerTokenMetadata] = TokenCache("customer_tokens")
+_terminal_tokens: TokenCache[str, Terminal] = TokenCache("terminal_tokens")
+# privileges of users at nodes by (user_id, node_id), evicted whenever the roles of a user change
+_user_privileges: TokenCache[tuple[int, int], frozenset[str]] = TokenCache("user_privileges")
+
+
+def records_token_cache_version(func):
+    """
+    records the token cache version for the transaction opened by the decorated service method,
+    see TokenCache.transaction. Within an already running transaction, i.e. if conn is passed,
+    the version recorded at its start is used, if any.
+    """
+
+    @wraps(func)
+    async def wrapper(self, **kwargs):
+        if "conn" in kwargs:
+            return await func(self, **kwargs)
+        with TokenCache.transaction():
+            return await func(self, **kwargs)
+
+    return wrapper
+
+
+async def fetch_user_privileges_at_node(*, conn: Connection, user_id: int, node_id: int) -> frozenset[str]:
+    """
+    the names of all privileges a user has at a node, including the ones inherited from roles at parent nodes
+    """
+    privileges = _user_privileges.get((user_id, node_id))
+    if privileges is None:
+        privileges = frozenset(
+            await conn.fetchval(
+                "select privileges from user_node_privileges where user_id = $1 and node_id = $2",
+                user_id,
+                node_id,
+            )
+            or ()
+        )
+        _user_privileges.set(
+            (user_id, node_id), f"user:{user_id}", privileges, version=TokenCache.transaction_version()
+        )
+    return privileges
+
+
 class AuthService(Service[Config]):
     """
     Extra service to check login tokens
@@ -64,13 +113,19 @@ class AuthService(Service[Config]):
         encoded_jwt = jwt.encode(to_encode, self.config.core.secret_key, algorithm=self.config.core.jwt_token_algorithm)
         return encoded_jwt
 
+    @records_token_cache_version
     @with_db_transaction(read_only=True)
     async def get_user_from_token(self, *, conn: Connection, token: str) -> Optional[CurrentUser]:
+        user = _user_tokens.get(token)
+        if user is not None:
+            # callers fill in the privileges of the user, never hand out the cached instance
+            return user.model_copy(deep=True)
+
         token_payload = self.decode_user_jwt_payload(token)
         if token_payload is None:
             return None
 
-        return await conn.fetch_maybe_one(
+        user = await conn.fetch_maybe_one(
             CurrentUser,
             "select u.*, null as active_role_id, '{}'::text array as privileges "
             "from user_with_tag u join usr_session s on u.id = s.usr "
@@ -78,14 +133,29 @@ class AuthService(Service[Config]):
             token_payload.user_id,
             token_payload.session_id,
         )
+        if user is not None:
+            _user_tokens.set(
+                token, f"user:{user.id}", user.model_copy(deep=True), version=TokenCache.transaction_version()
+            )
+        return user
 
+    @records_token_cache_version
     @with_db_transaction(read_only=True)
     async def get_customer_from_token(self, *, conn: Connection, token: str) -> Optional[Customer]:
+        token_payload = _customer_tokens.get(token)
+        if token_payload is not None:
+            return await conn.fetch_maybe_one(
+                Customer,
+                "select c.*, $2::bigint as session_id from customer c where c.id = $1",
+                token_payload.customer_id,
+                token_payload.session_id,
+            )
+
         token_payload = self.decode_customer_jwt_payload(token)
         if token_payload is None:
             return None
 
-        return await conn.fetch_maybe_one(
+        customer = await conn.fetch_maybe_one(
             Customer,
             "select c.*, s.id as session_id "
             "from customer c join customer_session s on c.id = s.customer "
@@ -93,6 +163,11 @@ class AuthService(Service[Config]):
             token_payload.customer_id,
             token_payload.session_id,
         )
+        if customer is not None:
+            _customer_tokens.set(
+                token, f"customer:{customer.id}", token_payload, version=TokenCache.transaction_version()
+            )
+        return customer
 
     def decode_terminal_jwt_payload(self, token: str) -> Optional[TerminalTokenMetadata]:
         try:
@@ -109,28 +184,32 @@ class AuthService(Service[Config]):
         encoded_jwt = jwt.encode(to_encode, self.config.core.secret_key, algorithm=self.config.core.jwt_token_algorithm)
         return encoded_jwt
 
+    @records_token_cache_version
     @with_db_transaction(read_only=True)
     async def get_terminal_from_token(self, *, conn: Connection, token: str) -> Optional[CurrentTerminal]:
-        token_payload: TerminalTokenMetadata | None = self.decode_terminal_jwt_payload(token)
-        if token_payload is None:
-            return None
-
-        terminal = await conn.fetch_maybe_one(
-            Terminal,
-            "select t.*, till.id as till_id "
-            "from terminal t "
-            "left join till on t.id = till.terminal_id "
-            "where t.id = $1 and session_uuid = $2",
-            token_payload.terminal_id,
-            token_payload.session_uuid,
-        )
+        terminal = _terminal_tokens.get(token)
         if terminal is None:
-            return None
+            token_payload: TerminalTokenMetadata | None = self.decode_terminal_jwt_payload(token)
+            if token_payload is None:
+                return None
+
+            terminal = await conn.fetch_maybe_one(
+                Terminal,
+                "select t.*, till.id as till_id "
+                "from terminal t "
+                "left join till on t.id = till.terminal_id "
+                "where t.id = $1 and session_uuid = $2",
+                token_payload.terminal_id,
+                token_payload.session_uuid,
+            )
+            if terminal is None:
+                return None
+            _terminal_tokens.set(token, f"terminal:{terminal.id}", terminal, version=TokenCache.transaction_version())
 
         till = await conn.fetch_maybe_one(
             Till,
             "select * from till where terminal_id = $1",
-            token_payload.terminal_id,
+            terminal.id,
         )
 
         return CurrentTerminal(
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import chain
+from typing import Generic, Hashable, Optional, TypeVar
+
+import asyncpg
+from sftkit.database import DatabaseHook
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+logger = logging.getLogger(__name__)
+
+# pg_notify channel which fires whenever system accounts, products, till layouts, terminals or nodes change
+NODE_CONSTANTS_CHANNEL = "node_constants"
+# pg_notify channel which fires whenever user, customer or terminal sessions end or logged in users or their
+# privileges change, the payload is '<user|customer|terminal>:<id>'
+AUTH_SESSION_CHANNEL = "auth_session"
+
+# NodeCache.version and TokenCache.version at the start of the current database transaction,
+# see NodeCache.transaction and TokenCache.transaction
+_transaction_version: ContextVar[Optional[int]] = ContextVar("node_cache_transaction_version", default=None)
+_token_transaction_version: ContextVar[Optional[int]] = ContextVar("token_cache_transaction_version", default=None)
+
+
+@contextmanager
+def _record_transaction_version(transaction_version: ContextVar[Optional[int]], version: int):
+    """set the transaction version unless an outer transaction already did"""
+    if transaction_version.get() is not None:
+        yield
+        return
+    token = transaction_version.set(version)
+    try:
+        yield
+    finally:
+        transaction_version.reset(token)
+
+
+class NodeCache(Generic[K, V]):
+    """
+    In-process cache for rarely changing data, keyed by the event node id and a key.
+
+    Entries can only go stale if a change notification is missed, so the cache is only active
+    while run_node_cache_invalidation listens for changes. Otherwise all lookups are misses
+    and storing values does nothing.
+    If a ttl in seconds is given, entries additionally expire after this time, for data which is partially
+    derived from tables not covered by change notifications.
+    """
+
+    _caches: list["NodeCache"] = []
+    _active = False
+    # incremented on every invalidation, allows to detect values built from outdated data
+    version = 0
+
+    def __init__(self, name: str, ttl: Optional[float] = None):
+        self.name = name
+        self.ttl = ttl
+        self._entries: dict[tuple[Optional[int], K], tuple[V, Optional[float]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.build_seconds = 0.0
+        NodeCache._caches.append(self)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def record_build(self, duration: float):
+        self.builds += 1
+        self.build_seconds += duration
+
+    def get(self, event_node_id: Optional[int], key: K) -> Optional[V]:
+        if not NodeCache._active:
+            return None
+        entry = self._entries.get((event_node_id, key))
+        if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+            del self._entries[(event_node_id, key)]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, event_node_id: Optional[int], key: K, value: V, version: Optional[int]):
+        """
+        store a value which was read in a transaction started at the given version, see NodeCache.transaction.
+        It is only stored if no invalidation happened since, values read at an unknown version are not stored.
+        """
+        if not NodeCache._active or version is None or version != NodeCache.version:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[(event_node_id, key)] = (value, expires_at)
+
+    def clear(self):
+        self._entries.clear()
+
+    @classmethod
+    def clear_all(cls):
+        cls.version += 1
+        for cache in cls._caches:
+            cache.clear()
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, float]]:
+        return {
+            cache.name: {
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "hit_rate": cache.hit_rate,
+                "builds": cache.builds,
+                "build_seconds": cache.build_seconds,
+            }
+            for cache in cls._caches
+        }
+
+    @classmethod
+    def is_active(cls) -> bool:
+        return cls._active
+
+    @classmethod
+    def set_active(cls, active: bool):
+        cls.clear_all()
+        cls._active = active
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        """
+        Record the cache version for a database transaction, has to be entered before its first statement.
+        Repeatable read and serializable transactions see the data of their snapshot even if an invalidation
+        arrives later on, so values read in them must only be cached under the version the snapshot was taken at.
+        Nested uses keep the version of the outermost one.
+        """
+        with _record_transaction_version(_transaction_version, NodeCache.version):
+            yield
+
+    @staticmethod
+    def transaction_version() -> Optional[int]:
+        """the cache version at the start of the current transaction, None if it is unknown"""
+        return _transaction_version.get()
+
+
+async def _handle_node_constants_changed(payload: Optional[str]):
+    # payload is None on (re)connects of the listener, we might have missed changes in this case as well
+    logger.debug(f"node constants changed: {payload}, clearing caches")
+    NodeCache.set_active(True)
+
+
+async def run_node_cache_invalidation(db_pool: asyncpg.Pool):
+    """
+    listen for changes of system accounts and constant products and invalidate all node caches.
+    node caches are only in use while this is running.
+    """
+    db_hook = DatabaseHook(db_pool, NODE_CONSTANTS_CHANNEL, _handle_node_constants_changed, initial_run=True)
+    try:
+        await db_hook.run()
+    finally:
+        NodeCache.set_active(False)
+
+
+class TokenCache(Generic[K, V]):
+    """
+    Bounded LRU cache for authentication data, i.e. validated login tokens and user privileges.
+
+    Each entry belongs to a subject such as 'user:42', all entries of a subject are evicted when a change
+    notification for it arrives, i.e. on logouts, deleted sessions or role changes.
+    As with NodeCache, the cache is only active while run_token_cache_invalidation listens for changes.
+    Entries additionally expire after a short ttl to bound the effect of missed notifications.
+    """
+
+    _caches: list["TokenCache"] = []
+    _active = False
+    # incremented on every eviction, allows to detect values validated before a session ended
+    version = 0
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: float = 30):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[K, tuple[str, V, float]] = OrderedDict()
+        self._keys_by_subject: dict[str, set[K]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        TokenCache._caches.append(self)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: K):
+        subject, _, _ = self._entries.pop(key)
+        keys = self._keys_by_subject[subject]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self._keys_by_subject[subject]
+
+    def get(self, key: K) -> Optional[V]:
+        if not TokenCache._active:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: K, subject: str, value: V, version: Optional[int]):
+        """
+        store a value of a subject which was read in a transaction started at the given version,
+        see TokenCache.transaction. It is only stored if no subject was evicted since,
+        values read at an unknown version are not stored.
+        """
+        if not TokenCache._active or version is None or version != TokenCache.version:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (subject, value, time.monotonic() + self.ttl)
+        self._keys_by_subject.setdefault(subject, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def evict_subject(self, subject: str):
+        for key in list(self._keys_by_subject.get(subject, ())):
+            self._remove(key)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_subject.clear()
+
+    @classmethod
+    def evict_all(cls, subject: str):
+        cls.version += 1
+        for cache in cls._caches:
+            cache.evict_subject(subject)
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, float]]:
+        return {
+            cache.name: {
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "hit_rate": cache.hit_rate,
+                "evictions": cache.evictions,
+                "size": len(cache),
+            }
+            for cache in cls._caches
+        }
+
+    @classmethod
+    def is_active(cls) -> bool:
+        return cls._active
+
+    @classmethod
+    def set_active(cls, active: bool):
+        cls.version += 1
+        for cache in cls._caches:
+            cache.clear()
+        cls._active = active
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        """
+        Record the cache version for a database transaction, has to be entered before its first statement.
+        Same as NodeCache.transaction, a session or privilege read from an older snapshot must not be cached
+        under the version of an eviction which arrived in the meantime.
+        """
+        with _record_transaction_version(_token_transaction_version, TokenCache.version):
+            yield
+
+    @staticmethod
+    def transaction_version() -> Optional[int]:
+        """the cache version at the start of the current transaction, None if it is unknown"""
+        return _token_transaction_version.get()
+
+
+async def _handle_auth_session_changed(payload: Optional[str]):
+    if payload is None:
+        # (re)connect of the listener, sessions might have ended in the meantime
+        TokenCache.set_active(True)
+        return
+    logger.debug(f"auth session changed: {payload}, evicting tokens")
+    TokenCache.evict_all(payload)
+
+
+async def run_token_cache_invalidation(db_pool: asyncpg.Pool):
+    """
+    listen for ended sessions and changed users and evict their validated tokens and privileges.
+    token caches are only in use while this is running.
+    """
+    db_hook = DatabaseHook(db_pool, AUTH_SESSION_CHANNEL, _handle_auth_session_changed, initial_run=True)
+    try:
+        await db_hook.run()
+    finally:
+        TokenCache.set_active(False)
+
+
+async def run_cache_stats_logging(interval: float = 300):
+    """
+    periodically log hit rates of all in-process caches, to judge how much database load they remove
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for name, stats in chain(NodeCache.stats().items(), TokenCache.stats().items()):
+            logger.info(f"cache {name}: {', '.join(f'{key}={value:g}' for key, value in stats.items())}")
@@ -1,7 +1,7 @@
+from dataclasses import dataclass
 from functools import wraps
 from inspect import Parameter, signature
-from itertools import chain
-from typing import Awaitable, Callable, Optional, TypeVar
+from typing import Awaitable, Callable, Mapping, Optional, TypeVar
 
 from sftkit.database import Connection
 
@@ -9,6 +9,8 @@ from stustapay.core.schema.terminal import CurrentTerminal
 from stustapay.core.schema.till import Till
 from stustapay.core.schema.tree import Node, ObjectType
 from stustapay.core.schema.user import CurrentUser, Privilege
+from stustapay.core.service.auth import fetch_user_privileges_at_node
+from stustapay.core.service.common.cache import NodeCache, TokenCache
 from stustapay.core.service.common.error import (
     AccessDenied,
     EventRequired,
@@ -25,9 +27,9 @@ R = TypeVar("R")
 _READONLY_KWARG_NAME = "__read_only__"
 
 
-def _is_func_read_only(kwargs, func):
+def _is_func_read_only(kwargs, func_params: Mapping[str, Parameter]):
     is_readonly = kwargs.get(_READONLY_KWARG_NAME, False)
-    if _READONLY_KWARG_NAME not in signature(func).parameters:
+    if _READONLY_KWARG_NAME not in func_params:
         kwargs.pop(_READONLY_KWARG_NAME)
 
     return is_readonly
@@ -45,6 +47,20 @@ def _add_arg_to_signature(original_func, new_func, name: str):
     new_func.__signature__ = sig  # type: ignore
 
 
+def _records_cache_versions(wrapper):
+    """
+    the decorators below run the first statements of a service transaction, so they record the node and token
+    cache versions before any of them for values cached within the transaction
+    """
+
+    @wraps(wrapper)
+    async def f(self, **kwargs):
+        with NodeCache.transaction(), TokenCache.transaction():
+            return await wrapper(self, **kwargs)
+
+    return f
+
+
 def requires_node(
     object_types: list[ObjectType] | None = None, event_only: bool = False
 ) -> Callable[[Callable[..., Awaitable[R]]], Callable[..., Awaitable[R]]]:
@@ -53,6 +69,10 @@ def requires_node(
     """
 
     def f(func: Callable[..., Awaitable[R]]):
+        # the signature is inspected once here, not on every call
+        func_params = signature(func).parameters
+        func_takes_node = "node" in func_params
+
         @wraps(func)
         async def wrapper(self, **kwargs):
             # TODO: Tree node sanity checks for this logic
@@ -73,7 +93,7 @@ def requires_node(
                 if node is None:
                     raise RuntimeError(f"Node with id {node_id} does not exist")
 
-            func_is_read_only = _is_func_read_only(kwargs, func)
+            func_is_read_only = _is_func_read_only(kwargs, func_params)
             if not func_is_read_only and node.read_only:
                 raise NodeIsReadOnly(f"{node.name} is read only")
 
@@ -86,14 +106,14 @@ def requires_node(
             if event_only and node.event_node_id is None:
                 raise EventRequired("This operation is only allowed for nodes within events")
 
-            if "node" in signature(func).parameters:
+            if func_takes_node:
                 kwargs["node"] = node
 
             return await func(self, **kwargs)
 
         _add_arg_to_signature(func, wrapper, _READONLY_KWARG_NAME)
 
-        return wrapper
+        return _records_cache_versions(wrapper)
 
     return f
 
@@ -140,14 +160,7 @@ def requires_user(
                 node: Node | None = kwargs.get("node")
                 if node is None:
                     raise RuntimeError("requires_user needs requires_node to be placed before it")
-                role_privileges = await conn.fetch(
-                    "select privileges "
-                    "from user_to_role utr join user_role_with_privileges urwp on utr.role_id = urwp.id "
-                    "where utr.node_id = any($1) and urwp.node_id = any($1) and utr.user_id = $2",
-                    node.ids_to_root,
-                    user.id,
-                )
-                user_privileges = set(chain.from_iterable(row["privileges"] for row in role_privileges))
+                user_privileges = await fetch_user_privileges_at_node(conn=conn, user_id=user.id, node_id=node.id)
                 user.privileges = list(user_privileges)
 
                 if privileges:
@@ -177,7 +190,7 @@ def requires_user(
         if node_required and "node" not in original_signature.parameters:
             _add_arg_to_signature(func, wrapper, "node")
 
-        return wrapper
+        return _records_cache_versions(wrapper)
 
     return f
 
@@ -189,6 +202,8 @@ def requires_customer(func: Callable[..., Awaitable[R]]) -> Callable[..., Awaita
     Sets the arguments current_customer in the wrapped function
     """
 
+    func_params = signature(func).parameters
+
     @wraps(func)
     async def wrapper(self, **kwargs):
         if "token" not in kwargs and "current_customer" not in kwargs:
@@ -217,26 +232,56 @@ def requires_customer(func: Callable[..., Awaitable[R]]) -> Callable[..., Awaita
         node_is_readonly = await conn.fetchval(
             "select read_only from node n join account a on a.node_id = n.id where a.id = $1", customer.id
         )
-        func_is_read_only = _is_func_read_only(kwargs, func)
+        func_is_read_only = _is_func_read_only(kwargs, func_params)
         if not func_is_read_only and node_is_readonly:
             raise NodeIsReadOnly("Event is read only")
 
-        if "current_customer" in signature(func).parameters:
+        if "current_customer" in func_params:
             kwargs["current_customer"] = customer
         elif "current_customer" in kwargs:
             kwargs.pop("current_customer")
 
-        if "token" not in signature(func).parameters and "token" in kwargs:
+        if "token" not in func_params and "token" in kwargs:
             kwargs.pop("token")
 
-        if "conn" not in signature(func).parameters:
+        if "conn" not in func_params:
             kwargs.pop("conn")
 
         return await func(self, **kwargs)
 
     _add_arg_to_signature(func, wrapper, _READONLY_KWARG_NAME)
 
-    return wrapper
+    return _records_cache_versions(wrapper)
+
+
+@dataclass
+class TillNodes:
+    node: Node
+    event_node: Node
+
+
+# tree nodes of tills, keyed by the till node id. Invalidated on node or event changes.
+# the till itself is always read freshly as logins, logouts and cash register assignments
+# need to be visible immediately, even within the same transaction
+_till_nodes: NodeCache[int, TillNodes] = NodeCache("till_nodes", ttl=60)
+_terminal_node_read_only: NodeCache[int, bool] = NodeCache("terminal_node_read_only", ttl=60)
+
+
+async def _fetch_till_nodes(*, conn: Connection, till: Till) -> TillNodes:
+    till_nodes = _till_nodes.get(None, till.node_id)
+    if till_nodes is not None:
+        return till_nodes
+
+    node = await fetch_node(conn=conn, node_id=till.node_id)
+    assert node is not None
+    if node.event_node_id is None:
+        raise InvalidArgument("Tills should not be able to be created outside of events")
+    event_node = await fetch_node(conn=conn, node_id=node.event_node_id)
+    assert event_node is not None
+
+    till_nodes = TillNodes(node=node, event_node=event_node)
+    _till_nodes.set(None, till.node_id, till_nodes, version=NodeCache.transaction_version())
+    return till_nodes
 
 
 def requires_terminal(
@@ -251,6 +296,8 @@ def requires_terminal(
     """
 
     def f(func: Callable[..., Awaitable[R]]):
+        signature_params = signature(func).parameters
+
         @wraps(func)
         async def wrapper(self, **kwargs):
             if "token" not in kwargs and "current_terminal" not in kwargs:
@@ -276,25 +323,18 @@ def requires_terminal(
             if terminal is None:
                 raise Unauthorized("invalid terminal token")
 
-            till = await conn.fetch_maybe_one(
-                Till,
-                "select * from till_with_cash_register where terminal_id = $1",
-                terminal.id,
-            )
-            if till is None and requires_till:
-                raise Unauthorized("Terminal does not have an assigned till but one is required")
-
-            signature_params = signature(func).parameters
-            func_is_read_only = _is_func_read_only(kwargs, func)
+            func_is_read_only = _is_func_read_only(kwargs, signature_params)
 
             if requires_till:
-                assert till is not None
-                node = await fetch_node(conn=conn, node_id=till.node_id)
-                assert node is not None
-                if node.event_node_id is None:
-                    raise InvalidArgument("Tills should not be able to be created outside of events")
-                event_node = await fetch_node(conn=conn, node_id=node.event_node_id)
-                assert event_node is not None
+                till = await conn.fetch_maybe_one(
+                    Till,
+                    "select * from till_with_cash_register where terminal_id = $1",
+                    terminal.id,
+                )
+                if till is None:
+                    raise Unauthorized("Terminal does not have an assigned till but one is required")
+                till_nodes = await _fetch_till_nodes(conn=conn, till=till)
+                node, event_node = till_nodes.node, till_nodes.event_node
 
                 logged_in_user = await conn.fetch_maybe_one(
                     CurrentUser,
@@ -343,9 +383,14 @@ def requires_terminal(
                     kwargs["current_till"] = till
 
             else:  # requires_till == False
-                node_is_readonly = await conn.fetchval(
-                    "select read_only from node n join terminal t on t.node_id = n.id where t.id = $1", terminal.id
-                )
+                node_is_readonly = _terminal_node_read_only.get(None, terminal.id)
+                if node_is_readonly is None:
+                    node_is_readonly = await conn.fetchval(
+                        "select read_only from node n join terminal t on t.node_id = n.id where t.id = $1", terminal.id
+                    )
+                    _terminal_node_read_only.set(
+                        None, terminal.id, node_is_readonly, version=NodeCache.transaction_version()
+                    )
                 if not func_is_read_only and node_is_readonly:
                     raise NodeIsReadOnly("Node is read only")
 
@@ -364,6 +409,6 @@ def requires_terminal(
 
         _add_arg_to_signature(func, wrapper, _READONLY_KWARG_NAME)
 
-        return wrapper
+        return _records_cache_versions(wrapper)
 
     return f
@@ -131,13 +131,25 @@ class CustomerService(Service[Config]):
 
     @with_db_transaction(read_only=True)
     @requires_customer
-    async def get_orders_with_bon(self, *, conn: Connection, current_customer: Customer) -> list[OrderWithBon]:
+    async def get_orders_with_bon(
+        self,
+        *,
+        conn: Connection,
+        current_customer: Customer,
+        before_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> list[OrderWithBon]:
         return await conn.fetch_many(
             OrderWithBon,
-            "select o.*, case when b.bon_json is null then false else true end as bon_generated from order_value_prefiltered("
-            "   (select array_agg(o.id) from ordr o where customer_account_id = $1)"
-            ") o left join bon b ON o.id = b.id order by o.booked_at desc",
+            "select o.*, case when b.bon_json is null then false else true end as bon_generated from order_value_prefiltered(("
+            "   select array_agg(p.id) from ("
+            "       select o.id from ordr o where o.customer_account_id = $1 and ($2::bigint is null or o.id < $2) "
+            "       order by o.id desc limit $3"
+            "   ) p"
+            ")) o left join bon b ON o.id = b.id order by o.id desc",
             current_customer.id,
+            before_id,
+            limit,
         )
 
     @with_db_transaction(read_only=True)
@@ -10,7 +10,7 @@ from stustapay.core.schema.order import OrderType, PaymentMethod
 from stustapay.core.schema.tree import Node
 from stustapay.core.service.common.error import InvalidArgument
 from stustapay.core.service.product import fetch_money_transfer_product
-from stustapay.core.service.transaction import book_transaction
+from stustapay.core.service.transaction import NewTransaction, book_transactions
 
 
 @dataclass(eq=True, frozen=True)
@@ -23,15 +23,20 @@ async def book_prepared_bookings(*, conn: Connection, order_id: int, bookings: d
     """
     insert the selected bookings into the database.
     bookings are (source, target, tax) -> amount
+    all bookings are inserted with a single statement, independent of the number of bookings.
     """
-    for booking_identifier, amount in bookings.items():
-        await book_transaction(
-            conn=conn,
-            order_id=order_id,
-            source_account_id=booking_identifier.source_account_id,
-            target_account_id=booking_identifier.target_account_id,
-            amount=amount,
-        )
+    await book_transactions(
+        conn=conn,
+        order_id=order_id,
+        transactions=[
+            NewTransaction(
+                source_account_id=booking_identifier.source_account_id,
+                target_account_id=booking_identifier.target_account_id,
+                amount=amount,
+            )
+            for booking_identifier, amount in bookings.items()
+        ],
+    )
 
 
 class NewLineItem(BaseModel):
@@ -117,18 +122,21 @@ async def book_order(
     order_id = order_row["id"]
     booked_at = order_row["booked_at"]
 
-    for i, line_item in enumerate(line_items):
-        await conn.fetchval(
+    if len(line_items) > 0:
+        # insert all line items at once, item ids are the zero based position in the given line item list
+        await conn.execute(
             "insert into line_item (order_id, item_id, product_id, product_price, quantity, tax_rate_id, "
             "   tax_name, tax_rate) "
-            "select $1, $2, $3, $4, $5, $6, t.name, t.rate "
-            "from tax_rate t where t.id = $6",
+            "select $1, li.item_id - 1, li.product_id, li.product_price, li.quantity, li.tax_rate_id, t.name, t.rate "
+            "from unnest($2::bigint array, $3::numeric array, $4::bigint array, $5::bigint array) "
+            "   with ordinality as li(product_id, product_price, quantity, tax_rate_id, item_id) "
+            "   join tax_rate t on t.id = li.tax_rate_id "
+            "order by li.item_id",
             order_id,
-            i,
-            line_item.product_id,
-            line_item.product_price,
-            line_item.quantity,
-            line_item.tax_rate_id,
+            [line_item.product_id for line_item in line_items],
+            [line_item.product_price for line_item in line_items],
+            [line_item.quantity for line_item in line_items],
+            [line_item.tax_rate_id for line_item in line_items],
         )
     await book_prepared_bookings(conn=conn, order_id=order_id, bookings=bookings)
     return OrderInfo(id=order_id, uuid=uuid, booked_at=booked_at)
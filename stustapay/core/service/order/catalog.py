@@ -0,0 +1,71 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sftkit.database import Connection
+
+from stustapay.core.schema.product import Product
+from stustapay.core.schema.tree import Node
+from stustapay.core.service.common.cache import NodeCache
+
+
+@dataclass
+class TillProfileCatalog:
+    """
+    all buttons a till profile can book, with the products booked by each button
+    """
+
+    till_profile_id: int
+    # node cache version of the transaction the catalog was read in, None if unknown
+    version: Optional[int]
+    button_products: dict[int, list[Product]]
+
+
+_catalogs: NodeCache[int, TillProfileCatalog] = NodeCache("till_profile_catalogs")
+_products: NodeCache[int, Product] = NodeCache("products")
+
+
+async def _build_till_profile_catalog(*, conn: Connection, till_profile_id: int) -> TillProfileCatalog:
+    version = NodeCache.transaction_version()
+    start = time.monotonic()
+    rows = await conn.fetch(
+        "select tltb.button_id, json_agg(p order by p.id) as products "
+        "from till_profile tp "
+        "join till_layout_to_button tltb on tltb.layout_id = tp.layout_id "
+        "join till_button_product tbp on tbp.button_id = tltb.button_id "
+        "join product_with_tax_and_restrictions p on tbp.product_id = p.id "
+        "where tp.id = $1 "
+        "group by tltb.button_id",
+        till_profile_id,
+    )
+    catalog = TillProfileCatalog(
+        till_profile_id=till_profile_id,
+        version=version,
+        button_products={
+            row["button_id"]: [Product.model_validate(product) for product in row["products"]] for row in rows
+        },
+    )
+    _catalogs.record_build(time.monotonic() - start)
+    return catalog
+
+
+async def fetch_till_profile_catalog(*, conn: Connection, node: Node, till_profile_id: int) -> TillProfileCatalog:
+    """
+    the button catalog of a till profile, rebuilt lazily after any layout, button or product change
+    """
+    catalog = _catalogs.get(node.event_node_id, till_profile_id)
+    if catalog is None:
+        catalog = await _build_till_profile_catalog(conn=conn, till_profile_id=till_profile_id)
+        _catalogs.set(node.event_node_id, till_profile_id, catalog, version=catalog.version)
+    return catalog
+
+
+async def fetch_catalog_product(*, conn: Connection, node: Node, product_id: int) -> Optional[Product]:
+    product = _products.get(node.event_node_id, product_id)
+    if product is None:
+        product = await conn.fetch_maybe_one(
+            Product, "select p.* from product_with_tax_and_restrictions p where p.id = $1", product_id
+        )
+        if product is not None:
+            _products.set(node.event_node_id, product_id, product, version=NodeCache.transaction_version())
+    return product
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import json
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+import asyncpg
+from pydantic import BaseModel
+from sftkit.database import DatabaseHook
+
+from stustapay.core.schema.tree import Node
+
+logger = logging.getLogger(__name__)
+
+
+class LiveStatsEntry(BaseModel):
+    node_id: int
+    hour: datetime
+    product_id: int
+    product_name: str
+    order_type: str
+    payment_method: str
+    count: int
+    revenue: float
+
+
+class LiveStatsUpdate(BaseModel):
+    """
+    line items booked since the last update, grouped like the hourly stats.
+    If resync is set, updates were dropped as the subscriber did not keep up and the full stats need to be refetched.
+    """
+
+    resync: bool = False
+    entries: list[LiveStatsEntry] = []
+
+
+class LiveStatsSubscription:
+    def __init__(self, node: Node, queue_size: int):
+        self.node_id = node.id
+        self.updates: asyncio.Queue[LiveStatsUpdate] = asyncio.Queue(maxsize=queue_size)
+
+    def publish(self, entries: list[tuple[LiveStatsEntry, list[int]]]):
+        """
+        queue all entries booked at or below the subscribed node, entries are paired with the parent ids of their node
+        """
+        own_entries = [entry for entry, parent_ids in entries if self.node_id in parent_ids]
+        if len(own_entries) == 0:
+            return
+        try:
+            self.updates.put_nowait(LiveStatsUpdate(entries=own_entries))
+        except asyncio.QueueFull:
+            # never block the broadcast for a slow subscriber, it has to refetch the full stats instead
+            self.resync()
+
+    def resync(self):
+        """
+        drop all queued updates and tell the subscriber to refetch the full stats
+        """
+        while not self.updates.empty():
+            self.updates.get_nowait()
+        self.updates.put_nowait(LiveStatsUpdate(resync=True))
+
+
+class LiveStatsBroadcaster:
+    """
+    Pushes newly booked line items to all subscribed stats dashboards of this process.
+
+    A single listener on the 'order' notification channel collects new orders, which are loaded in batches
+    every batch_interval seconds, but only while someone is subscribed.
+    """
+
+    def __init__(self, db_pool: asyncpg.Pool, batch_interval: float = 0.5, queue_size: int = 100):
+        self.db_pool = db_pool
+        self.batch_interval = batch_interval
+        self.queue_size = queue_size
+        self.subscriptions: set[LiveStatsSubscription] = set()
+        self.is_listening = False
+        self._new_order_ids: set[int] = set()
+
+    @contextlib.contextmanager
+    def subscribe(self, node: Node):
+        subscription = LiveStatsSubscription(node=node, queue_size=self.queue_size)
+        self.subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self.subscriptions.discard(subscription)
+
+    async def stream(self, node: Node, keepalive_interval: float = 15) -> AsyncIterator[str]:
+        """
+        server-sent events with all updates for the given node
+        """
+        with self.subscribe(node) as subscription:
+            while True:
+                try:
+                    update = await asyncio.wait_for(subscription.updates.get(), timeout=keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                event = "resync" if update.resync else "update"
+                yield f"event: {event}\ndata: {update.model_dump_json()}\n\n"
+
+    def _resync_subscriptions(self):
+        for subscription in list(self.subscriptions):
+            subscription.resync()
+
+    async def _handle_new_order(self, payload: Optional[str]):
+        if payload is None:
+            # (re)connect of the listener, orders booked in the meantime were missed
+            self.is_listening = True
+            self._new_order_ids.clear()
+            self._resync_subscriptions()
+            return
+        if len(self.subscriptions) == 0:
+            return
+        self._new_order_ids.add(json.loads(payload)["order_id"])
+
+    async def _fetch_entries(self, order_ids: list[int]) -> list[tuple[LiveStatsEntry, list[int]]]:
+        rows = await self.db_pool.fetch(
+            "select "
+            "   li.node_id, n.parent_ids, li.hour, li.product_id, p.name as product_name, li.order_type, "
+            "   li.payment_method, sum(li.quantity) as count, sum(li.total_price) as revenue "
+            "from order_stats_line_items li "
+            "join node n on li.node_id = n.id "
+            "join product p on li.product_id = p.id "
+            "where li.order_id = any($1) "
+            "group by li.node_id, n.parent_ids, li.hour, li.product_id, p.name, li.order_type, li.payment_method",
+            order_ids,
+        )
+        entries = []
+        for row in rows:
+            entry = LiveStatsEntry.model_validate(dict(row))
+            entries.append((entry, [*row["parent_ids"], row["node_id"]]))
+        return entries
+
+    async def _broadcast(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            if len(self._new_order_ids) == 0:
+                continue
+            order_ids = list(self._new_order_ids)
+            self._new_order_ids.clear()
+            try:
+                entries = await self._fetch_entries(order_ids)
+            except asyncpg.PostgresError:
+                logger.exception("failed to load live stats")
+                self._resync_subscriptions()
+                continue
+            for subscription in list(self.subscriptions):
+                subscription.publish(entries)
+
+    async def run(self):
+        db_hook = DatabaseHook(self.db_pool, "order", self._handle_new_order, initial_run=True)
+        broadcast_task = asyncio.create_task(self._broadcast())
+        try:
+            await db_hook.run()
+        finally:
+            self.is_listening = False
+            broadcast_task.cancel()
+            await asyncio.gather(broadcast_task, return_exceptions=True)
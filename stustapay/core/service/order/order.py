@@ -1,6 +1,7 @@
+import json
 import logging
 from collections import defaultdict
-from typing import Dict, Optional, Set
+from typing import AsyncIterator, Dict, Optional, Set
 from uuid import UUID
 
 import asyncpg
@@ -30,6 +31,7 @@ from stustapay.core.schema.order import (
     NewTicketScan,
     NewTopUp,
     Order,
+    OrderSummary,
     OrderType,
     PaymentMethod,
     PendingLineItem,
@@ -50,7 +52,7 @@ from stustapay.core.schema.tree import Node, RestrictedEventSettings
 from stustapay.core.schema.user import CurrentUser, Privilege, User, format_user_tag_uid
 from stustapay.core.service.account import (
     get_account_by_id,
-    get_system_account_for_node,
+    get_system_account_id_for_node,
 )
 from stustapay.core.service.auth import AuthService
 from stustapay.core.service.common.decorators import (
@@ -70,6 +72,7 @@ from stustapay.core.service.transaction import book_transaction
 from stustapay.core.service.tree.common import fetch_restricted_event_settings_for_node
 
 from .booking import BookingIdentifier, NewLineItem, book_order
+from .catalog import fetch_catalog_product, fetch_till_profile_catalog
 from .stats import OrderStatsService
 from .voucher import VoucherService
 
@@ -175,6 +178,30 @@ class AlreadyProcessedException(ServiceException):
         return self.msg
 
 
+def _sale_booking_error(error: asyncpg.exceptions.RaiseError) -> Exception:
+    """
+    translate an error raised by the book_sale database function to the matching service exception
+    """
+    args = json.loads(error.hint) if error.hint else {}
+    if error.detail == InvalidArgument.id:
+        return InvalidArgument(error.message)
+    if error.detail == AlreadyProcessedException.id:
+        return AlreadyProcessedException(error.message)
+    if error.detail == InvalidSaleException.id:
+        return InvalidSaleException(error.message)
+    if error.detail == CustomerNotFound.id:
+        return CustomerNotFound(uid=args["uid"])
+    if error.detail == AgeRestrictionException.id:
+        return AgeRestrictionException(product_names=set(args["product_names"]))
+    if error.detail == NotEnoughVouchersException.id:
+        return NotEnoughVouchersException(
+            used_vouchers=args["used_vouchers"], available_vouchers=args["available_vouchers"]
+        )
+    if error.detail == NotEnoughFundsException.id:
+        return NotEnoughFundsException(needed_fund=args["needed_fund"], available_fund=args["available_fund"])
+    return error
+
+
 class BookedButton(BaseModel):
     id: int
     quantity: Optional[int] = None
@@ -213,6 +240,36 @@ async def fetch_order(*, conn: Connection, order_id: int) -> Optional[Order]:
     return await conn.fetch_maybe_one(Order, "select * from order_value where id = $1", order_id)
 
 
+async def fetch_order_summary(*, conn: Connection, order_id: int) -> Optional[OrderSummary]:
+    """
+    get the totals of an order without its line items.
+    """
+    return await conn.fetch_maybe_one(OrderSummary, "select * from order_summary where id = $1", order_id)
+
+
+async def fetch_order_page(
+    *, conn: Connection, condition: str, args: tuple, before_id: Optional[int], limit: Optional[int]
+) -> list[Order]:
+    """
+    get the orders matching the condition on ordr o, newest first.
+    pages are continued by passing the smallest order id of the previous page as before_id.
+    """
+    before_param, limit_param = len(args) + 1, len(args) + 2
+    return await conn.fetch_many(
+        Order,
+        "select * from order_value_prefiltered(("
+        "   select array_agg(p.id) from ("
+        f"      select o.id from ordr o where {condition} "
+        f"      and (${before_param}::bigint is null or o.id < ${before_param}) "
+        f"      order by o.id desc limit ${limit_param}"
+        "   ) p"
+        ")) order by id desc",
+        *args,
+        before_id,
+        limit,
+    )
+
+
 class OrderService(Service[Config]):
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
@@ -224,27 +281,20 @@ class OrderService(Service[Config]):
     async def _get_products_from_buttons(
         *,
         conn: Connection,
+        node: Node,
         till_profile_id: int,
         buttons: list[BookedButton],
     ) -> list[BookedProduct]:
-        # TODO: check if the till making this sale has these buttons as part of its layout
+        catalog = await fetch_till_profile_catalog(conn=conn, node=node, till_profile_id=till_profile_id)
         booked_products = []
         for button in buttons:
+            products: list[Product] = []
             if not button.is_product:
-                products = await conn.fetch_many(
-                    Product,
-                    "select p.* from till_button_product tbp "
-                    "join product_with_tax_and_restrictions p on tbp.product_id = p.id "
-                    "join till_layout_to_button tltp on tltp.button_id = tbp.button_id "
-                    "join till_profile tp on tp.layout_id = tltp.layout_id "
-                    "where tbp.button_id = $1 and tp.id = $2",
-                    button.id,
-                    till_profile_id,
-                )
+                products = catalog.button_products.get(button.id, [])
             else:
-                products = await conn.fetch_many(
-                    Product, "select p.* from product_with_tax_and_restrictions p where p.id = $1", button.id
-                )
+                product = await fetch_catalog_product(conn=conn, node=node, product_id=button.id)
+                if product is not None:
+                    products = [product]
             if len(products) == 0:
                 raise InvalidArgument("this till profile is not allowed to use these buttons")
 
@@ -421,27 +471,31 @@ class OrderService(Service[Config]):
             )
         ]
 
-        cash_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.cash_entry)
-        cash_topup_acc = await get_system_account_for_node(
+        cash_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.cash_entry
+        )
+        cash_topup_acc_id = await get_system_account_id_for_node(
             conn=conn, node=node, account_type=AccountType.cash_topup_source
         )
-        sumup_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.sumup_entry)
+        sumup_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.sumup_entry
+        )
 
         if pending_top_up.payment_method == PaymentMethod.cash:
             bookings = {
                 BookingIdentifier(
-                    source_account_id=cash_topup_acc.id,
+                    source_account_id=cash_topup_acc_id,
                     target_account_id=pending_top_up.customer_account_id,
                 ): pending_top_up.amount,
                 BookingIdentifier(
-                    source_account_id=cash_entry_acc.id,
+                    source_account_id=cash_entry_acc_id,
                     target_account_id=current_user.cashier_account_id,
                 ): pending_top_up.amount,
             }
         elif pending_top_up.payment_method == PaymentMethod.sumup:
             bookings = {
                 BookingIdentifier(
-                    source_account_id=sumup_entry_acc.id,
+                    source_account_id=sumup_entry_acc_id,
                     target_account_id=pending_top_up.customer_account_id,
                 ): pending_top_up.amount
             }
@@ -511,7 +565,7 @@ class OrderService(Service[Config]):
             )
 
         booked_products = await self._get_products_from_buttons(
-            conn=conn, till_profile_id=till.active_profile_id, buttons=new_sale.buttons
+            conn=conn, node=node, till_profile_id=till.active_profile_id, buttons=new_sale.buttons
         )
         line_items = await self._preprocess_order_positions(
             customer_restrictions=(
@@ -669,6 +723,16 @@ class OrderService(Service[Config]):
         """
         apply the order after all payment has been settled.
         """
+        if self.config.core.fused_sale_booking:
+            return await self._book_sale_fused(
+                conn=conn,
+                node=node,
+                event_settings=event_settings,
+                till=till,
+                current_user=current_user,
+                new_sale=new_sale,
+            )
+
         pending_sale = await self._check_sale(
             conn=conn,
             node=node,
@@ -687,12 +751,18 @@ class OrderService(Service[Config]):
             for line_item in pending_sale.line_items
         ]
 
-        cash_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.cash_entry)
-        cash_topup_acc = await get_system_account_for_node(
+        cash_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.cash_entry
+        )
+        cash_topup_acc_id = await get_system_account_id_for_node(
             conn=conn, node=node, account_type=AccountType.cash_topup_source
         )
-        sumup_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.sumup_entry)
-        sale_exit_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.sale_exit)
+        sumup_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.sumup_entry
+        )
+        sale_exit_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.sale_exit
+        )
 
         # combine booking based on (source, target) -> amount
         bookings: Dict[BookingIdentifier, float] = defaultdict(lambda: 0.0)
@@ -704,19 +774,19 @@ class OrderService(Service[Config]):
             if pending_sale.payment_method == PaymentMethod.tag:
                 assert pending_sale.customer_account_id is not None
                 source_acc_id = get_source_account(OrderType.sale, pending_sale.customer_account_id)
-                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc.id)
+                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc_id)
             elif pending_sale.payment_method == PaymentMethod.cash:
                 assert current_user.cashier_account_id is not None
                 bookings[
                     BookingIdentifier(
-                        source_account_id=cash_entry_acc.id, target_account_id=current_user.cashier_account_id
+                        source_account_id=cash_entry_acc_id, target_account_id=current_user.cashier_account_id
                     )
                 ] += float(line_item.total_price)
-                source_acc_id = get_source_account(OrderType.sale, cash_topup_acc.id)
-                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc.id)
+                source_acc_id = get_source_account(OrderType.sale, cash_topup_acc_id)
+                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc_id)
             elif pending_sale.payment_method == PaymentMethod.sumup:
-                source_acc_id = get_source_account(OrderType.sale, sumup_entry_acc.id)
-                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc.id)
+                source_acc_id = get_source_account(OrderType.sale, sumup_entry_acc_id)
+                target_acc_id = get_target_account(OrderType.sale, product, sale_exit_acc_id)
 
             assert source_acc_id is not None
             assert target_acc_id is not None
@@ -744,7 +814,7 @@ class OrderService(Service[Config]):
                 conn=conn,
                 order_id=order_info.id,
                 source_account_id=pending_sale.customer_account_id,
-                target_account_id=sale_exit_acc.id,
+                target_account_id=sale_exit_acc_id,
                 voucher_amount=pending_sale.used_vouchers,
             )
 
@@ -777,6 +847,69 @@ class OrderService(Service[Config]):
 
         return completed_order
 
+    @staticmethod
+    async def _book_sale_fused(
+        *,
+        conn: Connection,
+        node: Node,
+        event_settings: RestrictedEventSettings,
+        till: Till,
+        current_user: CurrentUser,
+        new_sale: InternalNewSale,
+    ) -> InternalCompletedSale:
+        """
+        apply the order with the book_sale database function, which performs the same checks and bookings as
+        _book_sale but only needs a single database round trip.
+        """
+        try:
+            result = await conn.fetchval(
+                "select book_sale("
+                "   order_uuid => $1,"
+                "   node_ids_to_root => $2,"
+                "   node_ids_to_event_node => $3,"
+                "   till_id => $4,"
+                "   till_profile_id => $5,"
+                "   cashier_id => $6,"
+                "   cashier_account_id => $7,"
+                "   cash_register_id => $8,"
+                "   payment_method => $9,"
+                "   customer_tag_uid => $10,"
+                "   used_vouchers => $11,"
+                "   button_ids => $12,"
+                "   button_is_product => $13,"
+                "   button_quantities => $14,"
+                "   button_prices => $15,"
+                "   max_account_balance => $16)",
+                new_sale.uuid,
+                node.ids_to_root,
+                node.ids_to_event_node,
+                till.id,
+                till.active_profile_id,
+                current_user.id,
+                current_user.cashier_account_id,
+                current_user.cash_register_id,
+                new_sale.payment_method.name,
+                new_sale.customer_tag_uid,
+                new_sale.used_vouchers,
+                [b.id for b in new_sale.buttons],
+                [b.is_product for b in new_sale.buttons],
+                [b.quantity for b in new_sale.buttons],
+                [b.price for b in new_sale.buttons],
+                event_settings.max_account_balance,
+            )
+        except asyncpg.exceptions.RaiseError as e:
+            raise _sale_booking_error(e) from e
+
+        return InternalCompletedSale.model_validate(
+            {
+                **result,
+                "buttons": new_sale.buttons,
+                "payment_method": new_sale.payment_method,
+                "till_id": till.id,
+                "cashier_id": current_user.id,
+            }
+        )
+
     @with_db_transaction(read_only=False)
     @requires_terminal(user_privileges=[Privilege.can_book_orders])
     async def book_sale(
@@ -902,7 +1035,7 @@ class OrderService(Service[Config]):
         order_id: int,
         edit_sale: EditSaleProducts,
     ) -> CompletedSaleProducts:
-        order = await fetch_order(conn=conn, order_id=order_id)
+        order = await fetch_order_summary(conn=conn, order_id=order_id)
         if order is None:
             raise InvalidArgument("Order does not exist")
         virtual_till = await fetch_virtual_till(conn=conn, node=node)
@@ -1072,17 +1205,19 @@ class OrderService(Service[Config]):
             )
         ]
 
-        cash_topup_acc = await get_system_account_for_node(
+        cash_topup_acc_id = await get_system_account_id_for_node(
             conn=conn, node=node, account_type=AccountType.cash_topup_source
         )
-        cash_exit_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.cash_exit)
+        cash_exit_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.cash_exit
+        )
 
         prepared_bookings: Dict[BookingIdentifier, float] = {
             BookingIdentifier(
-                source_account_id=pending_pay_out.customer_account_id, target_account_id=cash_topup_acc.id
+                source_account_id=pending_pay_out.customer_account_id, target_account_id=cash_topup_acc_id
             ): -pending_pay_out.amount,
             BookingIdentifier(
-                source_account_id=current_user.cashier_account_id, target_account_id=cash_exit_acc.id
+                source_account_id=current_user.cashier_account_id, target_account_id=cash_exit_acc_id
             ): -pending_pay_out.amount,
         }
 
@@ -1347,36 +1482,42 @@ class OrderService(Service[Config]):
             if line_item.product.type != ProductType.topup:
                 total_ticket_price += line_item.total_price
 
-        cash_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.cash_entry)
-        cash_topup_acc = await get_system_account_for_node(
+        cash_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.cash_entry
+        )
+        cash_topup_acc_id = await get_system_account_id_for_node(
             conn=conn, node=node, account_type=AccountType.cash_topup_source
         )
-        sumup_entry_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.sumup_entry)
-        sale_exit_acc = await get_system_account_for_node(conn=conn, node=node, account_type=AccountType.sale_exit)
+        sumup_entry_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.sumup_entry
+        )
+        sale_exit_acc_id = await get_system_account_id_for_node(
+            conn=conn, node=node, account_type=AccountType.sale_exit
+        )
 
         prepared_bookings: dict[BookingIdentifier, float] = {}
         if pending_ticket_sale.payment_method == PaymentMethod.cash:
             prepared_bookings[
                 BookingIdentifier(
-                    source_account_id=cash_entry_acc.id, target_account_id=current_user.cashier_account_id
+                    source_account_id=cash_entry_acc_id, target_account_id=current_user.cashier_account_id
                 )
             ] = pending_ticket_sale.total_price
             prepared_bookings[
-                BookingIdentifier(source_account_id=cash_topup_acc.id, target_account_id=sale_exit_acc.id)
+                BookingIdentifier(source_account_id=cash_topup_acc_id, target_account_id=sale_exit_acc_id)
             ] = total_ticket_price
             for customer_account_id in customers.keys():
                 topup_amount = customers[customer_account_id][0]
                 prepared_bookings[
-                    BookingIdentifier(source_account_id=cash_topup_acc.id, target_account_id=customer_account_id)
+                    BookingIdentifier(source_account_id=cash_topup_acc_id, target_account_id=customer_account_id)
                 ] = topup_amount
         elif pending_ticket_sale.payment_method == PaymentMethod.sumup:
             prepared_bookings[
-                BookingIdentifier(source_account_id=sumup_entry_acc.id, target_account_id=sale_exit_acc.id)
+                BookingIdentifier(source_account_id=sumup_entry_acc_id, target_account_id=sale_exit_acc_id)
             ] = total_ticket_price
             for customer_account_id in customers.keys():
                 topup_amount = customers[customer_account_id][0]
                 prepared_bookings[
-                    BookingIdentifier(source_account_id=sumup_entry_acc.id, target_account_id=customer_account_id)
+                    BookingIdentifier(source_account_id=sumup_entry_acc_id, target_account_id=customer_account_id)
                 ] = topup_amount
         else:
             raise InvalidArgument("Invalid payment method")
@@ -1417,39 +1558,91 @@ class OrderService(Service[Config]):
     @with_db_transaction(read_only=True)
     @requires_terminal([Privilege.can_book_orders])
     async def list_orders_terminal(
-        self, *, conn: Connection, current_user: User, current_terminal: CurrentTerminal
+        self,
+        *,
+        conn: Connection,
+        current_user: User,
+        current_terminal: CurrentTerminal,
+        before_id: Optional[int] = None,
+        limit: Optional[int] = None,
     ) -> list[Order]:
         assert current_terminal.till is not None
-        return await conn.fetch_many(
-            Order,
-            "select * from order_value_prefiltered((select array_agg(o.id) from ordr o where o.cashier_id = $1 and o.till_id = $2))",
-            current_user.id,
-            current_terminal.till.id,
+        return await fetch_order_page(
+            conn=conn,
+            condition="o.cashier_id = $1 and o.till_id = $2",
+            args=(current_user.id, current_terminal.till.id),
+            before_id=before_id,
+            limit=limit,
         )
 
     @with_db_transaction(read_only=True)
     @requires_node()
     @requires_user([Privilege.node_administration])
-    async def list_orders(self, *, conn: Connection, customer_account_id: Optional[int] = None) -> list[Order]:
+    async def list_orders(
+        self,
+        *,
+        conn: Connection,
+        node: Node,
+        customer_account_id: Optional[int] = None,
+        before_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> list[Order]:
         if customer_account_id is not None:
-            return await conn.fetch_many(
-                Order,
-                "select * from order_value_prefiltered((select array_agg(o.id) from ordr o where customer_account_id = $1))",
-                customer_account_id,
+            return await fetch_order_page(
+                conn=conn,
+                condition="o.customer_account_id = $1",
+                args=(customer_account_id,),
+                before_id=before_id,
+                limit=limit,
             )
-        else:
-            return await conn.fetch_many(Order, "select * from order_value")
+        return await fetch_order_page(
+            conn=conn,
+            condition="o.till_id in ("
+            "   select t.id from till t join node n on t.node_id = n.id where $1 = any(n.parent_ids) or n.id = $1"
+            ")",
+            args=(node.id,),
+            before_id=before_id,
+            limit=limit,
+        )
 
     @with_db_transaction(read_only=True)
     @requires_node()
     @requires_user([Privilege.node_administration])
-    async def list_orders_by_till(self, *, conn: Connection, till_id: int) -> list[Order]:
-        return await conn.fetch_many(
-            Order,
-            "select * from order_value_prefiltered((select array_agg(o.id) from ordr o where till_id = $1))",
-            till_id,
+    async def list_orders_by_till(
+        self, *, conn: Connection, till_id: int, before_id: Optional[int] = None, limit: Optional[int] = None
+    ) -> list[Order]:
+        return await fetch_order_page(
+            conn=conn, condition="o.till_id = $1", args=(till_id,), before_id=before_id, limit=limit
         )
 
+    @with_db_transaction(read_only=True)
+    @requires_node()
+    @requires_user([Privilege.node_administration])
+    async def get_order_export_node(self, *, node: Node) -> Node:
+        """
+        check that the current user may export all orders of the given node
+        """
+        return node
+
+    async def stream_orders(self, *, node: Node, prefetch: int = 500) -> AsyncIterator[Order]:
+        """
+        all orders booked at or below the given node, read through a server side cursor.
+        the caller has to check the permissions with get_order_export_node beforehand.
+        """
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                cursor = conn.cursor(
+                    "select o.* from order_value o "
+                    "join till t on o.till_id = t.id "
+                    "join node n on t.node_id = n.id "
+                    "where $1 = any(n.parent_ids) or n.id = $1 "
+                    "order by o.id",
+                    node.id,
+                    prefetch=prefetch,
+                )
+                async for row in cursor:
+                    yield Order.model_validate(dict(row))
+
     @with_db_transaction(read_only=True)
     @requires_node()
     @requires_user([Privilege.node_administration])
@@ -17,6 +17,7 @@ from stustapay.core.service.common.decorators import (
     requires_user,
 )
 from stustapay.core.service.common.error import InvalidArgument
+from stustapay.core.service.order.live_stats import LiveStatsBroadcaster
 from stustapay.core.service.product import fetch_pay_out_product, fetch_top_up_product
 from stustapay.core.service.tree.common import fetch_event_for_node
 
@@ -99,81 +100,60 @@ def get_event_time_bounds(query: TimeseriesStatsQuery, event: PublicEventSetting
     return from_t, to_t
 
 
-async def get_hourly_entry_stats(*, conn: Connection, node: Node, from_time: datetime, to_time: datetime) -> Timeseries:
+async def _get_hourly_rollup_stats(
+    *, conn: Connection, node: Node, from_time: datetime, to_time: datetime, condition: str, params: tuple = ()
+) -> Timeseries:
+    """
+    hourly sums of all line items booked at tills in the subtree of node, read from the order_stats_hourly rollup.
+    condition can filter on the rollup (r) and the product (p), its parameters start at $4.
+    """
     stats = await conn.fetch_many(
         StatInterval,
         "select "
-        "   date_trunc('hour', o.booked_at) as from_time, "
-        "   date_trunc('hour', o.booked_at) + interval '1 hour' as to_time, "
-        "   sum(li.quantity) as count,"
-        "   round(sum(li.total_price), 2) as revenue "
-        "from orders_at_node_and_children($3) o "
-        "join line_item li on o.id = li.order_id "
-        "join product p on li.product_id = p.id "
-        "where p.ticket_metadata_id is not null and o.booked_at >= $1 and o.booked_at <= $2 "
-        "group by from_time, to_time "
-        "order by from_time",
+        "   r.hour as from_time, "
+        "   r.hour + interval '1 hour' as to_time, "
+        "   sum(r.count) as count,"
+        "   round(sum(r.revenue), 2) as revenue "
+        "from order_stats_hourly r "
+        "join node n on r.node_id = n.id "
+        "join product p on r.product_id = p.id "
+        "where r.hour >= date_trunc('hour', $1::timestamptz) and r.hour <= $2 "
+        "   and ($3 = any(n.parent_ids) or n.id = $3) "
+        f"  and {condition} "
+        "group by r.hour "
+        "order by r.hour",
         from_time,
         to_time,
         node.id,
+        *params,
     )
 
     return Timeseries(from_time=from_time, to_time=to_time, intervals=stats)
 
 
+async def get_hourly_entry_stats(*, conn: Connection, node: Node, from_time: datetime, to_time: datetime) -> Timeseries:
+    return await _get_hourly_rollup_stats(
+        conn=conn, node=node, from_time=from_time, to_time=to_time, condition="p.ticket_metadata_id is not null"
+    )
+
+
 async def get_hourly_top_up_stats(
     *, conn: Connection, node: Node, from_time: datetime, to_time: datetime
 ) -> Timeseries:
     top_up_product = await fetch_top_up_product(conn=conn, node=node)
-
-    stats = await conn.fetch_many(
-        StatInterval,
-        "select "
-        "   date_trunc('hour', o.booked_at) as from_time, "
-        "   date_trunc('hour', o.booked_at) + interval '1 hour' as to_time, "
-        "   sum(li.quantity) as count,"
-        "   round(sum(li.total_price), 2) as revenue "
-        "from orders_at_node_and_children($3) o "
-        "join line_item li on o.id = li.order_id "
-        "join product p on li.product_id = p.id "
-        "where p.id = $4 and o.booked_at >= $1 and o.booked_at <= $2 "
-        "group by from_time, to_time "
-        "order by from_time",
-        from_time,
-        to_time,
-        node.id,
-        top_up_product.id,
+    return await _get_hourly_rollup_stats(
+        conn=conn, node=node, from_time=from_time, to_time=to_time, condition="p.id = $4", params=(top_up_product.id,)
     )
 
-    return Timeseries(from_time=from_time, to_time=to_time, intervals=stats)
-
 
 async def get_hourly_pay_out_stats(
     *, conn: Connection, node: Node, from_time: datetime, to_time: datetime
 ) -> Timeseries:
     pay_out_product = await fetch_pay_out_product(conn=conn, node=node)
-
-    stats = await conn.fetch_many(
-        StatInterval,
-        "select "
-        "   date_trunc('hour', o.booked_at) as from_time, "
-        "   date_trunc('hour', o.booked_at) + interval '1 hour' as to_time, "
-        "   sum(li.quantity) as count,"
-        "   round(sum(li.total_price), 2) as revenue "
-        "from orders_at_node_and_children($3) o "
-        "join line_item li on o.id = li.order_id "
-        "join product p on li.product_id = p.id "
-        "where p.id = $4 and o.booked_at >= $1 and o.booked_at <= $2 "
-        "group by from_time, to_time "
-        "order by from_time",
-        from_time,
-        to_time,
-        node.id,
-        pay_out_product.id,
+    return await _get_hourly_rollup_stats(
+        conn=conn, node=node, from_time=from_time, to_time=to_time, condition="p.id = $4", params=(pay_out_product.id,)
     )
 
-    return Timeseries(from_time=from_time, to_time=to_time, intervals=stats)
-
 
 async def get_hourly_sales_stats(*, conn: Connection, node: Node, from_time: datetime, to_time: datetime) -> Timeseries:
     """
@@ -183,51 +163,31 @@ async def get_hourly_sales_stats(*, conn: Connection, node: Node, from_time: dat
     We currently assume that only payments made with a tag are actual vending payments (since anything else is
     currently not possible in the system).
     """
-
-    stats = await conn.fetch_many(
-        StatInterval,
-        "select "
-        "   date_trunc('hour', o.booked_at) as from_time, "
-        "   date_trunc('hour', o.booked_at) + interval '1 hour' as to_time, "
-        "   sum(li.quantity) as count,"
-        "   round(sum(li.total_price), 2) as revenue "
-        "from orders_at_node_and_children($3) o "
-        "join line_item li on o.id = li.order_id "
-        "where o.booked_at >= $1 and o.booked_at <= $2 and o.payment_method = 'tag' "
-        "group by from_time, to_time "
-        "order by from_time",
-        from_time,
-        to_time,
-        node.id,
+    return await _get_hourly_rollup_stats(
+        conn=conn, node=node, from_time=from_time, to_time=to_time, condition="r.payment_method = 'tag'"
     )
 
-    return Timeseries(from_time=from_time, to_time=to_time, intervals=stats)
-
 
 async def get_hourly_product_stats(
     *, conn: Connection, node: Node, from_time: datetime, to_time: datetime, returnable=False
 ) -> list[ProductTimeseries]:
     result = await conn.fetch(
-        "select s.*, prod.name as product_name "
-        "from (select "
+        "select "
         "   p.id as product_id, "
-        "   date_trunc('hour', o.booked_at) as from_time, "
-        "   date_trunc('hour', o.booked_at) + interval '1 hour' as to_time, "
-        "   sum(li.quantity) as count,"
-        "   round(sum(li.total_price), 2) as revenue "
-        "from order_value o "
-        "join till t on o.till_id = t.id "
-        "join line_item li on o.id = li.order_id "
-        "join product p on li.product_id = p.id "
-        "join node n on t.node_id = n.id "
-        "where o.booked_at >= $1 and o.booked_at <= $2 "
+        "   p.name as product_name, "
+        "   r.hour as from_time, "
+        "   r.hour + interval '1 hour' as to_time, "
+        "   sum(r.count) as count,"
+        "   round(sum(r.revenue), 2) as revenue "
+        "from order_stats_hourly r "
+        "join node n on r.node_id = n.id "
+        "join product p on r.product_id = p.id "
+        "where r.hour >= date_trunc('hour', $1::timestamptz) and r.hour <= $2 "
         "   and p.type = 'user_defined' "
         "   and ($3 = any(n.parent_ids) or n.id = $3) "
         "   and p.is_returnable = $4 "
-        "group by p.id, from_time, to_time "
-        "order by from_time) s "
-        "join product prod on s.product_id = prod.id "
-        "join node nod on prod.node_id = nod.id",
+        "group by p.id, r.hour "
+        "order by r.hour",
         from_time,
         to_time,
         node.id,
@@ -286,6 +246,16 @@ class OrderStatsService(Service[Config]):
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
+        self.live = LiveStatsBroadcaster(db_pool=db_pool)
+
+    @with_db_transaction(read_only=True)
+    @requires_node(event_only=True)
+    @requires_user([Privilege.node_administration, Privilege.view_node_stats])
+    async def get_live_stats_node(self, *, node: Node) -> Node:
+        """
+        check that the current user may follow the live stats of the given node
+        """
+        return node
 
     @with_db_transaction(read_only=True)
     @requires_node(event_only=True)
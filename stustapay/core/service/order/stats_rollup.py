@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+import asyncpg
+from pydantic import BaseModel
+from sftkit.database import Connection, DatabaseHook
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = 1000
+
+
+class OrderStatsMismatch(BaseModel):
+    node_id: int
+    hour: datetime
+    product_id: int
+    order_type: str
+    payment_method: str
+    rollup_count: Optional[int]
+    rollup_revenue: Optional[float]
+    expected_count: Optional[int]
+    expected_revenue: Optional[float]
+
+
+async def rollup_order_stats(*, conn: Connection, batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """
+    add all queued orders to the hourly stats rollup, each batch is committed on its own.
+    returns the number of processed orders.
+    """
+    n_orders = 0
+    while True:
+        n_processed = await conn.fetchval("select rollup_order_stats($1)", batch_size)
+        n_orders += n_processed
+        if n_processed < batch_size:
+            return n_orders
+
+
+async def backfill_order_stats(*, conn: Connection):
+    """
+    recompute the hourly stats rollup from all booked orders.
+    """
+    async with conn.transaction():
+        # blocks concurrent rollups until we are done
+        await conn.execute("truncate order_stats_hourly")
+        # a single statement guarantees that the cleared queue and the aggregated orders are from the same snapshot,
+        # orders committed in the meantime stay queued.
+        await conn.execute(
+            "with cleared as (delete from order_stats_pending) "
+            "insert into order_stats_hourly (node_id, hour, product_id, order_type, payment_method, count, revenue) "
+            "select li.node_id, li.hour, li.product_id, li.order_type, li.payment_method, "
+            "   sum(li.quantity), sum(li.total_price) "
+            "from order_stats_line_items li "
+            "group by li.node_id, li.hour, li.product_id, li.order_type, li.payment_method"
+        )
+
+
+async def check_order_stats(*, conn: Connection) -> list[OrderStatsMismatch]:
+    """
+    compare the hourly stats rollup with the stats computed from all orders which are not queued for the rollup.
+    """
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        return await conn.fetch_many(
+            OrderStatsMismatch,
+            "with expected as ("
+            "   select li.node_id, li.hour, li.product_id, li.order_type, li.payment_method, "
+            "       sum(li.quantity) as count, sum(li.total_price) as revenue "
+            "   from order_stats_line_items li "
+            "   where not exists (select from order_stats_pending p where p.order_id = li.order_id) "
+            "   group by li.node_id, li.hour, li.product_id, li.order_type, li.payment_method"
+            ") "
+            "select "
+            "   node_id, hour, product_id, order_type, payment_method, "
+            "   r.count as rollup_count, r.revenue as rollup_revenue, "
+            "   e.count as expected_count, e.revenue as expected_revenue "
+            "from expected e "
+            "full outer join order_stats_hourly r using (node_id, hour, product_id, order_type, payment_method) "
+            "where r.count is distinct from e.count or r.revenue is distinct from e.revenue "
+            "order by node_id, hour, product_id, order_type, payment_method",
+        )
+
+
+async def run_order_stats_rollup(db_pool: asyncpg.Pool, min_interval: float = 1.0):
+    """
+    keep the hourly stats rollup up to date, new orders are rolled up at most every min_interval seconds
+    """
+    orders_pending = asyncio.Event()
+
+    async def handle_new_order(payload: Optional[str]):  # pylint: disable=unused-argument
+        # all queued orders are rolled up at once, the notified order does not matter
+        orders_pending.set()
+
+    db_hook = DatabaseHook(db_pool, "order", handle_new_order, initial_run=True)
+    hook_task = asyncio.create_task(db_hook.run())
+    try:
+        while True:
+            await orders_pending.wait()
+            orders_pending.clear()
+            try:
+                async with db_pool.acquire() as conn:
+                    n_orders = await rollup_order_stats(conn=conn)
+                logger.debug(f"added {n_orders} orders to the stats rollup")
+            except asyncpg.PostgresError:
+                logger.exception("order stats rollup failed")
+                orders_pending.set()
+            await asyncio.sleep(min_interval)
+    finally:
+        hook_task.cancel()
+        await asyncio.gather(hook_task, return_exceptions=True)
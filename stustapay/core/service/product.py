@@ -9,6 +9,7 @@ from stustapay.core.schema.product import NewProduct, Product, ProductType
 from stustapay.core.schema.tree import Node, ObjectType
 from stustapay.core.schema.user import Privilege
 from stustapay.core.service.auth import AuthService
+from stustapay.core.service.common.cache import NodeCache
 from stustapay.core.service.common.decorators import requires_node, requires_user
 from stustapay.core.service.common.error import NotFound, ServiceException
 
@@ -25,7 +26,14 @@ async def fetch_product(
     )
 
 
+_constant_products: NodeCache[ProductType, Product] = NodeCache("constant_products")
+
+
 async def fetch_constant_product(*, conn: Connection, node: Node, product_type: ProductType) -> Product:
+    product = _constant_products.get(node.event_node_id, product_type)
+    if product is not None:
+        return product
+
     product = await conn.fetch_maybe_one(
         Product,
         "select * from product_with_tax_and_restrictions where type = $1 and node_id = any($2)",
@@ -34,6 +42,7 @@ async def fetch_constant_product(*, conn: Connection, node: Node, product_type:
     )
     if product is None:
         raise RuntimeError("no product found in database")
+    _constant_products.set(node.event_node_id, product_type, product, version=NodeCache.transaction_version())
     return product
 
 
@@ -21,7 +21,11 @@ from stustapay.core.schema.terminal import (
 from stustapay.core.schema.till import Till, TillProfile
 from stustapay.core.schema.tree import Node, ObjectType, RestrictedEventSettings
 from stustapay.core.schema.user import Privilege
-from stustapay.core.service.auth import AuthService, TerminalTokenMetadata
+from stustapay.core.service.auth import (
+    AuthService,
+    TerminalTokenMetadata,
+    fetch_user_privileges_at_node,
+)
 from stustapay.core.service.common.decorators import (
     requires_node,
     requires_terminal,
@@ -234,11 +238,11 @@ class TerminalService(Service[Config]):
         )
         allow_ticket_sale = layout_has_tickets and profile.allow_ticket_sale
 
-        user_privileges = await conn.fetchval(
-            "select privileges_at_node as privileges from user_privileges_at_node($1) where node_id = $2",
-            till.active_user_id,
-            till.node_id,
-        )
+        user_privileges = None
+        if till.active_user_id is not None:
+            user_privileges = sorted(
+                await fetch_user_privileges_at_node(conn=conn, user_id=till.active_user_id, node_id=till.node_id)
+            )
         buttons = await conn.fetch_many(
             TerminalButton,
             "select tlwb.* "
@@ -17,6 +17,7 @@ from stustapay.core.schema.user import (
     UserTag,
     format_user_tag_uid,
 )
+from stustapay.core.service.auth import fetch_user_privileges_at_node
 from stustapay.core.service.common.decorators import (
     requires_node,
     requires_terminal,
@@ -188,12 +189,8 @@ class TillService(Service[Config]):
         new_user_id = await conn.fetchval("select id from user_with_tag where user_tag_uid = $1", user_tag.uid)
         assert new_user_id is not None
 
-        new_user_is_supervisor = await conn.fetchval(
-            "select true from user_privileges_at_node($1) where $2 = any(privileges_at_node) and node_id = $3",
-            new_user_id,
-            Privilege.terminal_login.name,
-            node.id,
-        )
+        new_user_privileges = await fetch_user_privileges_at_node(conn=conn, user_id=new_user_id, node_id=node.id)
+        new_user_is_supervisor = Privilege.terminal_login.name in new_user_privileges
         if not new_user_is_supervisor:
             if current_user is None or Privilege.terminal_login not in current_user.privileges:
                 raise AccessDenied("You can only be logged in by a supervisor")
@@ -334,7 +331,13 @@ class TillService(Service[Config]):
     @with_db_transaction(read_only=True)
     @requires_terminal(user_privileges=[Privilege.customer_management])
     async def get_customer_orders(
-        self, *, conn: Connection, current_terminal: CurrentTerminal, customer_tag_uid: int
+        self,
+        *,
+        conn: Connection,
+        current_terminal: CurrentTerminal,
+        customer_tag_uid: int,
+        before_id: Optional[int] = None,
+        limit: Optional[int] = None,
     ) -> list[Order]:
         node = await fetch_node(conn=conn, node_id=current_terminal.node_id)
         assert node is not None
@@ -346,9 +349,15 @@ class TillService(Service[Config]):
         if customer_id is None:
             raise InvalidArgument(f"Customer with tag uid {format_user_tag_uid(customer_tag_uid)} does not exist")
 
-        orders = await conn.fetch_many(
+        return await conn.fetch_many(
             Order,
-            "select * from order_value_prefiltered((select array_agg(o.id) from ordr o where customer_account_id = $1))",
+            "select * from order_value_prefiltered(("
+            "   select array_agg(p.id) from ("
+            "       select o.id from ordr o where o.customer_account_id = $1 and ($2::bigint is null or o.id < $2) "
+            "       order by o.id desc limit $3"
+            "   ) p"
+            ")) order by id desc",
             customer_id,
+            before_id,
+            limit,
         )
-        return orders
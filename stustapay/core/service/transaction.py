@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from typing import Optional
 
 from sftkit.database import Connection
@@ -31,3 +32,45 @@ async def book_transaction(
         voucher_amount,
         conducting_user_id,
     )
+
+
+@dataclass
+class NewTransaction:
+    source_account_id: int
+    target_account_id: int
+    amount: float = 0
+    voucher_amount: int = 0
+
+
+async def book_transactions(
+    *,
+    conn: Connection,
+    transactions: list[NewTransaction],
+    conducting_user_id: Optional[int] = None,
+    description: str = "",
+    order_id: Optional[int] = None,
+) -> list[int]:
+    """
+    book multiple transactions with a constant number of database statements
+    """
+    if len(transactions) == 0:
+        return []
+
+    rows = await conn.fetch(
+        "select * from book_transactions("
+        "   order_id => $1,"
+        "   description => $2,"
+        "   source_account_ids => $3,"
+        "   target_account_ids => $4,"
+        "   amounts => $5,"
+        "   vouchers_amounts => $6,"
+        "   conducting_user_id => $7) as id",
+        order_id,
+        description,
+        [t.source_account_id for t in transactions],
+        [t.target_account_id for t in transactions],
+        [t.amount for t in transactions],
+        [t.voucher_amount for t in transactions],
+        conducting_user_id,
+    )
+    return [row["id"] for row in rows]
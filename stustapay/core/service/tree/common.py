@@ -1,5 +1,10 @@
+import logging
+import time
+from typing import Optional
+
+import asyncpg
 from pydantic import BaseModel
-from sftkit.database import Connection
+from sftkit.database import Connection, DatabaseHook
 
 from stustapay.core.schema.tree import (
     Language,
@@ -18,10 +23,11 @@ class TranslationText(BaseModel):
     content: str
 
 
-async def _fetch_translation_textx(conn: Connection, event_id: int) -> dict[Language, dict[str, str]]:
-    texts = await conn.fetch_many(
-        TranslationText, "select lang_code, type, content from translation_text where event_id = $1", event_id
-    )
+class EventTranslationText(TranslationText):
+    event_id: int
+
+
+def _group_translation_texts(texts: list[TranslationText]) -> dict[Language, dict[str, str]]:
     result: dict[Language, dict[str, str]] = {}
     for text in texts:
         if text.lang_code not in result:
@@ -30,7 +36,125 @@ async def _fetch_translation_textx(conn: Connection, event_id: int) -> dict[Lang
     return result
 
 
-async def fetch_node(conn: Connection, node_id: int) -> Node | None:
+async def _fetch_translation_textx(conn: Connection, event_id: int) -> dict[Language, dict[str, str]]:
+    texts = await conn.fetch_many(
+        TranslationText, "select lang_code, type, content from translation_text where event_id = $1", event_id
+    )
+    return _group_translation_texts(texts)
+
+
+logger = logging.getLogger(__name__)
+
+# pg_notify channel which fires whenever nodes, events, their translations or forbidden objects change
+NODE_CHANNEL = "node"
+
+
+class NodeTreeCache:
+    """
+    Process wide copy of the complete node tree, including event settings and translations.
+
+    The tree is loaded by run_node_tree_cache and reloaded on every change notification, it is only used
+    while this is running. Cached nodes and event settings are shared and must not be modified.
+    """
+
+    def __init__(self):
+        self.nodes: Optional[dict[int, Node]] = None
+        self.event_settings: dict[int, RestrictedEventSettings] = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.nodes is not None
+
+    def get_node(self, node_id: int) -> Optional[Node]:
+        if self.nodes is None:
+            return None
+        node = self.nodes.get(node_id)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def get_event_settings(self, event_node_id: int) -> Optional[RestrictedEventSettings]:
+        if self.nodes is None:
+            return None
+        return self.event_settings.get(event_node_id)
+
+    def clear(self):
+        self.nodes = None
+        self.event_settings = {}
+
+    async def load(self, conn: Connection):
+        start = time.monotonic()
+        # all queries have to see the same state of the tree
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            nodes = await conn.fetch_many(
+                Node, "select n.*, '{}'::json array as children from node_with_allowed_objects n order by n.path asc"
+            )
+            event_settings_rows = await conn.fetch(
+                "select n.id as event_node_id, e.* from event_with_translations e join node n on n.event_id = e.id"
+            )
+            texts = await conn.fetch_many(
+                EventTranslationText, "select event_id, lang_code, type, content from translation_text"
+            )
+        texts_by_event: dict[int, list[TranslationText]] = {}
+        for text in texts:
+            texts_by_event.setdefault(text.event_id, []).append(text)
+
+        node_map: dict[int, Node] = {}
+        for node in nodes:
+            if node.event is not None:
+                node.event.translation_texts = _group_translation_texts(texts_by_event.get(node.event.id, []))
+            if node.parent != node.id and node.parent in node_map:
+                node_map[node.parent].children.append(node)
+            node_map[node.id] = node
+
+        event_settings: dict[int, RestrictedEventSettings] = {}
+        for row in event_settings_rows:
+            settings = RestrictedEventSettings.model_validate(dict(row))
+            settings.translation_texts = _group_translation_texts(texts_by_event.get(settings.id, []))
+            event_settings[row["event_node_id"]] = settings
+
+        self.nodes = node_map
+        self.event_settings = event_settings
+        self.loads += 1
+        self.load_seconds += time.monotonic() - start
+
+
+node_tree = NodeTreeCache()
+
+
+async def run_node_tree_cache(db_pool: asyncpg.Pool):
+    """
+    load the node tree into memory and keep it current by listening for node changes.
+    """
+
+    async def reload(payload: Optional[str]):
+        logger.debug(f"node tree changed: {payload}, reloading")
+        async with db_pool.acquire() as conn:
+            await node_tree.load(conn=conn)
+
+    db_hook = DatabaseHook(db_pool, NODE_CHANNEL, reload, initial_run=True)
+    try:
+        await db_hook.run()
+    finally:
+        node_tree.clear()
+
+
+async def fetch_node(conn: Connection, node_id: int, use_cache: bool = True) -> Node | None:
+    """
+    the node with its complete subtree. Served from the node tree cache if it is loaded,
+    writers have to pass use_cache=False to see their own uncommitted changes.
+    """
+    if use_cache:
+        node = node_tree.get_node(node_id)
+        if node is not None:
+            return node
+
     node = await conn.fetch_maybe_one(
         Node, "select n.*, '{}'::json array as children from node_with_allowed_objects n where n.id = $1", node_id
     )
@@ -105,6 +229,11 @@ async def get_tree_for_current_user(conn: Connection, current_user: CurrentUser)
 
 
 async def fetch_event_for_node(conn: Connection, node: Node) -> PublicEventSettings:
+    if node.event_node_id is not None:
+        event_node = node_tree.get_node(node.event_node_id)
+        if event_node is not None and event_node.event is not None:
+            return event_node.event
+
     return await conn.fetch_one(
         PublicEventSettings,
         "select * from event_with_translations e join node n on n.event_id = e.id where n.id = $1",
@@ -113,13 +242,28 @@ async def fetch_event_for_node(conn: Connection, node: Node) -> PublicEventSetti
 
 
 async def fetch_event_node_for_node(conn: Connection, node_id: int) -> Node | None:
+    node = node_tree.get_node(node_id)
+    if node is not None and node.event_node_id is not None:
+        event_node = node_tree.get_node(node.event_node_id)
+        if event_node is not None:
+            return event_node
+
     event_node_id = await conn.fetchval("select event_node_id from node where id = $1", node_id)
     if event_node_id is None:
         raise NotFound(element_type="node", element_id=node_id)
     return await fetch_node(conn=conn, node_id=event_node_id)
 
 
-async def fetch_restricted_event_settings_for_node(conn: Connection, node_id: int) -> RestrictedEventSettings:
+async def fetch_restricted_event_settings_for_node(
+    conn: Connection, node_id: int, use_cache: bool = True
+) -> RestrictedEventSettings:
+    if use_cache:
+        node = node_tree.get_node(node_id)
+        if node is not None and node.event_node_id is not None:
+            cached_settings = node_tree.get_event_settings(node.event_node_id)
+            if cached_settings is not None:
+                return cached_settings
+
     event_node_id = await conn.fetchval("select event_node_id from node where id = $1", node_id)
     if event_node_id is None:
         raise NotFound(element_type="node", element_id=node_id)
@@ -111,13 +111,13 @@ async def create_node(conn: Connection, parent_id: int, new_node: NewNode, event
         new_node.description,
         event_id,
     )
-    result = await fetch_node(conn=conn, node_id=new_node_id)
+    result = await fetch_node(conn=conn, node_id=new_node_id, use_cache=False)
     assert result is not None
     await _update_forbidden_objects_at_node(conn=conn, node=result, forbidden=set(new_node.forbidden_objects_at_node))
     await _update_forbidden_objects_in_subtree(
         conn=conn, node=result, forbidden=set(new_node.forbidden_objects_in_subtree)
     )
-    result = await fetch_node(conn=conn, node_id=new_node_id)
+    result = await fetch_node(conn=conn, node_id=new_node_id, use_cache=False)
     assert result is not None
     return result
 
@@ -277,7 +277,7 @@ class TreeService(Service[Config]):
         await _update_forbidden_objects_in_subtree(
             conn=conn, node=node, forbidden=set(updated_node.forbidden_objects_in_subtree)
         )
-        result = await fetch_node(conn=conn, node_id=node.id)
+        result = await fetch_node(conn=conn, node_id=node.id, use_cache=False)
         assert result is not None
         return result
 
@@ -356,7 +356,7 @@ class TreeService(Service[Config]):
                     text_type,
                     content,
                 )
-        updated_node = await fetch_node(conn=conn, node_id=node.id)
+        updated_node = await fetch_node(conn=conn, node_id=node.id, use_cache=False)
         assert updated_node is not None
         return updated_node
 
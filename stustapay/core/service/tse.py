@@ -4,7 +4,7 @@ from sftkit.service import Service, with_db_transaction
 
 from stustapay.core.config import Config
 from stustapay.core.schema.tree import Node, ObjectType
-from stustapay.core.schema.tse import NewTse, Tse, UpdateTse
+from stustapay.core.schema.tse import NewTse, Tse, TseHistogram, TseMetrics, UpdateTse
 from stustapay.core.schema.user import Privilege
 from stustapay.core.service.auth import AuthService
 from stustapay.core.service.common.decorators import requires_node, requires_user
@@ -15,6 +15,113 @@ async def list_tses(conn: Connection, node: Node) -> list[Tse]:
     return await conn.fetch_many(Tse, "select * from tse where node_id = any($1) order by name", node.ids_to_event_node)
 
 
+async def list_tse_metrics(conn: Connection, node: Node) -> list[TseMetrics]:
+    rows = await conn.fetch(
+        "select m.metrics from tse_metrics m join tse t on m.tse_id = t.id where t.node_id = any($1) order by t.name",
+        node.ids_to_event_node,
+    )
+    return [TseMetrics.model_validate(row["metrics"]) for row in rows]
+
+
+def _prometheus_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(**labels: str) -> str:
+    return "{" + ",".join(f'{name}="{_prometheus_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def _prometheus_histogram(name: str, histogram: TseHistogram, **labels: str) -> list[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_prometheus_labels(**labels, le=repr(float(bound)))} {cumulative}")
+    lines.append(f"{name}_bucket{_prometheus_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_prometheus_labels(**labels)} {histogram.sum!r}")
+    lines.append(f"{name}_count{_prometheus_labels(**labels)} {histogram.count}")
+    return lines
+
+
+def render_prometheus_metrics(metrics: list[TseMetrics]) -> str:
+    """
+    render the TSE metrics in the prometheus text exposition format
+    """
+    lines = []
+
+    def add_metric(name: str, metric_type: str, help_text: str, samples: list[str]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+
+    add_metric(
+        "stustapay_tse_queue_wait_seconds",
+        "histogram",
+        "Time from creating a signature request until it is claimed by the TSE.",
+        [
+            line
+            for m in metrics
+            for line in _prometheus_histogram("stustapay_tse_queue_wait_seconds", m.queue_wait, tse=m.tse_name)
+        ],
+    )
+    add_metric(
+        "stustapay_tse_request_duration_seconds",
+        "histogram",
+        "Round trip time of the TSE commands.",
+        [
+            line
+            for m in metrics
+            for command, histogram in m.request_round_trip.items()
+            for line in _prometheus_histogram(
+                "stustapay_tse_request_duration_seconds", histogram, tse=m.tse_name, command=command
+            )
+        ],
+    )
+    add_metric(
+        "stustapay_tse_order_signature_latency_seconds",
+        "histogram",
+        "Time from booking an order until its signature is stored.",
+        [
+            line
+            for m in metrics
+            for line in _prometheus_histogram(
+                "stustapay_tse_order_signature_latency_seconds", m.end_to_end, tse=m.tse_name
+            )
+        ],
+    )
+    add_metric(
+        "stustapay_tse_signatures_total",
+        "counter",
+        "Signature requests processed by the TSE by result.",
+        [
+            f"stustapay_tse_signatures_total{_prometheus_labels(tse=m.tse_name, result=result)} {count}"
+            for m in metrics
+            for result, count in (("done", m.signatures_done), ("failed", m.signatures_failed))
+        ],
+    )
+    add_metric(
+        "stustapay_tse_request_failures_total",
+        "counter",
+        "TSE commands answered with an error.",
+        [
+            f"stustapay_tse_request_failures_total{_prometheus_labels(tse=m.tse_name, command=command)} {count}"
+            for m in metrics
+            for command, count in m.request_failures.items()
+        ],
+    )
+    add_metric(
+        "stustapay_tse_request_timeouts_total",
+        "counter",
+        "TSE commands without a response in time.",
+        [
+            f"stustapay_tse_request_timeouts_total{_prometheus_labels(tse=m.tse_name, command=command)} {count}"
+            for m in metrics
+            for command, count in m.request_timeouts.items()
+        ],
+    )
+    return "\n".join(lines) + "\n"
+
+
 class TseService(Service[Config]):
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
@@ -59,3 +166,9 @@ class TseService(Service[Config]):
     @requires_user([Privilege.node_administration])
     async def list_tses(self, *, conn: Connection, node: Node) -> list[Tse]:
         return await list_tses(conn=conn, node=node)
+
+    @with_db_transaction(read_only=True)
+    @requires_node(event_only=False)
+    @requires_user([Privilege.node_administration])
+    async def list_tse_metrics(self, *, conn: Connection, node: Node) -> list[TseMetrics]:
+        return await list_tse_metrics(conn=conn, node=node)
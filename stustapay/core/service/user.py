@@ -22,7 +22,12 @@ from stustapay.core.schema.user import (
     UserWithoutId,
     format_user_tag_uid,
 )
-from stustapay.core.service.auth import AuthService, UserTokenMetadata
+from stustapay.core.service.auth import (
+    AuthService,
+    UserTokenMetadata,
+    fetch_user_privileges_at_node,
+    records_token_cache_version,
+)
 from stustapay.core.service.common.decorators import (
     requires_node,
     requires_terminal,
@@ -96,9 +101,7 @@ async def list_user_roles(*, conn: Connection, node: Node) -> list[UserRole]:
 
 
 async def get_user_privileges_at_node(*, conn: Connection, user_id: int, node_id: int) -> set[Privilege]:
-    text_privileges = await conn.fetchval(
-        "select privileges_at_node from user_privileges_at_node($1) where node_id = $2", user_id, node_id
-    )
+    text_privileges = await fetch_user_privileges_at_node(conn=conn, user_id=user_id, node_id=node_id)
     privileges = set(Privilege[p] for p in text_privileges)
     return privileges
 
@@ -532,6 +535,7 @@ class UserService(Service[Config]):
 
         return await fetch_user_to_roles(conn=conn, node=node, user_id=user_to_roles.user_id)
 
+    @records_token_cache_version
     @with_db_transaction
     async def login_user(
         self, *, conn: Connection, username: str, password: str, node_id: int | None = None
@@ -2,7 +2,9 @@
 some basic api endpoints.
 """
 
-from fastapi import APIRouter, status
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Query, status
 
 from stustapay.bon.bon import BonJson
 from stustapay.core.http.auth_customer import CurrentAuthToken
@@ -41,8 +43,10 @@ async def get_customer(
 async def get_orders(
     token: CurrentAuthToken,
     customer_service: ContextCustomerService,
+    before_id: Optional[int] = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
 ):
-    return await customer_service.get_orders_with_bon(token=token)
+    return await customer_service.get_orders_with_bon(token=token, before_id=before_id, limit=limit)
 
 
 @router.post("/customer_info", summary="set iban, account name and email", status_code=status.HTTP_204_NO_CONTENT)
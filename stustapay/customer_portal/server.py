@@ -10,9 +10,15 @@ from stustapay.core.config import Config
 from stustapay.core.database import get_database
 from stustapay.core.healthcheck import run_healthcheck
 from stustapay.core.http.context import Context
+from stustapay.core.service.common.cache import (
+    run_cache_stats_logging,
+    run_node_cache_invalidation,
+    run_token_cache_invalidation,
+)
 from stustapay.core.service.config import ConfigService
 from stustapay.core.service.customer.customer import CustomerService
 from stustapay.core.service.mail import MailService
+from stustapay.core.service.tree.common import run_node_tree_cache
 from stustapay.core.service.user import AuthService
 
 from .routers import auth, base, sumup
@@ -67,6 +73,10 @@ class Api:
 
         try:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="customer_portal")))
+            self.server.add_task(asyncio.create_task(run_node_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_node_tree_cache(db_pool)))
+            self.server.add_task(asyncio.create_task(run_token_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_cache_stats_logging()))
             self.server.add_task(asyncio.create_task(customer_service.sumup.run_sumup_checkout_processing()))
             self.server.add_task(asyncio.create_task(mail_service.run_mail_service()))
             await self.server.run(context)
@@ -2,19 +2,108 @@
 # with modifications by StuStaPay, 2023
 
 import csv
+import io
+import json
+import shutil
+import tempfile
 from collections import defaultdict
 from io import StringIO
-from zipfile import ZIP_DEFLATED, ZipFile
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZipFile
 
 from .table import Model
 
+# master data is written from the current settings on every export, it may change without the closure changing
+_MASTER_DATA_TABLES = {"location.csv", "cashregister.csv", "slaves.csv", "pa.csv", "vat.csv", "tse.csv"}
+_MASTER_DATA_FIELDS = {"cashpointclosing.csv": {"NAME", "STRASSE", "PLZ", "ORT", "LAND", "STNR", "USTID"}}
+
+
+def digest_line(record: Model) -> bytes:
+    """
+    unambiguous serialization of a record's table and csv values, for hashing.
+    only covers the transactional data of a closure, master data is left out.
+    """
+    if record.filename in _MASTER_DATA_TABLES:
+        return b""
+    master_data_fields = _MASTER_DATA_FIELDS.get(record.filename, set())
+    values = ["" if v is None else str(v) for k, v in record.data.items() if k not in master_data_fields]
+    return json.dumps([record.filename, values]).encode("utf-8") + b"\n"
+
+
+class _SpooledTable:
+    """
+    csv rows of one table, written to a temporary file as they are added
+    """
+
+    def __init__(self, record: Model):
+        self.file = tempfile.TemporaryFile("w+b")
+        self.text = io.TextIOWrapper(self.file, encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(
+            self.text, fieldnames=[f.name for f in record._fields], delimiter=";", lineterminator="\r\n"
+        )
+        self.writer.writeheader()
+        self.text.flush()
+        self.header_size = self.file.tell()
+
+    def add(self, record: Model):
+        if record.data:
+            self.writer.writerow(record.data)
+
+    def extend(self, other: "_SpooledTable"):
+        """append the rows of another table of the same type"""
+        self.text.flush()
+        other.text.flush()
+        other.file.seek(other.header_size)
+        shutil.copyfileobj(other.file, self.file)
+        other.close()
+
+    def copy_to(self, zf: ZipFile, name: str):
+        self.text.flush()
+        size = self.file.tell()
+        self.file.seek(0)
+        with zf.open(name, "w", force_zip64=size > ZIP64_LIMIT) as entry:
+            shutil.copyfileobj(self.file, entry)
+
+    def close(self):
+        self.text.close()
+
 
 class Collection:
-    def __init__(self):
+    """
+    Records of a DSFinV-K export, grouped by their table file.
+
+    With streaming=True the records are not kept in memory, instead each row is written to a
+    temporary file of its table right away, and the files are copied into the zip in write().
+    """
+
+    def __init__(self, streaming: bool = False):
+        self.streaming = streaming
         self.records = defaultdict(list)
+        self.spooled_tables: dict[str, _SpooledTable] = {}
+        # optional hash object, e.g. hashlib.sha256(), updated with every added record
+        self.digest = None
 
     def add(self, record: Model):
-        self.records[record.filename].append(record)
+        if self.digest is not None:
+            self.digest.update(digest_line(record))
+        if self.streaming:
+            table = self.spooled_tables.get(record.filename)
+            if table is None:
+                table = self.spooled_tables[record.filename] = _SpooledTable(record)
+            table.add(record)
+        else:
+            self.records[record.filename].append(record)
+
+    def merge(self, other: "Collection"):
+        """append all records of another collection, which must not be used afterwards"""
+        for k, l in other.records.items():
+            self.records[k].extend(l)
+        for k, table in other.spooled_tables.items():
+            if k in self.spooled_tables:
+                self.spooled_tables[k].extend(table)
+            else:
+                self.spooled_tables[k] = table
+        other.records.clear()
+        other.spooled_tables.clear()
 
     def write(self, name, xml_path, dtd_path):
         with ZipFile(name, "w", compression=ZIP_DEFLATED, compresslevel=9) as zf:
@@ -27,5 +116,9 @@ class Collection:
                         w.writerow(r.data)
                 b.seek(0)
                 zf.writestr(k, b.read())
+            for k, table in self.spooled_tables.items():
+                table.copy_to(zf, k)
+                table.close()
+            self.spooled_tables.clear()
             zf.write(xml_path, "index.xml")
             zf.write(dtd_path, "gdpdu-01-08-2002.dtd")
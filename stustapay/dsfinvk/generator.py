@@ -1,9 +1,15 @@
+import asyncio
+import collections
 import contextlib
+import hashlib
+import itertools
 import logging
 import time
 from datetime import datetime
 from decimal import Decimal
+from typing import AsyncIterable, AsyncIterator, Optional
 
+import asyncpg
 from dateutil import parser
 from sftkit.database import Connection
 
@@ -16,7 +22,7 @@ from stustapay.core.service.tree.common import (
 from stustapay.tse.wrapper import PAYMENT_METHOD_TO_ZAHLUNGSART
 
 from ..core.database import get_database
-from .dsfinvk.collection import Collection
+from .dsfinvk.collection import Collection, digest_line
 from .dsfinvk.models import (
     Bonkopf,
     Bonkopf_USt,
@@ -33,6 +39,7 @@ from .dsfinvk.models import (
     Z_Waehrungen,
     Z_Zahlart,
 )
+from .dsfinvk.table import Model
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,6 +55,64 @@ ORDERTYPE_TO_KUNDETYP = {
 }
 
 
+def _shard_closures(closures: list[asyncpg.Record], n_shards: int) -> list[list[asyncpg.Record]]:
+    """
+    Splits the closures sorted by till into at most n_shards consecutive groups of whole tills
+    with roughly the same number of orders.
+    """
+    total_orders = sum(closure["n_orders"] for closure in closures)
+    shards: list[list[asyncpg.Record]] = [[]]
+    n_orders = 0
+    for _, till_closures in itertools.groupby(closures, key=lambda closure: closure["till_id"]):
+        if shards[-1] and len(shards) < n_shards and n_orders >= total_orders * len(shards) / n_shards:
+            shards.append([])
+        for closure in till_closures:
+            shards[-1].append(closure)
+            n_orders += closure["n_orders"]
+    return shards
+
+
+# (till_id, z_nr) in den Listen $2 und $3, für eine Tabelle mit till_id und z_nr
+_SELECTED_CLOSURES = "({0}.till_id, {0}.z_nr) in (select * from unnest($2::bigint[], $3::bigint[]))"
+
+
+class _ClosureRows:
+    """
+    Rows of a query sorted by (till_id, z_nr), handed out per Kassenabschluss.
+    The closures have to be requested in the same order.
+    """
+
+    def __init__(self, rows: AsyncIterable[asyncpg.Record]):
+        self._rows: AsyncIterator[asyncpg.Record] = rows.__aiter__()
+        self._next: Optional[asyncpg.Record] = None
+        self._exhausted = False
+
+    async def take(self, till_id: int, z_nr: int) -> list[asyncpg.Record]:
+        result = []
+        while not self._exhausted:
+            if self._next is None:
+                try:
+                    self._next = await anext(self._rows)
+                except StopAsyncIteration:
+                    self._exhausted = True
+                    break
+            if self._next["till_id"] != till_id or self._next["z_nr"] != z_nr:
+                break
+            result.append(self._next)
+            self._next = None
+        return result
+
+
+class _DigestCollection(Collection):
+    """
+    Only hashes the added records, to verify already exported closures
+    """
+
+    def add(self, record: Model):
+        if self.digest is not None:
+            self.digest.update(digest_line(record))
+
+
 class BNU:
     Brutto = Decimal(0)
     Netto = Decimal(0)
@@ -55,24 +120,47 @@ class BNU:
 
 
 class Generator:
-    def __init__(self, config: Config, event_node_id: int, filename: str, xml: str, dtd: str, simulate: bool):
+    def __init__(
+        self,
+        config: Config,
+        event_node_id: int,
+        filename: str,
+        xml: str,
+        dtd: str,
+        simulate: bool,
+        jobs: int = 1,
+        since_last: bool = False,
+        verify: bool = False,
+    ):
         self.node_id = event_node_id
         self.config = config
         self.filename = filename
         self.xml = xml  # path to index.xml file
         self.dtd = dtd  # path to *.dtd file
-        self.c = Collection()
         self.simulate = simulate
+        self.jobs = jobs  # Anzahl der parallel exportierenden Datenbankverbindungen
+        self.since_last = since_last  # nur Kassenabschlüsse, die noch nicht im Export-Manifest stehen
+        self.verify = verify  # nur die Hashes der Kassenabschlüsse im Export-Manifest prüfen, keine Datei schreiben
+        self.c = self.new_collection()
         self.starttime = time.monotonic()
-        self.GV_SUMME: dict = dict()  # aufsummierte Geschäftsvorfalltypen
         self.PLZ = ""
         self.Street = ""
         self.City = ""
+        # Stammdaten, einmal für alle Kassenabschlüsse geladen
+        self.tax_rates: list[asyncpg.Record] = []
+        self.till_tse_ids: dict[int, Optional[int]] = {}
+        self.till_histories: dict[str, list[asyncpg.Record]] = collections.defaultdict(list)
+        self.tses: dict[int, asyncpg.Record] = {}
+        self.till_z_nrs: dict[int, int] = {}
+        # bereits exportierte Kassenabschlüsse (till_id, z_nr) -> Hash ihrer Datensätze
+        self.manifest: dict[tuple[int, int], str] = {}
+        self.closure_hashes: dict[tuple[int, int], str] = {}
+        self.drifted_closures: list[tuple[int, int]] = []
 
     async def run(self):
         async with contextlib.AsyncExitStack() as es:
             db = get_database(self.config.database)
-            db_pool = await db.create_pool(n_connections=2)
+            db_pool = await db.create_pool(n_connections=self.jobs + 1)
             es.push_async_callback(db_pool.close)
             conn: Connection = await es.enter_async_context(db_pool.acquire())
             node = await fetch_node(conn=conn, node_id=self.node_id)
@@ -90,50 +178,249 @@ class Generator:
                 self.PLZ = bon_addr.split(" ")[2]
                 self.City = bon_addr.split(" ")[3]
 
-            # iteriere über alle Kassen Z_KASSE_ID (= KASSE_SERIENNR bei uns)
-            # alle Kassen mit einer order (und damit auch mit einer TSE und die deshalb ans Finanzamt gemeldet wurden)
-            for row in await conn.fetch(
-                "select distinct o.till_id "
-                "from ordr o "
-                "   join till t on o.till_id = t.id "
-                "   join node n on t.node_id = n.id "
-                "where n.id = $1 or $1 = any(n.parent_ids) "
-                "order by o.till_id",
-                node.id,
-            ):
-                Z_KASSE_ID: int = row["till_id"]
-
-                # iteriere über Kassenabschlüsse Z_NR dieser Kassen
-                for row in await conn.fetch(
-                    "select z_nr from ordr where till_id = $1 group by z_nr order by z_nr", Z_KASSE_ID
-                ):  # alle Kassenabschlussids
-                    Z_NR: int = row["z_nr"]
-
-                    # hole alle order dieser Kasse und Kassenabschluss und nimm den Zeitpunkt der letzten für den Kassenabschluss
-                    last_order_time = await conn.fetchval(
-                        "select booked_at from ordr where till_id = $1 and z_nr = $2 order by id desc", Z_KASSE_ID, Z_NR
-                    )
-                    Z_ERSTELLUNG: datetime = last_order_time
-
-                    # sammle Einzelaufzeichnungsmodul
-                    await self.einzelaufzeichnungsmodul(
-                        conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, event_settings=event_settings
-                    )
-                    # sammle Stammdatenmodul
-                    await self.stammdatenmodul(
-                        conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, node=node, event_settings=event_settings
-                    )
-                    # sammle Kassenabschlussmodul
-                    await self.kassenabschlussmodul(conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, event_settings=event_settings)
-
-            self.finalize()  # schreibe die Datei
+            # jede DSFinV-K Tabelle wird mit einer einzigen, nach (till_id, z_nr) sortierten Abfrage gelesen
+            # und beim Durchlaufen der Kassenabschlüsse gruppiert
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                await self.export(db_pool, conn, node=node, event_settings=event_settings)
+
+            if self.verify:
+                self.check_manifest()
+            else:
+                phase_start = time.monotonic()
+                self.finalize()  # schreibe die Datei
+                LOGGER.info(f"Datei geschrieben: {time.monotonic() - phase_start:.3f}s")
+                if not self.simulate:
+                    await self.record_manifest(conn, node=node)
             LOGGER.info(f"Duration: {time.monotonic() - self.starttime:.3f}s")
             return
 
-    async def einzelaufzeichnungsmodul(
-        self, conn, Z_NR: int, Z_ERSTELLUNG: datetime, Z_KASSE_ID: int, event_settings: RestrictedEventSettings
+    async def export(
+        self, db_pool: asyncpg.Pool, conn: Connection, node: Node, event_settings: RestrictedEventSettings
     ):
-        self.GV_SUMME = {
+        phase_start = time.monotonic()
+        # iteriere über alle Kassen Z_KASSE_ID (= KASSE_SERIENNR bei uns) und deren Kassenabschlüsse Z_NR
+        # alle Kassen mit einer order (und damit auch mit einer TSE und die deshalb ans Finanzamt gemeldet wurden)
+        # Z_ERSTELLUNG ist der Zeitpunkt der letzten order des Kassenabschlusses
+        closures = await conn.fetch(
+            "select "
+            "   o.till_id, o.z_nr, min(o.id) as z_start_id, max(o.id) as z_ende_id, count(*) as n_orders, "
+            "   (array_agg(o.booked_at order by o.id desc))[1] as z_erstellung "
+            "from ordr o "
+            "   join till t on o.till_id = t.id "
+            "   join node n on t.node_id = n.id "
+            "where n.id = $1 or $1 = any(n.parent_ids) "
+            "group by o.till_id, o.z_nr "
+            "order by o.till_id, o.z_nr",
+            node.id,
+        )
+        self.manifest = {
+            (row["till_id"], row["z_nr"]): row["content_hash"]
+            for row in await conn.fetch(
+                "select till_id, z_nr, content_hash from dsfinvk_exported_closure where node_id = $1", node.id
+            )
+        }
+        if self.verify:
+            closures = [closure for closure in closures if (closure["till_id"], closure["z_nr"]) in self.manifest]
+        elif self.since_last:
+            closures = [closure for closure in closures if (closure["till_id"], closure["z_nr"]) not in self.manifest]
+        till_ids = sorted({closure["till_id"] for closure in closures})
+        await self.fetch_stammdaten(conn, node=node, till_ids=till_ids)
+        LOGGER.info(
+            f"Kassenabschlüsse und Stammdaten: {len(closures)} Abschlüsse von {len(till_ids)} Kassen "
+            f"in {time.monotonic() - phase_start:.3f}s"
+        )
+
+        phase_start = time.monotonic()
+        shards = _shard_closures(closures, self.jobs)
+        if len(shards) == 1:
+            shard_collections = [await self.export_closures(conn, shards[0], event_settings=event_settings)]
+        else:
+            # alle Worker lesen denselben Datenbankstand wie diese Transaktion
+            snapshot = await conn.fetchval("select pg_export_snapshot()")
+            shard_collections = await asyncio.gather(
+                *(
+                    self.export_shard(db_pool, snapshot, shard_closures, event_settings=event_settings)
+                    for shard_closures in shards
+                )
+            )
+        LOGGER.info(f"Export in {len(shards)} Teilen: {time.monotonic() - phase_start:.3f}s")
+
+        # die Teile sind nach Kassen sortiert, aneinandergehängt ergeben sie dieselben Tabellen wie ein einzelner Export
+        for shard_collection in shard_collections:
+            self.c.merge(shard_collection)
+
+    async def export_shard(
+        self,
+        db_pool: asyncpg.Pool,
+        snapshot: str,
+        closures: list[asyncpg.Record],
+        event_settings: RestrictedEventSettings,
+    ) -> Collection:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                await conn.execute(f"set transaction snapshot '{snapshot}'")
+                return await self.export_closures(conn, closures, event_settings=event_settings)
+
+    async def export_closures(
+        self, conn: Connection, closures: list[asyncpg.Record], event_settings: RestrictedEventSettings
+    ) -> Collection:
+        shard_start = time.monotonic()
+        collection = self.new_collection()
+        till_ids = sorted({closure["till_id"] for closure in closures})
+        # nur die angefragten Kassenabschlüsse, z.B. nicht die bereits exportierten bei --since-last
+        closure_keys = (
+            till_ids,
+            [closure["till_id"] for closure in closures],
+            [closure["z_nr"] for closure in closures],
+        )
+
+        # Summen je Zahlart über die line_items aller orders eines Kassenabschlusses
+        payments = _ClosureRows(
+            conn.cursor(
+                "select o.till_id, o.z_nr, o.payment_method, sum(li.total_price) as total_price "
+                "from line_item li join ordr o on li.order_id = o.id "
+                f"where o.till_id = any($1) and {_SELECTED_CLOSURES.format('o')} "
+                "group by o.till_id, o.z_nr, o.payment_method "
+                "order by o.till_id, o.z_nr, o.payment_method",
+                *closure_keys,
+            )
+        )
+        orders = _ClosureRows(
+            conn.cursor(
+                f"""
+                select
+                    ordr.id,
+                    ordr.till_id,
+                    ordr.z_nr,
+                    ordr.payment_method,
+                    ordr.cash_register_id,
+                    ordr.cancels_order,
+                    tse_signature.tse_start,
+                    tse_signature.tse_end,
+                    tse_signature.tse_id,
+                    tse_signature.tse_transaction,
+                    tse_signature.transaction_process_type,
+                    tse_signature.tse_signaturenr,
+                    tse_signature.transaction_process_data,
+                    tse_signature.tse_signature,
+                    ordr.cashier_id,
+                    ordr.customer_account_id,
+                    ordr.order_type,
+                    ordr.item_count,
+                    tse_signature.signature_status,
+                    tse_signature.result_message,
+                    order_value.total_price,
+                    order_value.line_items
+                from
+                    ordr
+                join
+                    tse_signature on ordr.id=tse_signature.id
+                join
+                    order_value on ordr.id=order_value.id
+                where
+                    ordr.till_id = any($1)
+                    and {_SELECTED_CLOSURES.format('ordr')}
+                order by
+                    ordr.till_id, ordr.z_nr, ordr.id
+                """,
+                *closure_keys,
+            )
+        )
+        tax_rates = _ClosureRows(
+            conn.cursor(
+                "select till_id, z_nr, id, tax_name, total_price, total_tax, total_no_tax "
+                "from order_tax_rates "
+                f"where till_id = any($1) and {_SELECTED_CLOSURES.format('order_tax_rates')} "
+                "order by till_id, z_nr, id, tax_rate, tax_name",
+                *closure_keys,
+            )
+        )
+
+        for closure in closures:
+            Z_KASSE_ID: int = closure["till_id"]
+            Z_NR: int = closure["z_nr"]
+            Z_ERSTELLUNG: datetime = closure["z_erstellung"]
+            collection.digest = hashlib.sha256()
+            closure_payments = await payments.take(Z_KASSE_ID, Z_NR)
+            closure_tax_rates: dict[int, list[asyncpg.Record]] = collections.defaultdict(list)
+            for row in await tax_rates.take(Z_KASSE_ID, Z_NR):
+                closure_tax_rates[row["id"]].append(row)
+
+            # sammle Einzelaufzeichnungsmodul
+            GV_SUMME = self.einzelaufzeichnungsmodul(
+                collection,
+                Z_NR,
+                Z_ERSTELLUNG,
+                Z_KASSE_ID,
+                orders=await orders.take(Z_KASSE_ID, Z_NR),
+                tax_rates=closure_tax_rates,
+                event_settings=event_settings,
+            )
+            # sammle Stammdatenmodul
+            self.stammdatenmodul(
+                collection,
+                Z_NR,
+                Z_ERSTELLUNG,
+                Z_KASSE_ID,
+                closure=closure,
+                payments=closure_payments,
+                event_settings=event_settings,
+            )
+            # sammle Kassenabschlussmodul
+            self.kassenabschlussmodul(
+                collection,
+                Z_NR,
+                Z_ERSTELLUNG,
+                Z_KASSE_ID,
+                payments=closure_payments,
+                GV_SUMME=GV_SUMME,
+                event_settings=event_settings,
+            )
+            self.closure_hashes[(Z_KASSE_ID, Z_NR)] = collection.digest.hexdigest()
+
+        collection.digest = None
+
+        if till_ids:
+            LOGGER.info(
+                f"Kassen {till_ids[0]} bis {till_ids[-1]}: {len(closures)} Abschlüsse "
+                f"in {time.monotonic() - shard_start:.3f}s"
+            )
+        return collection
+
+    async def fetch_stammdaten(self, conn: Connection, node: Node, till_ids: list[int]):
+        # Stammdaten sind klein und werden für jeden Kassenabschluss wieder gebraucht
+        self.tax_rates = await conn.fetch("select name, rate, description from tax_rate where node_id = $1", node.id)
+        for row in await conn.fetch("select id, tse_id, z_nr from till where id = any($1)", till_ids):
+            self.till_tse_ids[row["id"]] = row["tse_id"]
+            self.till_z_nrs[row["id"]] = row["z_nr"]
+        for row in await conn.fetch(
+            "select till_id, what, tse_id, z_nr, date from till_tse_history where till_id = any($1) order by till_id, z_nr",
+            [str(till_id) for till_id in till_ids],
+        ):
+            self.till_histories[row["till_id"]].append(row)
+        tse_ids = {tse_id for tse_id in self.till_tse_ids.values() if tse_id is not None}
+        tse_ids.update(row["tse_id"] for history in self.till_histories.values() for row in history)
+        self.tses = {
+            row["id"]: row
+            for row in await conn.fetch(
+                "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
+                "   tse.public_key, tse.certificate "
+                "from tse where id = any($1)",
+                list(tse_ids),
+            )
+        }
+
+    def einzelaufzeichnungsmodul(
+        self,
+        collection: Collection,
+        Z_NR: int,
+        Z_ERSTELLUNG: datetime,
+        Z_KASSE_ID: int,
+        orders: list[asyncpg.Record],
+        tax_rates: dict[int, list[asyncpg.Record]],
+        event_settings: RestrictedEventSettings,
+    ):
+        GV_SUMME = {  # aufsummierte Geschäftsvorfalltypen
             "MehrzweckgutscheinKauf": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
             "Geldtransit": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
             "DifferenzSollIst": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
@@ -147,45 +434,8 @@ class Generator:
         ### b transactions_tse.csv ###
         ### c transactions_vat.csv ###
         ### d datapayment.csv ###
-        # alle orders für diese Kasse und Abschluss abfragen:
-        for row in await conn.fetch(
-            """
-            select
-                ordr.id,
-                ordr.payment_method,
-                ordr.cash_register_id,
-                ordr.cancels_order,
-                tse_signature.tse_start,
-                tse_signature.tse_end,
-                tse_signature.tse_id,
-                tse_signature.tse_transaction,
-                tse_signature.transaction_process_type,
-                tse_signature.tse_signaturenr,
-                tse_signature.transaction_process_data,
-                tse_signature.tse_signature,
-                ordr.cashier_id,
-                ordr.customer_account_id,
-                ordr.order_type,
-                ordr.item_count,
-                tse_signature.signature_status,
-                tse_signature.result_message,
-                order_value.total_price,
-                order_value.line_items
-            from
-                ordr
-            join
-                tse_signature on ordr.id=tse_signature.id
-            join
-                order_value on ordr.id=order_value.id
-            where
-                ordr.till_id = $1
-                and ordr.z_nr = $2
-            order by
-                ordr.id
-            """,
-            Z_KASSE_ID,
-            Z_NR,
-        ):
+        # alle orders für diese Kasse und Abschluss:
+        for row in orders:
             if row["signature_status"] == "new" or row["signature_status"] == "pending":
                 LOGGER.warning("Nicht Signierte Transaktion, wird nicht exportiert")
                 continue  # signatur noch nicht fertig
@@ -235,12 +485,8 @@ class Generator:
                 pass
 
             # einmal über alle Umsatzsteuersätze je Order iterieren
-            # leider müssen wir da wieder eine db abfrage machen....
             if row["item_count"] != 0:
-                for line in await conn.fetch(
-                    "select tax_name, total_price, total_tax, total_no_tax from order_tax_rates where id = $1",
-                    row["id"],
-                ):
+                for line in tax_rates[row["id"]]:
                     c = Bonkopf_USt()
                     c.Z_KASSE_ID = Z_KASSE_ID
                     c.Z_ERSTELLUNG = Z_ERSTELLUNG
@@ -252,7 +498,7 @@ class Generator:
                     c.BON_NETTO = Decimal(line["total_no_tax"])
                     c.BON_UST = Decimal(line["total_tax"])
 
-                    self.c.add(c)
+                    collection.add(c)
             else:
                 LOGGER.warning(f"Order {row['id']} has no line_items...")
 
@@ -270,10 +516,10 @@ class Generator:
             d.KASSENSCHUBLADENNR = row[
                 "cash_register_id"
             ]  # Nummer der Kassenschublade (nur bei Kassen, die Bargeld annehmen), Eigenkreation in Anlehnung an FAQ vom Bundesfinanzministerium zum Kassengesetz
-            self.c.add(d)
+            collection.add(d)
 
-            self.c.add(a)
-            self.c.add(b)
+            collection.add(a)
+            collection.add(b)
             ### /datapayment.csv ###
             ### /transactions_vat.csv ###
             ### /transactions_tse.csv ###
@@ -326,13 +572,11 @@ class Generator:
                 else:
                     gvtyp = "Umsatz"  # alles andere
 
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Brutto += Decimal(
+                GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Brutto += Decimal(
                     item["total_price"]
                 )
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].USt += Decimal(
-                    item["total_tax"]
-                )
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Netto += Decimal(
+                GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].USt += Decimal(item["total_tax"])
+                GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Netto += Decimal(
                     item["total_price"]
                 ) - Decimal(item["total_tax"])
                 e.GV_TYP = gvtyp
@@ -350,8 +594,8 @@ class Generator:
                 f.POS_UST = Decimal(item["total_tax"])
                 f.POS_NETTO = Decimal(item["total_price"]) - Decimal(item["total_tax"])
 
-                self.c.add(e)
-                self.c.add(f)
+                collection.add(e)
+                collection.add(f)
 
             ### /lines.csv ###
 
@@ -362,15 +606,16 @@ class Generator:
             # a.Z_NR = Z_NR
             ### /itemamounts.csv ###
 
-        return
+        return GV_SUMME
 
-    async def stammdatenmodul(
+    def stammdatenmodul(
         self,
-        conn: Connection,
+        collection: Collection,
         Z_NR: int,
         Z_ERSTELLUNG: datetime,
         Z_KASSE_ID: int,
-        node: Node,
+        closure: asyncpg.Record,
+        payments: list[asyncpg.Record],
         event_settings: RestrictedEventSettings,
     ):
         ### cashpointclosing.csv ###
@@ -388,21 +633,12 @@ class Generator:
         a.STNR = ""
         a.USTID = event_settings.ust_id
 
-        a.Z_START_ID = await conn.fetchval(
-            "select id from ordr where ordr.till_id = $1 and ordr.z_nr = $2 order by ordr.id asc", Z_KASSE_ID, Z_NR
-        )  # erste BON_ID in diesem Abschluss
-        a.Z_ENDE_ID = await conn.fetchval(
-            "select id from ordr where ordr.till_id = $1 and ordr.z_nr = $2 order by ordr.id desc", Z_KASSE_ID, Z_NR
-        )  # letzte BON_ID in diesem Abschluss
+        a.Z_START_ID = closure["z_start_id"]  # erste BON_ID in diesem Abschluss
+        a.Z_ENDE_ID = closure["z_ende_id"]  # letzte BON_ID in diesem Abschluss
 
         Z_SE_ZAHLUNGEN = Decimal()
         Z_SE_BARZAHLUNGEN = Decimal()
-        for row in await conn.fetch(
-            "select total_price, payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2",
-            Z_KASSE_ID,
-            Z_NR,
-        ):
+        for row in payments:
             Z_SE_ZAHLUNGEN += Decimal(row["total_price"])
             if PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]] == "Bar":
                 Z_SE_BARZAHLUNGEN += Decimal(row["total_price"])
@@ -410,7 +646,7 @@ class Generator:
         a.Z_SE_ZAHLUNGEN = Z_SE_ZAHLUNGEN  # Summe alle Zahlungen dieser Kasse für diesen Kassenabschluss
         a.Z_SE_BARZAHLUNGEN = Z_SE_BARZAHLUNGEN  # Summe alle Barzahlungen dieser Kasse für diesen Kassenabschluss
 
-        self.c.add(a)
+        collection.add(a)
         ### \cashpointclosing.csv ###
 
         ### locations.csv ###
@@ -427,7 +663,7 @@ class Generator:
         a.LOC_LAND = "DEU"  # sorry, not in db -> hardcoded
         a.USTID = event_settings.ust_id
 
-        self.c.add(a)
+        collection.add(a)
         ### \locations.csv ###
 
         ### cashregister.csv ###
@@ -443,11 +679,11 @@ class Generator:
         a.KASSE_BASISWAEH_CODE = event_settings.currency_identifier
         a.KASSE_UST_ZUORDNUNG = ""  # puh?
 
-        self.c.add(a)
+        collection.add(a)
         ### \cashregister.csv ###
 
         ### vat.csv ###
-        for row in await conn.fetch("select name, rate, description from tax_rate where node_id = $1", node.id):
+        for row in self.tax_rates:
             a = Stamm_USt()
             a.Z_KASSE_ID = Z_KASSE_ID
             a.Z_ERSTELLUNG = Z_ERSTELLUNG
@@ -456,7 +692,7 @@ class Generator:
             a.UST_SCHLUESSEL = TAXNAME_TO_SCHLUESSELNUMMER[row["name"]]
             a.UST_SATZ = Decimal(row["rate"] * 100)
             a.UST_BESCHR = row["description"]
-            self.c.add(a)
+            collection.add(a)
 
         ### \vat.csv ###
 
@@ -467,30 +703,23 @@ class Generator:
         a.Z_NR = Z_NR
 
         # Prüfe, ob diese Kasse verschiedene TSEs hatte, wenn nicht, dann müssen wir nichts weiter tun. Das sollte der Normalfall sein:
-        till_history = await conn.fetch(
-            "select what, tse_id, z_nr, date from till_tse_history where till_id = $1 order by z_nr", str(Z_KASSE_ID)
-        )
+        till_history = self.till_histories[str(Z_KASSE_ID)]
         tses = list()
         for entry in till_history:
             if entry["what"] == "register":
                 tses.append(entry["tse_id"])
         if len(tses) == 1:
             # Fall, dass wir nur eine TSE für diese Kasse haben: Einfach
-            row = await conn.fetchrow(
-                "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, tse.public_key, tse.certificate "
-                "from till join tse on till.tse_id = tse.id where till.id = $1",
-                Z_KASSE_ID,
-            )
+            # es sei denn, die Kasse wurde schon auf eine andere TSE verschoben, auf der sie noch nicht registriert ist
+            aktuelle_tse_id = self.till_tse_ids[Z_KASSE_ID]
+            row = self.tses.get(aktuelle_tse_id) if aktuelle_tse_id in tses else None
 
             # oh gott, es gibt noch einen Fall: eine Kasse wird von der defekten TSE geschoben, aber hat noch keine Buchung gemacht und somit noch keine neue TSE erhalten -> das Feld tse_id in till ist Null
-            # damit schlägt natürlich der join fehl und es kommt None zurück.
+            # damit schlägt natürlich der join fehl und es kommt None zurück. Genauso bei einer verschobenen Kasse (s.o.).
             if row is None:
                 # jetze müssen wir in der history nachschauen, auf welcher TSE diese Kasse registriert war, kann natürlich auch wieder mehrere geben, ahrg
                 # dazu kopieren wir jetzt einfach den code von unten
-                kassenschlussgrenzen = await conn.fetch(
-                    "select z_nr from till_tse_history where till_id = $1 and what = 'register' order by z_nr",
-                    str(Z_KASSE_ID),
-                )
+                kassenschlussgrenzen = [entry for entry in till_history if entry["what"] == "register"]
                 aeltereschluesse = list()
 
                 for schluss in kassenschlussgrenzen:
@@ -499,22 +728,15 @@ class Generator:
                         aeltereschluesse.append(schluss["z_nr"])
                 # nimm jetzt den größten weil ältesten Kassenschluss in der Liste und hole die TSE
                 aeltereschluesse.sort(reverse=True)
-                aktuelle_tse_id = await conn.fetchval(
-                    "select tse_id from till_tse_history where till_id = $1 and what = 'register' and z_nr = $2",
-                    str(Z_KASSE_ID),
-                    aeltereschluesse[0],
+                aktuelle_tse_id = next(
+                    entry["tse_id"] for entry in kassenschlussgrenzen if entry["z_nr"] == aeltereschluesse[0]
                 )
                 print(
                     f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id} und wurde bisher noch nicht auf eine neue TSE registriert"
                 )
 
                 # und jetzt die stammdaten dieser TSE
-                row = await conn.fetchrow(
-                    "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
-                    "   tse.public_key, tse.certificate "
-                    "from tse where id = $1",
-                    aktuelle_tse_id,
-                )
+                row = self.tses.get(aktuelle_tse_id)
 
         elif len(tses) == 0:
             print(f"Kasse {Z_KASSE_ID} wurde bei keiner TSE registriert")
@@ -524,10 +746,7 @@ class Generator:
             # Fall, dass bei dieser Kasse die TSE gewechselt wurde: Kompliziert :(
             # Erstens: Herausfinden, welche TSE für diesen Kassenschluss zuständig war:
             # ich habe mehrere Einträge, davon muss ich den mit dem kleinsten z_nr nehmen und vergleichen, ob der größer gleich dem aktuellen z_nr ist.
-            kassenschlussgrenzen = await conn.fetch(
-                "select z_nr from till_tse_history where till_id = $1 and what = 'register' order by z_nr",
-                str(Z_KASSE_ID),
-            )
+            kassenschlussgrenzen = [entry for entry in till_history if entry["what"] == "register"]
             aeltereschluesse = list()
 
             for schluss in kassenschlussgrenzen:
@@ -536,20 +755,13 @@ class Generator:
                     aeltereschluesse.append(schluss["z_nr"])
             # nimm jetzt den größten weil ältesten Kassenschluss in der Liste und hole die TSE
             aeltereschluesse.sort(reverse=True)
-            aktuelle_tse_id = await conn.fetchval(
-                "select tse_id from till_tse_history where till_id = $1 and what = 'register' and z_nr = $2",
-                str(Z_KASSE_ID),
-                aeltereschluesse[0],
+            aktuelle_tse_id = next(
+                entry["tse_id"] for entry in kassenschlussgrenzen if entry["z_nr"] == aeltereschluesse[0]
             )
             print(f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id}")
 
             # und jetzt die stammdaten dieser TSE
-            row = await conn.fetchrow(
-                "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
-                "   tse.public_key, tse.certificate "
-                "from tse where id = $1",
-                aktuelle_tse_id,
-            )
+            row = self.tses.get(aktuelle_tse_id)
 
         # LOGGER.info(row)
         # LOGGER.info(f'Z_KASSE_ID: {Z_KASSE_ID}, Z_NR: {Z_NR}')
@@ -585,43 +797,34 @@ class Generator:
             )
             raise NotImplementedError
 
-        self.c.add(a)
+        collection.add(a)
         ### \tse.csv ###
 
         return
 
-    async def kassenabschlussmodul(
+    def kassenabschlussmodul(
         self,
-        conn: Connection,
+        collection: Collection,
         Z_NR: int,
         Z_ERSTELLUNG: datetime,
         Z_KASSE_ID: int,
+        payments: list[asyncpg.Record],
+        GV_SUMME: dict,
         event_settings: RestrictedEventSettings,
     ):
-        paymentmethods = await conn.fetch(
-            "select payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2 group by payment_method",
-            Z_KASSE_ID,
-            Z_NR,
-        )
         barzahlungen = Decimal(0)
         summe_je_zahlart = dict()
-        for method in paymentmethods:
+        for method in payments:
             summe_je_zahlart[str(method["payment_method"])] = Decimal(0)
 
-        for row in await conn.fetch(
-            "select total_price, payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2",
-            Z_KASSE_ID,
-            Z_NR,
-        ):
+        for row in payments:
             summe_je_zahlart[row["payment_method"]] += Decimal(row["total_price"])
             if PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]] == "Bar":
                 barzahlungen += Decimal(row["total_price"])
 
         ### businesscases.csv###
         # wir iterieren über die daten die wir in im einzelaufzeichnungsmodul aggregiert haben
-        for gvtyp, summe in self.GV_SUMME.items():
+        for gvtyp, summe in GV_SUMME.items():
             for schluessel, betrag in summe.items():
                 a = Z_GV_Typ()
                 a.Z_KASSE_ID = Z_KASSE_ID
@@ -635,11 +838,11 @@ class Generator:
                 a.Z_UMS_NETTO = betrag.Netto
                 a.Z_UST = betrag.USt
                 if betrag.Brutto != 0:
-                    self.c.add(a)
+                    collection.add(a)
         ### \businesscases.csv###
 
         ### payment.csv###
-        for typ in paymentmethods:
+        for typ in payments:
             a = Z_Zahlart()
             a.Z_KASSE_ID = Z_KASSE_ID
             a.Z_ERSTELLUNG = Z_ERSTELLUNG
@@ -647,7 +850,7 @@ class Generator:
             a.ZAHLART_TYP = PAYMENT_METHOD_TO_ZAHLUNGSART[typ["payment_method"]]
             a.ZAHLART_NAME = typ["payment_method"]
             a.Z_ZAHLART_BETRAG = summe_je_zahlart[typ["payment_method"]]
-            self.c.add(a)
+            collection.add(a)
         ### \payment.csv###
 
         ### cash_per_currency.csv###
@@ -657,13 +860,46 @@ class Generator:
         a.Z_NR = Z_NR
         a.ZAHLART_WAEH = event_settings.currency_identifier
         a.ZAHLART_BETRAG_WAEH = barzahlungen  # Gesamtsumme der Barzahlungen je Währung (... wir nehmen nur eine!)
-        self.c.add(a)
+        collection.add(a)
         ### \cash_per_currency.csv###
 
         return
 
     ################################################################################################################
 
+    def new_collection(self) -> Collection:
+        if self.verify:
+            return _DigestCollection()
+        # the records of a real export are streamed to disk instead of being kept until the zip is written
+        return Collection(streaming=not self.simulate)
+
+    async def record_manifest(self, conn: Connection, node: Node):
+        # nur abgeschlossene Kassenabschlüsse ändern sich nicht mehr, der aktuelle einer Kasse wird beim nächsten Mal
+        # wieder exportiert
+        closed = [
+            (node.id, till_id, z_nr, content_hash)
+            for (till_id, z_nr), content_hash in self.closure_hashes.items()
+            if z_nr < self.till_z_nrs[till_id]
+        ]
+        await conn.executemany(
+            "insert into dsfinvk_exported_closure (node_id, till_id, z_nr, content_hash) values ($1, $2, $3, $4) "
+            "on conflict do nothing",
+            closed,
+        )
+        LOGGER.info(f"{len(closed)} abgeschlossene Kassenabschlüsse im Export-Manifest")
+
+    def check_manifest(self):
+        for closure, content_hash in sorted(self.manifest.items()):
+            if closure not in self.closure_hashes:
+                LOGGER.error(f"Kasse {closure[0]} Abschluss {closure[1]}: exportiert, aber nicht mehr vorhanden")
+                self.drifted_closures.append(closure)
+            elif self.closure_hashes[closure] != content_hash:
+                LOGGER.error(f"Kasse {closure[0]} Abschluss {closure[1]}: Daten seit dem Export verändert")
+                self.drifted_closures.append(closure)
+        LOGGER.info(
+            f"{len(self.manifest)} exportierte Kassenabschlüsse geprüft, {len(self.drifted_closures)} verändert"
+        )
+
     def finalize(self):
         if not self.simulate:
             LOGGER.info("write file")
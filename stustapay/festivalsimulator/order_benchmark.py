@@ -0,0 +1,82 @@
+import logging
+import time
+
+from stustapay.core.config import Config
+from stustapay.core.database import get_database
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBenchmark:
+    """
+    Compares the full order projection including the line item json with the lean order summary when listing all
+    orders of a node.
+
+    The node's orders are padded to n_orders by copying one of its existing orders with all line items inside a
+    transaction which is rolled back at the end, the database is left untouched.
+    """
+
+    def __init__(self, config: Config, node_id: int, n_orders: int, n_repetitions: int):
+        self.config = config
+        self.node_id = node_id
+        self.n_orders = n_orders
+        self.n_repetitions = n_repetitions
+
+    async def run(self):
+        db = get_database(self.config.database)
+        db_pool = await db.create_pool(n_connections=1)
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    template_order_id = await conn.fetchval(
+                        "select o.id from order_summaries_at_node_and_children($1) o where o.item_count > 0 limit 1",
+                        self.node_id,
+                    )
+                    if template_order_id is None:
+                        logger.error(f"Node {self.node_id} has no orders to copy, run a festival simulation first")
+                        return
+                    n_existing = await conn.fetchval(
+                        "select count(*) from order_summaries_at_node_and_children($1)", self.node_id
+                    )
+                    await conn.execute(
+                        "with new_order as ( "
+                        "   insert into ordr ( "
+                        "       item_count, booked_at, payment_method, z_nr, order_type, cashier_id, cash_register_id, "
+                        "       till_id, customer_account_id "
+                        "   ) "
+                        "   select "
+                        "       o.item_count, o.booked_at, o.payment_method, o.z_nr, o.order_type, o.cashier_id, "
+                        "       o.cash_register_id, o.till_id, o.customer_account_id "
+                        "   from ordr o, generate_series(1, $2) "
+                        "   where o.id = $1 "
+                        "   returning id "
+                        ") "
+                        "insert into line_item (order_id, item_id, product_id, product_price, quantity, tax_name, "
+                        "   tax_rate, tax_rate_id) "
+                        "select n.id, l.item_id, l.product_id, l.product_price, l.quantity, l.tax_name, l.tax_rate, "
+                        "   l.tax_rate_id "
+                        "from new_order n, line_item l where l.order_id = $1",
+                        template_order_id,
+                        max(self.n_orders - n_existing, 0),
+                    )
+                    await conn.execute("analyze ordr")
+                    await conn.execute("analyze line_item")
+
+                    for function in ("orders_at_node_and_children", "order_summaries_at_node_and_children"):
+                        start = time.monotonic()
+                        for _ in range(self.n_repetitions):
+                            await conn.fetch(f"select * from {function}($1)", self.node_id)
+                        duration = time.monotonic() - start
+                        logger.info(
+                            f"{function}: {duration / self.n_repetitions * 1000:.1f} ms per listing of "
+                            f"{max(self.n_orders, n_existing)} orders ({self.n_repetitions} repetitions)"
+                        )
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            await db_pool.close()
+
+
+class _Rollback(Exception):
+    pass
@@ -0,0 +1,65 @@
+import logging
+import random
+import time
+
+from stustapay.core.config import Config
+from stustapay.core.database import get_database
+from stustapay.core.schema.tree import ROOT_NODE_ID, ObjectType
+
+logger = logging.getLogger(__name__)
+
+
+class TreeBenchmark:
+    """
+    Measures the cost of looking up single nodes with their computed forbidden objects for growing node trees.
+
+    All nodes are created inside a transaction which is rolled back at the end, the database is left untouched.
+    """
+
+    def __init__(self, config: Config, node_counts: list[int], branching: int, n_lookups: int):
+        self.config = config
+        self.node_counts = sorted(node_counts)
+        self.branching = branching
+        self.n_lookups = n_lookups
+
+    async def run(self):
+        db = get_database(self.config.database)
+        db_pool = await db.create_pool(n_connections=1)
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    node_ids: list[int] = []
+                    for node_count in self.node_counts:
+                        while len(node_ids) < node_count:
+                            parent = node_ids[(len(node_ids) - 1) // self.branching] if node_ids else ROOT_NODE_ID
+                            node_id = await conn.fetchval(
+                                "insert into node (parent, name) values ($1, $2) returning id",
+                                parent,
+                                f"benchmark-node-{len(node_ids)}",
+                            )
+                            if len(node_ids) % 10 == 0:
+                                await conn.execute(
+                                    "insert into forbidden_objects_in_subtree_at_node (object_name, node_id) "
+                                    "values ($1, $2)",
+                                    ObjectType.ticket.value,
+                                    node_id,
+                                )
+                            node_ids.append(node_id)
+
+                        start = time.monotonic()
+                        for node_id in random.choices(node_ids, k=self.n_lookups):
+                            await conn.fetchrow("select * from node_with_allowed_objects where id = $1", node_id)
+                        duration = time.monotonic() - start
+                        logger.info(
+                            f"{node_count} nodes: {duration / self.n_lookups * 1000:.3f} ms per node lookup "
+                            f"({self.n_lookups} lookups)"
+                        )
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            await db_pool.close()
+
+
+class _Rollback(Exception):
+    pass
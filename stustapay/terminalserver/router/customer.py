@@ -1,4 +1,6 @@
-from fastapi import APIRouter
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Query
 from pydantic import BaseModel
 
 from stustapay.core.http.auth_till import CurrentAuthToken
@@ -51,5 +53,9 @@ async def get_customer_orders(
     token: CurrentAuthToken,
     customer_tag_uid: int,
     till_service: ContextTillService,
+    before_id: Optional[int] = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
 ):
-    return await till_service.get_customer_orders(token=token, customer_tag_uid=customer_tag_uid)
+    return await till_service.get_customer_orders(
+        token=token, customer_tag_uid=customer_tag_uid, before_id=before_id, limit=limit
+    )
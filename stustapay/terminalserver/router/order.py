@@ -2,9 +2,9 @@
 purchase ordering.
 """
 
-from typing import Optional
+from typing import Annotated, Optional
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
 
 from stustapay.core.http.auth_till import CurrentAuthToken
 from stustapay.core.http.context import ContextOrderService
@@ -33,11 +33,13 @@ router = APIRouter(prefix="/order", tags=["order"])
 async def list_orders(
     token: CurrentAuthToken,
     order_service: ContextOrderService,
+    before_id: Optional[int] = None,
+    limit: Annotated[Optional[int], Query(ge=1)] = None,
 ):
     """
-    List all the order of the currently logged in Cashier
+    List all the order of the currently logged in Cashier, newest first
     """
-    return await order_service.list_orders_terminal(token=token)
+    return await order_service.list_orders_terminal(token=token, before_id=before_id, limit=limit)
 
 
 @router.post("/check-sale", summary="check if a sale is valid", response_model=PendingSale)
@@ -16,9 +16,15 @@ from stustapay.core.healthcheck import run_healthcheck
 from stustapay.core.http.context import Context
 from stustapay.core.service.account import AccountService
 from stustapay.core.service.auth import AuthService
+from stustapay.core.service.common.cache import (
+    run_cache_stats_logging,
+    run_node_cache_invalidation,
+    run_token_cache_invalidation,
+)
 from stustapay.core.service.order import OrderService
 from stustapay.core.service.terminal import TerminalService
 from stustapay.core.service.till import TillService
+from stustapay.core.service.tree.common import run_node_tree_cache
 from stustapay.core.service.user import UserService
 from stustapay.terminalserver.router import (
     auth,
@@ -85,6 +91,10 @@ class Api:
         )
         try:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="terminalserver")))
+            self.server.add_task(asyncio.create_task(run_node_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_node_tree_cache(db_pool)))
+            self.server.add_task(asyncio.create_task(run_token_cache_invalidation(db_pool)))
+            self.server.add_task(asyncio.create_task(run_cache_stats_logging()))
             await self.server.run(context)
         finally:
             await db_pool.close()
@@ -36,6 +36,7 @@ from stustapay.core.schema.tree import (
     Node,
     RestrictedEventSettings,
 )
+from stustapay.core.schema.tse import NewTse, Tse, TseStatus, TseType
 from stustapay.core.schema.user import (
     ADMIN_ROLE_ID,
     NewUser,
@@ -63,6 +64,7 @@ from stustapay.core.service.tree.common import (
     fetch_restricted_event_settings_for_node,
 )
 from stustapay.core.service.tree.service import TreeService, create_event
+from stustapay.core.service.tse import TseService
 from stustapay.core.service.user import UserService, associate_user_to_role
 from stustapay.core.service.user_tag import UserTagService
 
@@ -294,6 +296,11 @@ async def tax_rate_service(
     return TaxRateService(db_pool=setup_test_db_pool, config=config, auth_service=auth_service)
 
 
+@pytest.fixture(scope="session")
+async def tse_service(setup_test_db_pool: asyncpg.Pool, config: Config, auth_service: AuthService) -> TseService:
+    return TseService(db_pool=setup_test_db_pool, config=config, auth_service=auth_service)
+
+
 @pytest.fixture(scope="session")
 async def customer_service(
     setup_test_db_pool: asyncpg.Pool, config: Config, auth_service: AuthService, config_service: ConfigService
@@ -522,3 +529,76 @@ async def till(
         node_id=event_node.id,
         till=NewTill(name="test-till", active_profile_id=till_profile.id, terminal_id=terminal.id),
     )
+
+
+class CreateTse(Protocol):
+    def __call__(self, status: TseStatus = ...) -> Awaitable[Tse]: ...
+
+
+@pytest.fixture
+async def create_tse(
+    db_connection: Connection, tse_service: TseService, event_admin_token: str, event_node: Node
+) -> CreateTse:
+    async def func(status: TseStatus = TseStatus.active) -> Tse:
+        tse = await tse_service.create_tse(
+            token=event_admin_token,
+            node_id=event_node.id,
+            new_tse=NewTse(
+                name=f"tse-{secrets.token_hex(8)}",
+                type=TseType.diebold_nixdorf,
+                serial=f"serial-{secrets.token_hex(8)}",
+                ws_url="ws://localhost:10001",
+                ws_timeout=5,
+                password="12345",
+            ),
+        )
+        await db_connection.execute("update tse set status = $2 where id = $1", tse.id, status.value)
+        tse.status = status
+        return tse
+
+    return func
+
+
+class CreateTill(Protocol):
+    def __call__(self, tse_id: int | None = ...) -> Awaitable[Till]: ...
+
+
+@pytest.fixture
+async def create_till(
+    db_connection: Connection,
+    till_service: TillService,
+    till_profile: TillProfile,
+    event_admin_token: str,
+    event_node: Node,
+) -> CreateTill:
+    async def func(tse_id: int | None = None) -> Till:
+        till = await till_service.create_till(
+            token=event_admin_token,
+            node_id=event_node.id,
+            till=NewTill(name=f"till-{secrets.token_hex(8)}", active_profile_id=till_profile.id),
+        )
+        await db_connection.execute("update till set tse_id = $2 where id = $1", till.id, tse_id)
+        return till
+
+    return func
+
+
+class CreateSignatureRequest(Protocol):
+    def __call__(self, till_id: int) -> Awaitable[int]: ...
+
+
+@pytest.fixture
+async def create_signature_request(db_connection: Connection) -> CreateSignatureRequest:
+    """
+    books an empty order at the till, which creates a new tse signature request for it
+    """
+
+    async def func(till_id: int) -> int:
+        return await db_connection.fetchval(
+            "insert into ordr (payment_method, order_type, till_id, z_nr) "
+            "select 'sumup_online', 'top_up', id, z_nr from till where id = $1 "
+            "returning id",
+            till_id,
+        )
+
+    return func
@@ -7,6 +7,8 @@ import pytest
 from sftkit.database import Connection
 
 from stustapay.core.schema.account import AccountType
+from stustapay.core.schema.product import NewProduct, Product
+from stustapay.core.schema.tax_rate import TaxRate
 from stustapay.core.schema.terminal import NewTerminal, Terminal
 from stustapay.core.schema.till import (
     CashRegister,
@@ -14,9 +16,12 @@ from stustapay.core.schema.till import (
     NewCashRegister,
     NewCashRegisterStocking,
     NewTill,
+    NewTillButton,
     NewTillLayout,
     NewTillProfile,
     Till,
+    TillButton,
+    TillLayout,
 )
 from stustapay.core.schema.tree import Node
 from stustapay.core.schema.user import (
@@ -30,6 +35,7 @@ from stustapay.core.schema.user import (
     UserTag,
 )
 from stustapay.core.service.account import AccountService, get_system_account_for_node
+from stustapay.core.service.product import ProductService
 from stustapay.core.service.terminal import TerminalService
 from stustapay.core.service.till import TillService
 from stustapay.core.service.user import UserService
@@ -41,6 +47,108 @@ from ..conftest import UserTag as TestUserTag
 START_BALANCE = 100
 
 
+@dataclass
+class SaleProducts:
+    beer_product: Product
+    beer_product_full: Product
+    deposit_product: Product
+    beer_button: TillButton
+    beer_button_full: TillButton
+    deposit_button: TillButton
+
+
+@pytest.fixture
+async def sale_products(
+    product_service: ProductService,
+    till_service: TillService,
+    event_admin_token: str,
+    event_node: Node,
+    tax_rate_ust: TaxRate,
+    tax_rate_none: TaxRate,
+    till_layout: TillLayout,
+) -> SaleProducts:
+    beer_product = await product_service.create_product(
+        token=event_admin_token,
+        node_id=event_node.id,
+        product=NewProduct(
+            name="Helles 0,5l",
+            price=3,
+            fixed_price=True,
+            tax_rate_id=tax_rate_ust.id,
+            target_account_id=None,
+            price_in_vouchers=1,
+            is_locked=True,
+            restrictions=[],
+            is_returnable=False,
+        ),
+    )
+    beer_product_full = await product_service.create_product(
+        token=event_admin_token,
+        node_id=event_node.id,
+        product=NewProduct(
+            name="Helles 1l",
+            price=5,
+            fixed_price=True,
+            tax_rate_id=tax_rate_ust.id,
+            target_account_id=None,
+            price_in_vouchers=2,
+            is_locked=True,
+            is_returnable=False,
+            restrictions=[],
+        ),
+    )
+    deposit_product = await product_service.create_product(
+        token=event_admin_token,
+        node_id=event_node.id,
+        product=NewProduct(
+            name="Pfand",
+            price=2,
+            fixed_price=True,
+            tax_rate_id=tax_rate_none.id,
+            target_account_id=None,
+            is_locked=True,
+            is_returnable=True,
+            restrictions=[],
+        ),
+    )
+    beer_button = await till_service.layout.create_button(
+        token=event_admin_token,
+        node_id=event_node.id,
+        button=NewTillButton(name="Helles 0,5l", product_ids=[beer_product.id, deposit_product.id]),
+    )
+    beer_button_full = await till_service.layout.create_button(
+        token=event_admin_token,
+        node_id=event_node.id,
+        button=NewTillButton(name="Helles 1l", product_ids=[beer_product_full.id, deposit_product.id]),
+    )
+    deposit_button = await till_service.layout.create_button(
+        token=event_admin_token,
+        node_id=event_node.id,
+        button=NewTillButton(name="Pfand", product_ids=[deposit_product.id]),
+    )
+
+    await till_service.layout.update_layout(
+        token=event_admin_token,
+        node_id=event_node.id,
+        layout_id=till_layout.id,
+        layout=NewTillLayout(
+            button_ids=[deposit_button.id, beer_button.id, beer_button_full.id],
+            name=till_layout.name,
+            description=till_layout.description,
+            ticket_ids=[],
+        ),
+    )
+
+    return SaleProducts(
+        beer_product=beer_product,
+        beer_button=beer_button,
+        beer_product_full=beer_product_full,
+        beer_button_full=beer_button_full,
+        deposit_product=deposit_product,
+        deposit_button=deposit_button,
+    )
+
+
 @pytest.fixture
 async def terminal_token(
     terminal_service: TerminalService,
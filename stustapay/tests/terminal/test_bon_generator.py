@@ -0,0 +1,139 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import uuid
+
+import asyncpg
+import pytest
+from sftkit.database import Connection
+
+from stustapay.bon import generator
+from stustapay.bon.bon import BonJson, generate_bon_json, generate_bon_jsons
+from stustapay.bon.generator import GeneratorWorker
+from stustapay.core.config import Config
+from stustapay.core.schema.order import Button, NewSale, PaymentMethod
+from stustapay.core.schema.tree import Node
+from stustapay.core.schema.tse import NewTse, Tse, TseType
+from stustapay.core.service.order import OrderService
+from stustapay.core.service.tse import TseService
+
+from ..conftest import Cashier
+from .conftest import Customer, LoginSupervisedUser, SaleProducts
+
+
+@pytest.fixture
+async def signed_sales(
+    db_connection: Connection,
+    order_service: OrderService,
+    tse_service: TseService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    event_admin_token: str,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+) -> tuple[Tse, list[int]]:
+    """
+    books 5 sales and finishes their tse signatures, which requests their bons
+    """
+    tse = await tse_service.create_tse(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_tse=NewTse(
+            name=f"tse-{uuid.uuid4()}",
+            type=TseType.diebold_nixdorf,
+            serial=f"serial-{uuid.uuid4()}",
+            ws_url="ws://localhost:10001",
+            ws_timeout=5,
+            password="12345",
+        ),
+    )
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    order_ids = []
+    for _ in range(5):
+        completed_sale = await order_service.book_sale(
+            token=terminal_token,
+            new_sale=NewSale(
+                uuid=uuid.uuid4(),
+                buttons=[Button(till_button_id=sale_products.beer_button.id, quantity=1)],
+                customer_tag_uid=customer.tag.uid,
+                payment_method=PaymentMethod.tag,
+            ),
+        )
+        order_ids.append(completed_sale.id)
+    # finishing the signatures requests the bons
+    await db_connection.execute(
+        "update tse_signature set "
+        "   signature_status = 'done', tse_id = $2, result_message = 'success', "
+        "   transaction_process_type = 'Kassenbeleg-V1', "
+        "   transaction_process_data = 'Beleg^5.00_0.00_0.00_0.00_0.00^5.00:Unbar', "
+        "   tse_transaction = id::text, tse_signaturenr = id::text, tse_start = '2023-04-24T14:46:54.000Z', "
+        "   tse_end = '2023-04-24T14:46:55.000Z', tse_signature = 'c2lnbmF0dXJl', tse_duration = 0.1 "
+        "where id = any($1)",
+        order_ids,
+        tse.id,
+    )
+    assert await db_connection.fetchval("select count(*) from bon where id = any($1)", order_ids) == 5
+    return tse, order_ids
+
+
+async def test_bon_generator_workers(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    config: Config,
+    signed_sales: tuple[Tse, list[int]],
+):
+    tse, order_ids = signed_sales
+
+    worker = GeneratorWorker(config=config, n_workers=3, batch_size=2)
+    worker.pool = setup_test_db_pool
+    assert await worker.fetch_backlog() >= 5
+    await worker.cleanup_pending_bons()
+    assert await worker.fetch_backlog() == 0
+    assert worker.failed_bons == set()
+
+    bons = await db_connection.fetch("select id, bon_json, generated_at from bon where id = any($1)", order_ids)
+    assert len(bons) == 5
+    for bon in bons:
+        assert bon["generated_at"] is not None
+        bon_json = BonJson.model_validate_json(bon["bon_json"])
+        assert bon_json.order.id == bon["id"]
+        assert bon_json.order.tse_public_key == tse.public_key
+        # the batched generation yields the same bon as generating it on its own
+        assert bon_json == await generate_bon_json(conn=db_connection, order_id=bon["id"])
+
+
+async def test_bon_generator_skips_broken_bons(
+    monkeypatch,
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    config: Config,
+    signed_sales: tuple[Tse, list[int]],
+):
+    _, order_ids = signed_sales
+    broken_order_id = order_ids[1]
+
+    async def generate_with_broken_order(*, conn: Connection, order_ids: list[int]):
+        if broken_order_id in order_ids:
+            # a failed query, which aborts the transaction
+            await conn.execute("select 1 / 0")
+        return await generate_bon_jsons(conn=conn, order_ids=order_ids)
+
+    monkeypatch.setattr(generator, "generate_bon_jsons", generate_with_broken_order)
+    worker = GeneratorWorker(config=config, n_workers=1, batch_size=10)
+    worker.pool = setup_test_db_pool
+    await worker.cleanup_pending_bons()
+    # the other bons of the batch are generated nonetheless, the broken one is not retried
+    assert worker.failed_bons == {broken_order_id}
+    generated = dict(
+        await db_connection.fetch("select id, generated_at is not null from bon where id = any($1)", order_ids)
+    )
+    assert generated == {order_id: order_id != broken_order_id for order_id in order_ids}
+    assert await worker.process_pending_bons() == 0
+
+    # after a restart, the bon is retried
+    monkeypatch.undo()
+    worker = GeneratorWorker(config=config, n_workers=1, batch_size=10)
+    worker.pool = setup_test_db_pool
+    await worker.cleanup_pending_bons()
+    assert worker.failed_bons == set()
+    assert await worker.fetch_backlog() == 0
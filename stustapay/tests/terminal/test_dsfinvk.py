@@ -0,0 +1,248 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,protected-access
+import csv
+import io
+import uuid
+import zipfile
+from pathlib import Path
+
+from sftkit.database import Connection
+
+from stustapay.core.config import Config
+from stustapay.core.schema.order import Button, NewSale, NewTopUp, PaymentMethod
+from stustapay.core.schema.tree import Node
+from stustapay.core.schema.tse import NewTse, TseType
+from stustapay.core.service.order import OrderService
+from stustapay.core.service.tse import TseService
+from stustapay.dsfinvk.dsfinvk.collection import Collection
+from stustapay.dsfinvk.dsfinvk.models import Bonpos, Stamm_Kassen
+from stustapay.dsfinvk.generator import Generator, _shard_closures
+from stustapay.tse.wrapper import TSEWrapper
+
+from ..conftest import Cashier, CreateTse
+from .conftest import AssignCashRegister, Customer, LoginSupervisedUser, SaleProducts
+
+ASSETS = Path(__file__).parents[2] / "dsfinvk" / "assets"
+
+
+def read_export(path: Path) -> dict[str, list[dict[str, str]]]:
+    tables = {}
+    with zipfile.ZipFile(path) as zf:
+        for name in zf.namelist():
+            if name.endswith(".csv"):
+                content = zf.read(name).decode("utf-8")
+                tables[name] = list(csv.DictReader(io.StringIO(content), delimiter=";"))
+    return tables
+
+
+async def test_dsfinvk_export(
+    tmp_path: Path,
+    db_connection: Connection,
+    config: Config,
+    order_service: OrderService,
+    tse_service: TseService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    event_admin_token: str,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    assign_cash_register: AssignCashRegister,
+    cashier: Cashier,
+    create_tse: CreateTse,
+):
+    await db_connection.execute(
+        "update event set bon_issuer = 'Verein', bon_address = 'Musterstraße 1\n80000 München' "
+        "where id = (select event_id from node where id = $1)",
+        event_node.id,
+    )
+    tse = await tse_service.create_tse(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_tse=NewTse(
+            name=f"tse-{uuid.uuid4()}",
+            type=TseType.diebold_nixdorf,
+            serial=f"serial-{uuid.uuid4()}",
+            ws_url="ws://localhost:10001",
+            ws_timeout=5,
+            password="12345",
+        ),
+    )
+    await assign_cash_register(cashier=cashier)
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+
+    async def book_orders():
+        await order_service.book_topup(
+            token=terminal_token,
+            new_topup=NewTopUp(
+                uuid=uuid.uuid4(), amount=20, payment_method=PaymentMethod.cash, customer_tag_uid=customer.tag.uid
+            ),
+        )
+        for _ in range(2):
+            await order_service.book_sale(
+                token=terminal_token,
+                new_sale=NewSale(
+                    uuid=uuid.uuid4(),
+                    buttons=[
+                        Button(till_button_id=sale_products.beer_button.id, quantity=2),
+                        Button(till_button_id=sale_products.deposit_button.id, quantity=1),
+                    ],
+                    customer_tag_uid=customer.tag.uid,
+                    payment_method=PaymentMethod.tag,
+                ),
+            )
+
+    await book_orders()
+    till_id = await db_connection.fetchval(
+        "select till_id from ordr where customer_account_id = $1", customer.account_id
+    )
+    await db_connection.execute("update till set z_nr = z_nr + 1 where id = $1", till_id)
+    await book_orders()
+
+    await db_connection.execute("update till set tse_id = $2 where id = $1", till_id, tse.id)
+    await db_connection.execute(
+        "insert into till_tse_history (till_id, tse_id, what, z_nr) values ($1, $2, 'register', 1)",
+        str(till_id),
+        tse.id,
+    )
+    await db_connection.execute(
+        "update tse set certificate = 'certificate', public_key = 'key', hashalgo = 'ecdsa-plain-SHA384', "
+        "   time_format = 'unixTime', process_data_encoding = 'UTF-8' "
+        "where id = $1",
+        tse.id,
+    )
+
+    async def sign_orders():
+        await db_connection.execute(
+            "update tse_signature set "
+            "   signature_status = 'done', tse_id = $2, result_message = 'success', "
+            "   transaction_process_type = 'Kassenbeleg-V1', "
+            "   transaction_process_data = 'Beleg^5.00_0.00_0.00_0.00_0.00^5.00:Unbar', "
+            "   tse_transaction = id::text, tse_signaturenr = id::text, tse_start = '2023-04-24T14:46:54.000Z', "
+            "   tse_end = '2023-04-24T14:46:55.000Z', tse_signature = 'c2lnbmF0dXJl', tse_duration = 0.1 "
+            "where signature_status = 'new' and id in (select id from ordr where till_id = $1)",
+            till_id,
+            tse.id,
+        )
+
+    await sign_orders()
+
+    async def run_export(filename: str, **kwargs) -> Generator:
+        generator = Generator(
+            config=config,
+            event_node_id=event_node.id,
+            filename=str(tmp_path / filename),
+            xml=str(ASSETS / "index.xml"),
+            dtd=str(ASSETS / "gdpdu-01-09-2004.dtd"),
+            simulate=False,
+            **kwargs,
+        )
+        await generator.run()
+        return generator
+
+    export = tmp_path / "dsfinvk.zip"
+    await run_export("dsfinvk.zip")
+
+    tables = read_export(export)
+    orders = await db_connection.fetch("select id, z_nr from ordr where till_id = $1 order by id", till_id)
+    closures = sorted({order["z_nr"] for order in orders})
+    assert len(closures) == 2
+    assert [int(row["BON_ID"]) for row in tables["transactions.csv"]] == [order["id"] for order in orders]
+    assert [(row["Z_KASSE_ID"], int(row["Z_NR"])) for row in tables["cashpointclosing.csv"]] == [
+        (str(till_id), z_nr) for z_nr in closures
+    ]
+    for row in tables["cashpointclosing.csv"]:
+        assert row["Z_START_ID"] == str(min(o["id"] for o in orders if o["z_nr"] == int(row["Z_NR"])))
+        assert row["STRASSE"] == "Musterstraße 1"
+        assert row["ORT"] == "München"
+    assert {row["TSE_SERIAL"] for row in tables["tse.csv"]} == {tse.serial}
+    # 2 sales per closure with a beer and a deposit line
+    assert len(tables["lines.csv"]) == len(tables["lines_vat.csv"]) >= 8
+    assert {row["GV_TYP"] for row in tables["businesscases.csv"]} >= {"Pfand", "MehrzweckgutscheinEinloesung"}
+    assert {row["ZAHLART_NAME"] for row in tables["payment.csv"]} >= {"cash", "tag"}
+
+    # only the first closure is recorded as exported, the till still books into the second one
+    manifest = await db_connection.fetch(
+        "select till_id, z_nr from dsfinvk_exported_closure where node_id = $1", event_node.id
+    )
+    assert [(row["till_id"], row["z_nr"]) for row in manifest] == [(till_id, closures[0])]
+
+    await run_export("dsfinvk-incremental.zip", since_last=True)
+    tables = read_export(tmp_path / "dsfinvk-incremental.zip")
+    assert {int(row["Z_NR"]) for row in tables["transactions.csv"]} == {closures[1]}
+    assert [int(row["Z_NR"]) for row in tables["tse.csv"]] == [closures[1]]
+
+    # right after a move to another tse, the closures still belong to the tse the till was registered at
+    new_tse = await create_tse()
+    await db_connection.execute(
+        "update till set active_user_id = null, active_user_role_id = null where id = $1", till_id
+    )
+    # the logout books the transfer of the cash register, which is signed as well
+    await sign_orders()
+    wrapper = TSEWrapper(tse_id=tse.id, factory_function=lambda: None)
+    wrapper.request_till_move(str(till_id), new_tse.id)
+    await wrapper._move_tills(db_connection)
+    assert await db_connection.fetchval("select tse_id from till where id = $1", till_id) == new_tse.id
+    await run_export("dsfinvk-moved.zip")
+    tables = read_export(tmp_path / "dsfinvk-moved.zip")
+    assert [(int(row["Z_NR"]), row["TSE_SERIAL"]) for row in tables["tse.csv"]] == [
+        (z_nr, tse.serial) for z_nr in closures
+    ]
+
+    # changed master data does not change the exported closures
+    await db_connection.execute(
+        "update event set bon_address = 'Musterstraße 2\n80000 München' "
+        "where id = (select event_id from node where id = $1)",
+        event_node.id,
+    )
+    await db_connection.execute(
+        "update tax_rate set description = description || ' (geändert)' where node_id = $1", event_node.id
+    )
+    await db_connection.execute("update tse set certificate = 'renewed certificate' where id = $1", tse.id)
+    verifier = await run_export("unused.zip", verify=True)
+    assert verifier.drifted_closures == []
+    assert not (tmp_path / "unused.zip").exists()
+
+    await db_connection.execute(
+        "update line_item set product_price = product_price + 1 "
+        "where order_id = (select min(id) from ordr where till_id = $1 and z_nr = $2 and item_count > 0)",
+        till_id,
+        closures[0],
+    )
+    verifier = await run_export("unused.zip", verify=True)
+    assert verifier.drifted_closures == [(till_id, closures[0])]
+
+
+def test_streaming_collection_writes_same_zip(tmp_path: Path):
+    exports = []
+    # in memory, streamed, and streamed in two parts which are merged afterwards
+    for streaming, n_parts in ((False, 1), (True, 1), (True, 2)):
+        parts = [Collection(streaming=streaming) for _ in range(n_parts)]
+        for i in range(4):
+            part = parts[i * n_parts // 4]
+            if i != 2:
+                part.add(Stamm_Kassen(Z_KASSE_ID=str(i), Z_NR=i, KASSE_BRAND="StuStaPay"))
+            part.add(Bonpos(Z_KASSE_ID=str(i), Z_NR=i, BON_ID=str(i), ARTIKELTEXT="Bier; 0,5l"))
+        collection = Collection(streaming=streaming)
+        for part in parts:
+            collection.merge(part)
+        export = tmp_path / f"streaming-{streaming}-{n_parts}.zip"
+        collection.write(str(export), str(ASSETS / "index.xml"), str(ASSETS / "gdpdu-01-09-2004.dtd"))
+        with zipfile.ZipFile(export) as zf:
+            exports.append([(info.filename, info.compress_type, zf.read(info)) for info in zf.infolist()])
+    assert exports[0] == exports[1] == exports[2]
+    assert [name for name, _, _ in exports[1]][:2] == ["cashregister.csv", "lines.csv"]
+    assert exports[2][1][2].count(b"Bier") == 4
+
+
+def test_shard_closures():
+    closures = [
+        {"till_id": till_id, "z_nr": z_nr, "n_orders": n_orders}
+        for till_id, z_nr, n_orders in [(1, 1, 10), (1, 2, 10), (2, 1, 15), (3, 1, 20), (4, 1, 5)]
+    ]
+    assert _shard_closures(closures, 1) == [closures]  # type: ignore
+    shards = _shard_closures(closures, 2)  # type: ignore
+    assert [[closure["till_id"] for closure in shard] for shard in shards] == [[1, 1, 2], [3, 4]]
+    # tills are never split up
+    shards = _shard_closures(closures, 10)  # type: ignore
+    assert [[closure["till_id"] for closure in shard] for shard in shards] == [[1, 1], [2], [3], [4]]
+    assert _shard_closures([], 4) == [[]]
@@ -0,0 +1,250 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,redefined-outer-name
+import uuid
+from typing import Optional
+
+import asyncpg
+import pytest
+from sftkit.database import Connection
+
+from stustapay.core.config import Config
+from stustapay.core.schema.order import Button, CompletedSale, NewSale, PaymentMethod
+from stustapay.core.schema.tree import Node
+from stustapay.core.service.auth import AuthService
+from stustapay.core.service.order import NotEnoughVouchersException, OrderService
+from stustapay.core.service.order.order import (
+    AlreadyProcessedException,
+    CustomerNotFound,
+    InvalidSaleException,
+    NotEnoughFundsException,
+)
+from stustapay.core.service.user_tag import get_or_assign_user_tag
+
+from ..conftest import Cashier, CreateRandomUserTag
+from .conftest import (
+    START_BALANCE,
+    AssignCashRegister,
+    Customer,
+    LoginSupervisedUser,
+    SaleProducts,
+)
+
+
+@pytest.fixture(scope="session")
+async def fused_order_service(
+    setup_test_db_pool: asyncpg.Pool, config: Config, auth_service: AuthService
+) -> OrderService:
+    fused_config = config.model_copy(update={"core": config.core.model_copy(update={"fused_sale_booking": True})})
+    return OrderService(db_pool=setup_test_db_pool, config=fused_config, auth_service=auth_service)
+
+
+@pytest.fixture
+async def other_customer(
+    create_random_user_tag: CreateRandomUserTag, db_connection: Connection, event_node: Node
+) -> Customer:
+    customer_tag = await create_random_user_tag()
+    user_tag_id = await get_or_assign_user_tag(
+        conn=db_connection, node=event_node, uid=customer_tag.uid, pin=customer_tag.pin
+    )
+    customer_account_id = await db_connection.fetchval(
+        "insert into account (node_id, user_tag_id, type, balance) values ($1, $2, 'private', $3) returning id",
+        event_node.id,
+        user_tag_id,
+        START_BALANCE,
+    )
+    return Customer(tag=customer_tag, account_id=customer_account_id)
+
+
+async def _fetch_ledger(conn: Connection, order_id: int, customer_account_id: Optional[int]) -> dict:
+    """
+    all booked data of an order, with the customer account replaced by a placeholder to be comparable
+    """
+
+    def account(account_id: int):
+        return "customer" if account_id == customer_account_id else account_id
+
+    order = await conn.fetchrow(
+        "select item_count, payment_method, order_type, cashier_id, till_id, cash_register_id, z_nr "
+        "from ordr where id = $1",
+        order_id,
+    )
+    line_items = await conn.fetch(
+        "select item_id, product_id, product_price, quantity, tax_rate_id, tax_name, tax_rate "
+        "from line_item where order_id = $1 order by item_id",
+        order_id,
+    )
+    transactions = await conn.fetch(
+        "select source_account, target_account, amount, vouchers from transaction where order_id = $1 order by id",
+        order_id,
+    )
+    return {
+        "order": dict(order),
+        "line_items": [dict(li) for li in line_items],
+        "transactions": sorted(
+            (account(t["source_account"]), account(t["target_account"]), t["amount"], t["vouchers"])
+            for t in transactions
+        ),
+    }
+
+
+def _sale_result(sale: CompletedSale) -> dict:
+    return sale.model_dump(exclude={"id", "uuid", "booked_at", "customer_account_id", "bon_url"})
+
+
+def _sale_scenarios(sale_products: SaleProducts) -> dict[str, tuple[list[Button], Optional[int]]]:
+    return {
+        "single_button": ([Button(till_button_id=sale_products.beer_button.id, quantity=2)], None),
+        "deposit_return": (
+            [
+                Button(till_button_id=sale_products.beer_button.id, quantity=3),
+                Button(till_button_id=sale_products.beer_button.id, quantity=2),
+                Button(till_button_id=sale_products.deposit_button.id, quantity=-1),
+                Button(till_button_id=sale_products.deposit_button.id, quantity=-5),
+            ],
+            None,
+        ),
+        "only_deposit_return": ([Button(till_button_id=sale_products.deposit_button.id, quantity=-3)], None),
+        "vouchers": (
+            [
+                Button(till_button_id=sale_products.beer_button.id, quantity=3),
+                Button(till_button_id=sale_products.beer_button_full.id, quantity=1),
+            ],
+            None,
+        ),
+        "fixed_vouchers": (
+            [
+                Button(till_button_id=sale_products.beer_button.id, quantity=3),
+                Button(till_button_id=sale_products.beer_button_full.id, quantity=1),
+            ],
+            2,
+        ),
+    }
+
+
+@pytest.mark.parametrize(
+    "scenario", ["single_button", "deposit_return", "only_deposit_return", "vouchers", "fixed_vouchers"]
+)
+async def test_fused_tag_sale_produces_identical_ledger(
+    scenario: str,
+    db_connection: Connection,
+    order_service: OrderService,
+    fused_order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    other_customer: Customer,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    await db_connection.execute(
+        "update account set vouchers = 3 where id = any($1)", [customer.account_id, other_customer.account_id]
+    )
+    buttons, used_vouchers = _sale_scenarios(sale_products)[scenario]
+
+    python_sale = await order_service.book_sale(
+        token=terminal_token,
+        new_sale=NewSale(
+            uuid=uuid.uuid4(),
+            buttons=buttons,
+            customer_tag_uid=customer.tag.uid,
+            payment_method=PaymentMethod.tag,
+            used_vouchers=used_vouchers,
+        ),
+    )
+    fused_sale = await fused_order_service.book_sale(
+        token=terminal_token,
+        new_sale=NewSale(
+            uuid=uuid.uuid4(),
+            buttons=buttons,
+            customer_tag_uid=other_customer.tag.uid,
+            payment_method=PaymentMethod.tag,
+            used_vouchers=used_vouchers,
+        ),
+    )
+
+    assert _sale_result(python_sale) == _sale_result(fused_sale)
+    assert fused_sale.customer_account_id == other_customer.account_id
+    assert await _fetch_ledger(db_connection, python_sale.id, customer.account_id) == await _fetch_ledger(
+        db_connection, fused_sale.id, other_customer.account_id
+    )
+
+    balances = await db_connection.fetch(
+        "select balance, vouchers from account where id = any($1)", [customer.account_id, other_customer.account_id]
+    )
+    assert balances[0] == balances[1]
+
+
+@pytest.mark.parametrize("payment_method", [PaymentMethod.cash, PaymentMethod.sumup])
+async def test_fused_non_tag_sale_produces_identical_ledger(
+    payment_method: PaymentMethod,
+    db_connection: Connection,
+    order_service: OrderService,
+    fused_order_service: OrderService,
+    sale_products: SaleProducts,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    assign_cash_register: AssignCashRegister,
+    cashier: Cashier,
+):
+    await assign_cash_register(cashier=cashier)
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    buttons = [
+        Button(till_button_id=sale_products.beer_button.id, quantity=2),
+        Button(till_button_id=sale_products.beer_button_full.id, quantity=1),
+        Button(till_button_id=sale_products.deposit_button.id, quantity=-1),
+    ]
+
+    python_sale = await order_service.book_sale(
+        token=terminal_token,
+        new_sale=NewSale(uuid=uuid.uuid4(), buttons=buttons, payment_method=payment_method),
+    )
+    fused_sale = await fused_order_service.book_sale(
+        token=terminal_token,
+        new_sale=NewSale(uuid=uuid.uuid4(), buttons=buttons, payment_method=payment_method),
+    )
+
+    assert _sale_result(python_sale) == _sale_result(fused_sale)
+    assert await _fetch_ledger(db_connection, python_sale.id, None) == await _fetch_ledger(
+        db_connection, fused_sale.id, None
+    )
+
+
+async def test_fused_sale_errors_match(
+    db_connection: Connection,
+    order_service: OrderService,
+    fused_order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    await db_connection.execute("update account set vouchers = 3 where id = $1", customer.account_id)
+
+    def new_sale(buttons: list[Button], customer_tag_uid: int = customer.tag.uid, used_vouchers=None) -> NewSale:
+        return NewSale(
+            uuid=uuid.uuid4(),
+            buttons=buttons,
+            customer_tag_uid=customer_tag_uid,
+            payment_method=PaymentMethod.tag,
+            used_vouchers=used_vouchers,
+        )
+
+    beer = Button(till_button_id=sale_products.beer_button.id, quantity=1)
+    failing_sales = [
+        (new_sale([Button(till_button_id=sale_products.beer_button.id, quantity=-1)]), InvalidSaleException),
+        (new_sale([beer], used_vouchers=4), NotEnoughVouchersException),
+        (new_sale([beer], customer_tag_uid=customer.tag.uid + 1), CustomerNotFound),
+        (new_sale([Button(till_button_id=sale_products.beer_button.id, quantity=100)]), NotEnoughFundsException),
+    ]
+    for sale, exception in failing_sales:
+        with pytest.raises(exception):
+            await order_service.book_sale(token=terminal_token, new_sale=sale)
+        with pytest.raises(exception):
+            await fused_order_service.book_sale(token=terminal_token, new_sale=sale)
+
+    booked_sale = new_sale([beer])
+    await fused_order_service.book_sale(token=terminal_token, new_sale=booked_sale)
+    with pytest.raises(AlreadyProcessedException):
+        await fused_order_service.book_sale(token=terminal_token, new_sale=booked_sale)
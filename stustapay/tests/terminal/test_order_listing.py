@@ -0,0 +1,52 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import uuid
+
+from stustapay.core.schema.order import Button, NewSale, PaymentMethod
+from stustapay.core.schema.tree import Node
+from stustapay.core.service.order import OrderService
+
+from ..conftest import Cashier
+from .conftest import Customer, LoginSupervisedUser, SaleProducts
+
+
+async def test_order_listing_pagination(
+    order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    terminal_token: str,
+    event_admin_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    booked_ids = []
+    for _ in range(3):
+        completed_sale = await order_service.book_sale(
+            token=terminal_token,
+            new_sale=NewSale(
+                uuid=uuid.uuid4(),
+                buttons=[Button(till_button_id=sale_products.beer_button.id, quantity=1)],
+                customer_tag_uid=customer.tag.uid,
+                payment_method=PaymentMethod.tag,
+            ),
+        )
+        booked_ids.append(completed_sale.id)
+
+    first_page = await order_service.list_orders_terminal(token=terminal_token, limit=2)
+    assert [o.id for o in first_page] == booked_ids[:0:-1]
+    second_page = await order_service.list_orders_terminal(token=terminal_token, before_id=first_page[-1].id, limit=2)
+    assert [o.id for o in second_page] == booked_ids[:1]
+    assert len(second_page[0].line_items) > 0
+
+    all_orders = await order_service.list_orders(token=event_admin_token, node_id=event_node.id)
+    assert [o.id for o in all_orders] == sorted((o.id for o in all_orders), reverse=True)
+    assert set(booked_ids) <= {o.id for o in all_orders}
+    customer_orders = await order_service.list_orders(
+        token=event_admin_token, node_id=event_node.id, customer_account_id=customer.account_id, limit=1
+    )
+    assert [o.id for o in customer_orders] == [booked_ids[-1]]
+
+    node = await order_service.get_order_export_node(token=event_admin_token, node_id=event_node.id)
+    exported = [order async for order in order_service.stream_orders(node=node, prefetch=2)]
+    assert exported == all_orders[::-1]
@@ -0,0 +1,187 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+import uuid
+from datetime import datetime
+
+import asyncpg
+from sftkit.database import Connection
+
+from stustapay.core.schema.order import Button, NewSale, OrderSummary, PaymentMethod
+from stustapay.core.schema.tree import Node
+from stustapay.core.service.order import OrderService
+from stustapay.core.service.order.live_stats import LiveStatsBroadcaster
+from stustapay.core.service.order.order import fetch_order, fetch_order_summary
+from stustapay.core.service.order.stats import (
+    get_hourly_product_stats,
+    get_hourly_sales_stats,
+)
+from stustapay.core.service.order.stats_rollup import (
+    backfill_order_stats,
+    check_order_stats,
+    rollup_order_stats,
+)
+
+from ..conftest import Cashier
+from .conftest import Customer, LoginSupervisedUser, SaleProducts
+
+
+async def test_order_stats_rollup(
+    db_connection: Connection,
+    order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    for quantity in (2, 3):
+        await order_service.book_sale(
+            token=terminal_token,
+            new_sale=NewSale(
+                uuid=uuid.uuid4(),
+                buttons=[Button(till_button_id=sale_products.beer_button.id, quantity=quantity)],
+                customer_tag_uid=customer.tag.uid,
+                payment_method=PaymentMethod.tag,
+            ),
+        )
+
+    # queued orders are not yet part of the rollup, which is consistent nonetheless
+    assert await check_order_stats(conn=db_connection) == []
+    assert await rollup_order_stats(conn=db_connection, batch_size=1) >= 2
+    assert await check_order_stats(conn=db_connection) == []
+
+    from_time, to_time = datetime(year=1970, month=1, day=1), datetime(year=4000, month=1, day=1)
+    product_stats = await get_hourly_product_stats(
+        conn=db_connection, node=event_node, from_time=from_time, to_time=to_time
+    )
+    beer_stats = next(s for s in product_stats if s.product_id == sale_products.beer_product.id)
+    assert sum(interval.count for interval in beer_stats.intervals) == 5
+    assert sale_products.beer_product.price is not None
+    assert sum(interval.revenue for interval in beer_stats.intervals) == 5 * sale_products.beer_product.price
+
+    sales_stats = await get_hourly_sales_stats(
+        conn=db_connection, node=event_node, from_time=from_time, to_time=to_time
+    )
+    expected_revenue = await db_connection.fetchval(
+        "select sum(li.total_price) from order_stats_line_items li join node n on li.node_id = n.id "
+        "where li.payment_method = 'tag' and ($1 = any(n.parent_ids) or n.id = $1)",
+        event_node.id,
+    )
+    assert sum(interval.revenue for interval in sales_stats.intervals) == expected_revenue
+
+    # the checker detects inconsistencies which are fixed by a backfill
+    await db_connection.execute(
+        "update order_stats_hourly set count = count + 1 where product_id = $1", sale_products.beer_product.id
+    )
+    assert len(await check_order_stats(conn=db_connection)) > 0
+    await backfill_order_stats(conn=db_connection)
+    assert await check_order_stats(conn=db_connection) == []
+    assert await db_connection.fetchval("select count(*) from order_stats_pending") == 0
+
+
+async def test_live_stats(
+    setup_test_db_pool: asyncpg.Pool,
+    order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    terminal_token: str,
+    event_admin_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    node = await order_service.stats.get_live_stats_node(token=event_admin_token, node_id=event_node.id)
+    broadcaster = LiveStatsBroadcaster(db_pool=setup_test_db_pool, batch_interval=0.05, queue_size=1)
+    broadcast_task = asyncio.create_task(broadcaster.run())
+    try:
+        while not broadcaster.is_listening:
+            await asyncio.sleep(0.01)
+
+        with broadcaster.subscribe(node) as subscription:
+            await order_service.book_sale(
+                token=terminal_token,
+                new_sale=NewSale(
+                    uuid=uuid.uuid4(),
+                    buttons=[Button(till_button_id=sale_products.beer_button.id, quantity=2)],
+                    customer_tag_uid=customer.tag.uid,
+                    payment_method=PaymentMethod.tag,
+                ),
+            )
+            async with asyncio.timeout(5):
+                update = await subscription.updates.get()
+            assert not update.resync
+            beer_entry = next(e for e in update.entries if e.product_id == sale_products.beer_product.id)
+            assert beer_entry.count == 2
+            assert beer_entry.product_name == sale_products.beer_product.name
+
+            # a subscriber which does not keep up gets told to resync instead of stalling the broadcast
+            for _ in range(2):
+                subscription.publish([(beer_entry, [event_node.id])])
+            update = await subscription.updates.get()
+            assert update.resync
+            assert subscription.updates.empty()
+
+            # orders might have been missed while the listener reconnected
+            await broadcaster._handle_new_order(None)  # pylint: disable=protected-access
+            assert subscription.updates.get_nowait().resync
+
+            # as well as when the new orders could not be loaded
+            async def fail_fetch_entries(order_ids: list[int]):
+                raise asyncpg.PostgresError("connection lost")
+
+            broadcaster._fetch_entries = fail_fetch_entries  # type: ignore
+            await broadcaster._handle_new_order('{"order_id": 1}')  # pylint: disable=protected-access
+            async with asyncio.timeout(5):
+                update = await subscription.updates.get()
+            assert update.resync
+
+        assert len(broadcaster.subscriptions) == 0
+    finally:
+        broadcast_task.cancel()
+        await broadcast_task
+
+    assert not broadcaster.is_listening
+
+
+async def test_order_summary_matches_order_value(
+    db_connection: Connection,
+    order_service: OrderService,
+    sale_products: SaleProducts,
+    customer: Customer,
+    event_node: Node,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+    cashier: Cashier,
+):
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    completed_sale = await order_service.book_sale(
+        token=terminal_token,
+        new_sale=NewSale(
+            uuid=uuid.uuid4(),
+            buttons=[
+                Button(till_button_id=sale_products.beer_button.id, quantity=2),
+                Button(till_button_id=sale_products.beer_button_full.id, quantity=1),
+            ],
+            customer_tag_uid=customer.tag.uid,
+            payment_method=PaymentMethod.tag,
+        ),
+    )
+
+    order = await fetch_order(conn=db_connection, order_id=completed_sale.id)
+    summary = await fetch_order_summary(conn=db_connection, order_id=completed_sale.id)
+    assert order is not None and summary is not None
+    assert summary == OrderSummary.model_validate(order.model_dump(exclude={"line_items"}))
+    assert summary.item_count == len(order.line_items)
+
+    full_orders = await db_connection.fetch(
+        "select id, total_price, total_tax, total_no_tax from orders_at_node_and_children($1) order by id",
+        event_node.id,
+    )
+    summaries = await db_connection.fetch(
+        "select id, total_price, total_tax, total_no_tax from order_summaries_at_node_and_children($1) order by id",
+        event_node.id,
+    )
+    assert [dict(row) for row in summaries] == [dict(row) for row in full_orders]
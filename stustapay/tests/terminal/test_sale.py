@@ -1,7 +1,8 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,redefined-outer-name
+import asyncio
 import uuid
-from dataclasses import dataclass
 
+import asyncpg
 import pytest
 from sftkit.database import Connection
 
@@ -13,15 +14,11 @@ from stustapay.core.schema.order import (
     PaymentMethod,
     PendingSale,
 )
-from stustapay.core.schema.product import NewProduct, Product
-from stustapay.core.schema.tax_rate import TaxRate
 from stustapay.core.schema.till import (
     NewCashRegister,
     NewCashRegisterStocking,
-    NewTillButton,
     NewTillLayout,
     Till,
-    TillButton,
     TillLayout,
 )
 from stustapay.core.schema.tree import Node, RestrictedEventSettings
@@ -31,10 +28,11 @@ from stustapay.core.service.cashier import (
     CloseOut,
     InvalidCloseOutException,
 )
+from stustapay.core.service.common.cache import NodeCache, run_node_cache_invalidation
 from stustapay.core.service.common.error import InvalidArgument
 from stustapay.core.service.order import NotEnoughVouchersException, OrderService
+from stustapay.core.service.order.catalog import fetch_till_profile_catalog
 from stustapay.core.service.order.order import InvalidSaleException
-from stustapay.core.service.product import ProductService
 from stustapay.core.service.till import TillService
 
 from ..conftest import Cashier
@@ -48,111 +46,10 @@ from .conftest import (
     Finanzorga,
     GetSystemAccountBalance,
     LoginSupervisedUser,
+    SaleProducts,
 )
 
 
-@dataclass
-class SaleProducts:
-    beer_product: Product
-    beer_product_full: Product
-    deposit_product: Product
-    beer_button: TillButton
-    beer_button_full: TillButton
-    deposit_button: TillButton
-
-
-@pytest.fixture
-async def sale_products(
-    product_service: ProductService,
-    till_service: TillService,
-    event_admin_token: str,
-    event_node: Node,
-    tax_rate_ust: TaxRate,
-    tax_rate_none: TaxRate,
-    till_layout: TillLayout,
-) -> SaleProducts:
-    beer_product = await product_service.create_product(
-        token=event_admin_token,
-        node_id=event_node.id,
-        product=NewProduct(
-            name="Helles 0,5l",
-            price=3,
-            fixed_price=True,
-            tax_rate_id=tax_rate_ust.id,
-            target_account_id=None,
-            price_in_vouchers=1,
-            is_locked=True,
-            restrictions=[],
-            is_returnable=False,
-        ),
-    )
-    beer_product_full = await product_service.create_product(
-        token=event_admin_token,
-        node_id=event_node.id,
-        product=NewProduct(
-            name="Helles 1l",
-            price=5,
-            fixed_price=True,
-            tax_rate_id=tax_rate_ust.id,
-            target_account_id=None,
-            price_in_vouchers=2,
-            is_locked=True,
-            is_returnable=False,
-            restrictions=[],
-        ),
-    )
-    deposit_product = await product_service.create_product(
-        token=event_admin_token,
-        node_id=event_node.id,
-        product=NewProduct(
-            name="Pfand",
-            price=2,
-            fixed_price=True,
-            tax_rate_id=tax_rate_none.id,
-            target_account_id=None,
-            is_locked=True,
-            is_returnable=True,
-            restrictions=[],
-        ),
-    )
-    beer_button = await till_service.layout.create_button(
-        token=event_admin_token,
-        node_id=event_node.id,
-        button=NewTillButton(name="Helles 0,5l", product_ids=[beer_product.id, deposit_product.id]),
-    )
-    beer_button_full = await till_service.layout.create_button(
-        token=event_admin_token,
-        node_id=event_node.id,
-        button=NewTillButton(name="Helles 1l", product_ids=[beer_product_full.id, deposit_product.id]),
-    )
-    deposit_button = await till_service.layout.create_button(
-        token=event_admin_token,
-        node_id=event_node.id,
-        button=NewTillButton(name="Pfand", product_ids=[deposit_product.id]),
-    )
-
-    await till_service.layout.update_layout(
-        token=event_admin_token,
-        node_id=event_node.id,
-        layout_id=till_layout.id,
-        layout=NewTillLayout(
-            button_ids=[deposit_button.id, beer_button.id, beer_button_full.id],
-            name=till_layout.name,
-            description=till_layout.description,
-            ticket_ids=[],
-        ),
-    )
-
-    return SaleProducts(
-        beer_product=beer_product,
-        beer_button=beer_button,
-        beer_product_full=beer_product_full,
-        beer_button_full=beer_button_full,
-        deposit_product=deposit_product,
-        deposit_button=deposit_button,
-    )
-
-
 async def test_basic_sale_flow(
     db_connection: Connection,
     till_service: TillService,
@@ -647,3 +544,70 @@ async def test_transport_and_cashier_account_management(
     )
     await assert_account_balance(finanzorga.transport_account_id, 0)
     await assert_system_account_balance(AccountType.cash_vault, -30)
+
+
+async def test_till_profile_catalog_is_rebuilt_on_layout_changes(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    till_service: TillService,
+    event_admin_token: str,
+    event_node: Node,
+    till: Till,
+    till_layout: TillLayout,
+    sale_products: SaleProducts,
+):
+    invalidation_task = asyncio.create_task(run_node_cache_invalidation(setup_test_db_pool))
+    try:
+        while not NodeCache.is_active():
+            await asyncio.sleep(0.01)
+
+        async def fetch_catalog():
+            with NodeCache.transaction():
+                return await fetch_till_profile_catalog(
+                    conn=db_connection, node=event_node, till_profile_id=till.active_profile_id
+                )
+
+        catalog = await fetch_catalog()
+        assert [p.id for p in catalog.button_products[sale_products.beer_button.id]] == sorted(
+            [sale_products.beer_product.id, sale_products.deposit_product.id]
+        )
+        assert await fetch_catalog() is catalog
+
+        await till_service.layout.update_layout(
+            token=event_admin_token,
+            node_id=event_node.id,
+            layout_id=till_layout.id,
+            layout=NewTillLayout(
+                button_ids=[sale_products.deposit_button.id],
+                name=till_layout.name,
+                description=till_layout.description,
+                ticket_ids=[],
+            ),
+        )
+        async with asyncio.timeout(5):
+            while catalog.version == NodeCache.version:
+                await asyncio.sleep(0.01)
+
+        rebuilt_catalog = await fetch_catalog()
+        assert rebuilt_catalog.version is not None and catalog.version is not None
+        assert rebuilt_catalog.version > catalog.version
+        assert list(rebuilt_catalog.button_products.keys()) == [sale_products.deposit_button.id]
+
+        # a catalog read from a snapshot taken before a layout change is not cached
+        with NodeCache.transaction():
+            async with db_connection.transaction(isolation="repeatable_read"):
+                await db_connection.execute("select 1")
+                version = NodeCache.version
+                async with setup_test_db_pool.acquire() as conn:
+                    await conn.execute("delete from till_layout_to_button where layout_id = $1", till_layout.id)
+                async with asyncio.timeout(5):
+                    while NodeCache.version == version:
+                        await asyncio.sleep(0.01)
+                stale_catalog = await fetch_till_profile_catalog(
+                    conn=db_connection, node=event_node, till_profile_id=till.active_profile_id
+                )
+                assert list(stale_catalog.button_products.keys()) == [sale_products.deposit_button.id]
+        assert (await fetch_catalog()).button_products == {}
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
@@ -1,6 +1,11 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+
+import asyncpg
 
 from stustapay.core.schema.tree import Node
+from stustapay.core.service.auth import AuthService
+from stustapay.core.service.common.cache import TokenCache, run_token_cache_invalidation
 from stustapay.core.service.terminal import TerminalService
 
 
@@ -21,3 +26,29 @@ async def test_terminal_registration_flow(
         token=event_admin_token, node_id=event_node.id, terminal_id=terminal_config.id
     )
     assert logged_out
+
+
+async def test_terminal_token_cache_evicted_on_logout(
+    setup_test_db_pool: asyncpg.Pool,
+    auth_service: AuthService,
+    terminal_service: TerminalService,
+    terminal_token: str,
+):
+    invalidation_task = asyncio.create_task(run_token_cache_invalidation(setup_test_db_pool))
+    try:
+        while not TokenCache.is_active():
+            await asyncio.sleep(0.01)
+
+        terminal = await auth_service.get_terminal_from_token(token=terminal_token)
+        assert terminal is not None
+        hits = TokenCache.stats()["terminal_tokens"]["hits"]
+        assert terminal == await auth_service.get_terminal_from_token(token=terminal_token)
+        assert TokenCache.stats()["terminal_tokens"]["hits"] == hits + 1
+
+        await terminal_service.logout_terminal(token=terminal_token)
+        async with asyncio.timeout(5):
+            while await auth_service.get_terminal_from_token(token=terminal_token) is not None:
+                await asyncio.sleep(0.01)
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
@@ -1,7 +1,14 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+
+import asyncpg
 import pytest
+from sftkit.database import Connection
 
+from stustapay.core.schema.till import Till
 from stustapay.core.schema.user import ADMIN_ROLE_ID
+from stustapay.core.service.common.cache import NodeCache, run_node_cache_invalidation
+from stustapay.core.service.common.decorators import _fetch_till_nodes
 from stustapay.core.service.common.error import AccessDenied
 from stustapay.core.service.till import TillService
 from stustapay.tests.conftest import Cashier, UserTag
@@ -29,3 +36,57 @@ async def test_get_user_info(
 
     user_info = await till_service.get_user_info(token=terminal_token, user_tag_uid=event_admin_tag.uid)
     assert user_info is not None
+
+
+async def test_till_nodes_are_cached_while_till_changes_are_visible(
+    setup_test_db_pool: asyncpg.Pool,
+    till_service: TillService,
+    cashier: Cashier,
+    terminal_token: str,
+    login_supervised_user: LoginSupervisedUser,
+):
+    invalidation_task = asyncio.create_task(run_node_cache_invalidation(setup_test_db_pool))
+    try:
+        while not NodeCache.is_active():
+            await asyncio.sleep(0.01)
+
+        await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+        current_user = await till_service.get_current_user(token=terminal_token)
+        assert current_user is not None
+        assert current_user.id == cashier.id
+
+        cached_till_nodes = NodeCache.stats()["till_nodes"]["hits"]
+        await till_service.logout_user(token=terminal_token)
+        assert await till_service.get_current_user(token=terminal_token) is None
+        assert NodeCache.stats()["till_nodes"]["hits"] == cached_till_nodes + 2
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
+
+
+async def test_till_nodes_from_outdated_snapshot_are_not_cached(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, till: Till
+):
+    invalidation_task = asyncio.create_task(run_node_cache_invalidation(setup_test_db_pool))
+    try:
+        while not NodeCache.is_active():
+            await asyncio.sleep(0.01)
+
+        with NodeCache.transaction():
+            async with db_connection.transaction(isolation="repeatable_read"):
+                await db_connection.execute("select 1")
+                version = NodeCache.version
+                async with setup_test_db_pool.acquire() as conn:
+                    await conn.execute("update node set read_only = true where id = $1", till.node_id)
+                async with asyncio.timeout(5):
+                    while NodeCache.version == version:
+                        await asyncio.sleep(0.01)
+                till_nodes = await _fetch_till_nodes(conn=db_connection, till=till)
+                assert not till_nodes.node.read_only
+
+        with NodeCache.transaction():
+            till_nodes = await _fetch_till_nodes(conn=db_connection, till=till)
+        assert till_nodes.node.read_only
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
@@ -2,8 +2,15 @@
 
 from sftkit.database import Connection
 
+from stustapay.core.schema.account import AccountType
 from stustapay.core.schema.tree import Node
-from stustapay.core.service.account import AccountService
+from stustapay.core.schema.user import User
+from stustapay.core.service.account import (
+    AccountService,
+    get_account_by_id,
+    get_system_account_for_node,
+)
+from stustapay.core.service.transaction import NewTransaction, book_transactions
 
 from .conftest import CreateRandomUserTag
 
@@ -32,3 +39,44 @@ async def test_account_comment_updates(
     acc = await account_service.get_account(token=event_admin_token, node_id=event_node.id, account_id=account_id)
     assert acc is not None
     assert "foobar" == acc.comment
+
+
+async def test_book_transactions_updates_balances(
+    db_connection: Connection,
+    event_node: Node,
+    global_admin_user: tuple[User, str],
+):
+    admin_user, _ = global_admin_user
+    source = await get_system_account_for_node(conn=db_connection, node=event_node, account_type=AccountType.cash_entry)
+    target = await get_system_account_for_node(conn=db_connection, node=event_node, account_type=AccountType.sale_exit)
+
+    transaction_ids = await book_transactions(
+        conn=db_connection,
+        conducting_user_id=admin_user.id,
+        transactions=[
+            NewTransaction(source_account_id=source.id, target_account_id=target.id, amount=10),
+            # negative amounts swap source and target
+            NewTransaction(source_account_id=target.id, target_account_id=source.id, amount=-5.5),
+            NewTransaction(source_account_id=source.id, target_account_id=target.id, voucher_amount=2),
+        ],
+    )
+    assert len(transaction_ids) == 3
+    assert transaction_ids == sorted(transaction_ids)
+
+    transactions = await db_connection.fetch(
+        "select source_account, target_account, amount, vouchers from transaction where id = any($1) order by id",
+        transaction_ids,
+    )
+    assert [(t["source_account"], t["target_account"], t["amount"], t["vouchers"]) for t in transactions] == [
+        (source.id, target.id, 10, 0),
+        (source.id, target.id, 5.5, 0),
+        (source.id, target.id, 0, 2),
+    ]
+
+    source_after = await get_account_by_id(conn=db_connection, node=event_node, account_id=source.id)
+    target_after = await get_account_by_id(conn=db_connection, node=event_node, account_id=target.id)
+    assert source_after is not None and target_after is not None
+    assert source_after.balance == source.balance - 15.5
+    assert source_after.vouchers == source.vouchers - 2
+    assert target_after.balance == target.balance + 15.5
+    assert target_after.vouchers == target.vouchers + 2
@@ -0,0 +1,96 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,protected-access
+import asyncio
+import os
+from pathlib import Path
+
+import pytest
+
+from stustapay.bon import pdflatex
+from stustapay.bon.pdflatex import LatexRenderer, PdfRenderResult, RenderedPdf
+
+
+async def test_latex_renderer_caches_and_limits_compilations(monkeypatch):
+    running = 0
+    max_running = 0
+    compiled: list[str] = []
+    build_dirs: set[Path] = set()
+
+    async def fake_latexmk(build_dir: Path, file_content: str) -> PdfRenderResult:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        build_dirs.add(build_dir)
+        await asyncio.sleep(0.05)
+        running -= 1
+        compiled.append(file_content)
+        if file_content == "broken":
+            return PdfRenderResult(success=False, msg="latex error")
+        return PdfRenderResult(
+            success=True, bon=RenderedPdf(mime_type="application/pdf", content=file_content.encode())
+        )
+
+    monkeypatch.setattr(pdflatex, "_latexmk", fake_latexmk)
+    renderer = LatexRenderer(max_concurrent=2, cache_size=3)
+
+    results = await asyncio.gather(*(renderer.render(f"doc {i % 4}") for i in range(8)))
+    # identical documents in flight are compiled once
+    assert sorted(compiled) == ["doc 0", "doc 1", "doc 2", "doc 3"]
+    assert max_running == 2
+    assert len(build_dirs) == 2
+    assert [r.bon.content for r in results if r.bon is not None] == [f"doc {i % 4}".encode() for i in range(8)]
+
+    # the least recently used document was evicted from the cache
+    compiled.clear()
+    await renderer.render("doc 3")
+    await renderer.render("doc 0")
+    assert compiled == ["doc 0"]
+
+    # failures are not cached
+    assert not (await renderer.render("broken")).success
+    assert not (await renderer.render("broken")).success
+    assert compiled == ["doc 0", "broken", "broken"]
+
+
+async def test_latex_renderer_cancellation(monkeypatch, tmp_path: Path):
+    compiled: list[str] = []
+    release = asyncio.Event()
+
+    async def fake_latexmk(build_dir: Path, file_content: str) -> PdfRenderResult:
+        await release.wait()
+        compiled.append(file_content)
+        return PdfRenderResult(
+            success=True, bon=RenderedPdf(mime_type="application/pdf", content=file_content.encode())
+        )
+
+    with monkeypatch.context() as m:
+        m.setattr(pdflatex, "_latexmk", fake_latexmk)
+        renderer = LatexRenderer(max_concurrent=1)
+
+        # a cancelled request does not abort the compilation the other requests wait for
+        first = asyncio.create_task(renderer.render("doc"))
+        second = asyncio.create_task(renderer.render("doc"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        assert (await second).success
+        assert first.cancelled()
+        assert compiled == ["doc"]
+
+    # an aborted compilation kills latex before its build directory is reused
+    pid_file = tmp_path / "latexmk.pid"
+    fake_latexmk_bin = tmp_path / "latexmk"
+    fake_latexmk_bin.write_text(f"#!/bin/sh\necho $$ > {pid_file}\nexec sleep 60\n")
+    fake_latexmk_bin.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    compilation = asyncio.create_task(renderer._compile("doc"))
+    async with asyncio.timeout(5):
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            await asyncio.sleep(0.01)
+    compilation.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await compilation
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    assert renderer._get_free_slots().qsize() == 1
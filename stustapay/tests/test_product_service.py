@@ -1,4 +1,7 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+
+import asyncpg
 import pytest
 from asyncpg import RaiseError
 from sftkit.database import Connection
@@ -6,8 +9,9 @@ from sftkit.database import Connection
 from stustapay.core.schema.product import NewProduct
 from stustapay.core.schema.tax_rate import TaxRate
 from stustapay.core.schema.tree import NewNode, Node
+from stustapay.core.service.common.cache import NodeCache, run_node_cache_invalidation
 from stustapay.core.service.common.error import AccessDenied
-from stustapay.core.service.product import ProductService
+from stustapay.core.service.product import ProductService, fetch_discount_product
 
 from ..core.service.tree.service import create_node
 from .conftest import Cashier
@@ -107,3 +111,44 @@ async def test_product_name_is_unique_in_tree(
             node_id=sub_sub_node.id,
             product=product,
         )
+
+
+async def test_constant_product_cache_invalidation(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, event_node: Node
+):
+    invalidation_task = asyncio.create_task(run_node_cache_invalidation(setup_test_db_pool))
+    try:
+        while not NodeCache.is_active():
+            await asyncio.sleep(0.01)
+
+        async def fetch_cached_discount_product():
+            with NodeCache.transaction():
+                return await fetch_discount_product(conn=db_connection, node=event_node)
+
+        discount_product = await fetch_cached_discount_product()
+        assert await fetch_cached_discount_product() is discount_product
+
+        await db_connection.execute("update product set name = 'changed discount' where id = $1", discount_product.id)
+        async with asyncio.timeout(5):
+            while (await fetch_cached_discount_product()).name != "changed discount":
+                await asyncio.sleep(0.01)
+
+        # a product read from a snapshot taken before a change must not be cached, even if the invalidation
+        # arrived before the product was read
+        with NodeCache.transaction():
+            async with db_connection.transaction(isolation="repeatable_read"):
+                await db_connection.execute("select 1")
+                version = NodeCache.version
+                async with setup_test_db_pool.acquire() as conn:
+                    await conn.execute("update product set name = 'new discount' where id = $1", discount_product.id)
+                async with asyncio.timeout(5):
+                    while NodeCache.version == version:
+                        await asyncio.sleep(0.01)
+                stale_product = await fetch_discount_product(conn=db_connection, node=event_node)
+                assert stale_product.name == "changed discount"
+        assert (await fetch_cached_discount_product()).name == "new discount"
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
+
+    assert not NodeCache.is_active()
@@ -1,10 +1,18 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,no-value-for-parameter
+import asyncio
+
+import asyncpg
 import pytest
 from asyncpg import RaiseError
 from sftkit.database import Connection
 
 from stustapay.core.schema.tree import ROOT_NODE_ID, NewEvent, NewNode, Node, ObjectType
-from stustapay.core.service.tree.common import fetch_node
+from stustapay.core.service.tree.common import (
+    fetch_node,
+    fetch_restricted_event_settings_for_node,
+    node_tree,
+    run_node_tree_cache,
+)
 from stustapay.core.service.tree.service import TreeService
 from stustapay.tests.common import list_equals
 
@@ -246,3 +254,111 @@ async def test_object_rules(tree_service: TreeService, global_admin_token: str):
         ],
         sub_node.computed_forbidden_objects_in_subtree,
     )
+
+
+async def test_node_tree_cache(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    tree_service: TreeService,
+    global_admin_token: str,
+    event_node: Node,
+):
+    cache_task = asyncio.create_task(run_node_tree_cache(setup_test_db_pool))
+    try:
+        while not node_tree.is_loaded:
+            await asyncio.sleep(0.01)
+
+        cached_node = await fetch_node(conn=db_connection, node_id=event_node.id)
+        assert cached_node is not None
+        assert node_tree.nodes is not None and cached_node is node_tree.nodes[event_node.id]
+        assert cached_node == await fetch_node(conn=db_connection, node_id=event_node.id, use_cache=False)
+        assert await fetch_restricted_event_settings_for_node(
+            conn=db_connection, node_id=event_node.id
+        ) == await fetch_restricted_event_settings_for_node(conn=db_connection, node_id=event_node.id, use_cache=False)
+
+        loads = node_tree.loads
+        await tree_service.update_node(
+            token=global_admin_token,
+            node_id=event_node.id,
+            updated_node=NewNode(name="Renamed test event", description=""),
+        )
+        async with asyncio.timeout(5):
+            while node_tree.loads == loads:
+                await asyncio.sleep(0.01)
+        updated_node = await fetch_node(conn=db_connection, node_id=event_node.id)
+        assert updated_node is not None
+        assert updated_node.name == "Renamed test event"
+    finally:
+        cache_task.cancel()
+        await cache_task
+
+    assert not node_tree.is_loaded
+
+
+async def _assert_computed_forbidden_consistent(conn: Connection):
+    nodes = await conn.fetch("select id, parent from node order by id")
+    forbidden_at_node = await conn.fetch("select node_id, object_name from forbidden_objects_at_node")
+    forbidden_in_subtree = await conn.fetch("select node_id, object_name from forbidden_objects_in_subtree_at_node")
+    materialized = {
+        row["node_id"]: row
+        for row in await conn.fetch(
+            "select node_id, computed_forbidden_at_node, computed_forbidden_in_subtree from node_computed_forbidden"
+        )
+    }
+
+    children: dict[int, list[int]] = {}
+    for node in nodes:
+        if node["id"] != ROOT_NODE_ID:
+            children.setdefault(node["parent"], []).append(node["id"])
+
+    expected: dict[int, tuple[set[str], set[str]]] = {ROOT_NODE_ID: (set(), set())}
+    to_visit = [ROOT_NODE_ID]
+    while to_visit:
+        parent = to_visit.pop()
+        for child in children.get(parent, []):
+            own_at_node = {r["object_name"] for r in forbidden_at_node if r["node_id"] == child}
+            own_in_subtree = {r["object_name"] for r in forbidden_in_subtree if r["node_id"] == child}
+            expected[child] = (expected[parent][1] | own_at_node, expected[parent][1] | own_in_subtree)
+            to_visit.append(child)
+
+    assert materialized.keys() == expected.keys()
+    for node_id, (at_node, in_subtree) in expected.items():
+        assert set(materialized[node_id]["computed_forbidden_at_node"]) == at_node
+        assert set(materialized[node_id]["computed_forbidden_in_subtree"]) == in_subtree
+
+
+async def test_computed_forbidden_objects_follow_changes(
+    db_connection: Connection, tree_service: TreeService, global_admin_token: str
+):
+    top_node = await tree_service.create_node(
+        token=global_admin_token, node_id=ROOT_NODE_ID, new_node=NewNode(name="top", description="")
+    )
+    middle_node = await tree_service.create_node(
+        token=global_admin_token, node_id=top_node.id, new_node=NewNode(name="middle", description="")
+    )
+    leaf_node = await tree_service.create_node(
+        token=global_admin_token,
+        node_id=middle_node.id,
+        new_node=NewNode(name="leaf", description="", forbidden_objects_at_node=[ObjectType.till]),
+    )
+    await _assert_computed_forbidden_consistent(db_connection)
+
+    # forbidding objects in a subtree has to be propagated to all existing descendants
+    await tree_service.update_node(
+        token=global_admin_token,
+        node_id=top_node.id,
+        updated_node=NewNode(name="top", description="", forbidden_objects_in_subtree=[ObjectType.ticket]),
+    )
+    await _assert_computed_forbidden_consistent(db_connection)
+    leaf_node = await fetch_node(conn=db_connection, node_id=leaf_node.id, use_cache=False)
+    assert leaf_node is not None
+    assert ObjectType.ticket in leaf_node.computed_forbidden_objects_at_node
+    assert ObjectType.ticket in leaf_node.computed_forbidden_objects_in_subtree
+
+    await tree_service.update_node(
+        token=global_admin_token, node_id=top_node.id, updated_node=NewNode(name="top", description="")
+    )
+    await _assert_computed_forbidden_consistent(db_connection)
+    leaf_node = await fetch_node(conn=db_connection, node_id=leaf_node.id, use_cache=False)
+    assert leaf_node is not None
+    assert ObjectType.ticket not in leaf_node.computed_forbidden_objects_in_subtree
@@ -0,0 +1,78 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,protected-access
+import asyncpg
+from sftkit.database import Connection
+
+from stustapay.tse.balancer import TSEBalancer
+from stustapay.tse.wrapper import TSEWrapper
+
+from .conftest import Cashier, CreateSignatureRequest, CreateTill, CreateTse
+
+
+async def test_assign_unassigned_tills(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    create_tse: CreateTse,
+    create_till: CreateTill,
+    create_signature_request: CreateSignatureRequest,
+):
+    slow_tse = await create_tse()
+    fast_tse = await create_tse()
+    tses = {tse.id: TSEWrapper(tse_id=tse.id, factory_function=lambda: None) for tse in (slow_tse, fast_tse)}
+    tses[slow_tse.id]._recent_durations.append(100)
+    tses[fast_tse.id]._recent_durations.append(0.01)
+    till = await create_till()
+    idle_till = await create_till()
+    await create_signature_request(till.id)
+
+    balancer = TSEBalancer(db_pool=setup_test_db_pool, tses=tses)
+    await balancer.assign_unassigned_tills(db_connection)
+    assert await db_connection.fetchval("select tse_id from till where id = $1", till.id) == fast_tse.id
+    # tills without signature requests are only assigned once they need a TSE
+    assert await db_connection.fetchval("select tse_id from till where id = $1", idle_till.id) is None
+
+
+async def test_rebalance(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    create_tse: CreateTse,
+    create_till: CreateTill,
+    cashier: Cashier,
+):
+    busy_tse = await create_tse()
+    idle_tse = await create_tse()
+    tses = {tse.id: TSEWrapper(tse_id=tse.id, factory_function=lambda: None) for tse in (busy_tse, idle_tse)}
+    for wrapper in tses.values():
+        wrapper._recent_durations.append(1)
+    logged_in_till = await create_till(tse_id=busy_tse.id)
+    await db_connection.execute(
+        "update till set active_user_id = $2, active_user_role_id = $3 where id = $1",
+        logged_in_till.id,
+        cashier.id,
+        cashier.cashier_role.id,
+    )
+    idle_tills = [await create_till(tse_id=busy_tse.id) for _ in range(2)]
+
+    balancer = TSEBalancer(db_pool=setup_test_db_pool, tses=tses, rebalance_idle_tills=True)
+    await balancer.rebalance(db_connection)
+    # the till with a logged in user is in the middle of a closure and stays with its TSE
+    assert tses[busy_tse.id]._till_moves == {str(idle_tills[0].id): idle_tse.id}
+
+    # the idle till is moved, its move is recorded although it was never registered on the TSE
+    tses[busy_tse.id].request_till_move(str(logged_in_till.id), idle_tse.id)
+    await tses[busy_tse.id]._move_tills(db_connection)
+    assert tses[busy_tse.id]._till_moves == {}
+    tills = dict(
+        await db_connection.fetch(
+            "select id, tse_id from till where id = any($1)", [logged_in_till.id, idle_tills[0].id]
+        )
+    )
+    assert tills == {logged_in_till.id: busy_tse.id, idle_tills[0].id: idle_tse.id}
+    history = await db_connection.fetch(
+        "select till_id, tse_id, what, z_nr from till_tse_history where till_id = any($1)",
+        [str(logged_in_till.id), str(idle_tills[0].id)],
+    )
+    assert [tuple(row) for row in history] == [(str(idle_tills[0].id), busy_tse.id, "deregister", idle_tills[0].z_nr)]
+
+    # the tses are balanced now
+    await balancer.rebalance(db_connection)
+    assert tses[busy_tse.id]._till_moves == {}
@@ -0,0 +1,73 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import uuid
+
+import asyncpg
+
+from stustapay.core.config import Config
+from stustapay.core.schema.tree import Node
+from stustapay.core.schema.tse import NewTse, TseType
+from stustapay.core.service.tse import TseService, render_prometheus_metrics
+from stustapay.tse.signature_processor import SignatureProcessor
+from stustapay.tse.wrapper import TSEWrapper
+
+
+async def test_tse_metrics(
+    setup_test_db_pool: asyncpg.Pool,
+    config: Config,
+    tse_service: TseService,
+    event_node: Node,
+    event_admin_token: str,
+):
+    tse = await tse_service.create_tse(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_tse=NewTse(
+            name=f"tse-{uuid.uuid4()}",
+            type=TseType.diebold_nixdorf,
+            serial=f"serial-{uuid.uuid4()}",
+            ws_url="ws://localhost:10001",
+            ws_timeout=5,
+            password="12345",
+        ),
+    )
+    assert await tse_service.list_tse_metrics(token=event_admin_token, node_id=event_node.id) == []
+
+    wrapper = TSEWrapper(tse_id=tse.id, factory_function=lambda: None)  # type: ignore
+    wrapper.name = tse.name
+    wrapper.metrics.queue_wait.observe(0.01)
+    wrapper.metrics.queue_wait.observe(0.3)
+    wrapper.metrics.observe_request("StartTransaction", 0.02)
+    wrapper.metrics.observe_request("FinishTransaction", 0.2)
+    wrapper.metrics.request_timed_out("FinishTransaction")
+    wrapper.metrics.signature_done(0.5)
+    wrapper.metrics.signature_failed()
+
+    processor = SignatureProcessor(config)
+    processor.db_pool = setup_test_db_pool
+    processor.tses = {tse.id: wrapper}
+    await processor.export_metrics()
+    # snapshots are overwritten
+    wrapper.metrics.signature_done(70)
+    await processor.export_metrics()
+
+    metrics = await tse_service.list_tse_metrics(token=event_admin_token, node_id=event_node.id)
+    assert len(metrics) == 1
+    tse_metrics = metrics[0]
+    assert tse_metrics.tse_name == tse.name
+    assert tse_metrics.signatures_done == 2
+    assert tse_metrics.signatures_failed == 1
+    assert tse_metrics.queue_wait.count == 2
+    assert tse_metrics.queue_wait.counts[tse_metrics.queue_wait.buckets.index(0.01)] == 1
+    assert tse_metrics.end_to_end.counts[-1] == 1
+    assert set(tse_metrics.request_round_trip.keys()) == {"StartTransaction", "FinishTransaction"}
+    assert tse_metrics.request_timeouts == {"FinishTransaction": 1}
+
+    prometheus = render_prometheus_metrics(metrics).splitlines()
+    assert "# TYPE stustapay_tse_queue_wait_seconds histogram" in prometheus
+    # buckets are cumulative
+    assert f'stustapay_tse_queue_wait_seconds_bucket{{tse="{tse.name}",le="0.25"}} 1' in prometheus
+    assert f'stustapay_tse_queue_wait_seconds_bucket{{tse="{tse.name}",le="0.5"}} 2' in prometheus
+    assert f'stustapay_tse_queue_wait_seconds_bucket{{tse="{tse.name}",le="+Inf"}} 2' in prometheus
+    assert f'stustapay_tse_order_signature_latency_seconds_count{{tse="{tse.name}"}} 2' in prometheus
+    assert f'stustapay_tse_signatures_total{{tse="{tse.name}",result="failed"}} 1' in prometheus
+    assert f'stustapay_tse_request_timeouts_total{{tse="{tse.name}",command="FinishTransaction"}} 1' in prometheus
@@ -0,0 +1,97 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+import base64
+import json
+import time
+from datetime import datetime
+from hashlib import sha256, sha384
+
+import ecdsa
+
+from stustapay.tse.diebold_nixdorf_usb.simulator import VirtualTSE
+from stustapay.tse.diebold_nixdorf_usb.tse_verifier import (
+    CertifiedData,
+    SignatureAlgorithm_seq,
+    TransactionData,
+)
+
+PASSWORD = base64.b64encode(b"12345").decode("ascii")
+
+
+async def _request(tse: VirtualTSE, **msg) -> dict:
+    response = await tse.parse_input(f"\x02{json.dumps(msg)}\x03\n")
+    assert response is not None
+    return json.loads(response.strip("\x02\n\x03"))
+
+
+async def test_simulator_signs_concurrently():
+    tse = VirtualTSE(
+        delay=0.2, fast=False, real=True, private_key_hex=None, gen_key=False, broken=False, signing_pool=None
+    )
+    client_ids = [str(i) for i in range(5)]
+    for client_id in client_ids:
+        await _request(tse, Command="RegisterClientID", ClientID=client_id, Password=PASSWORD)
+
+    start = time.monotonic()
+    started = await asyncio.gather(
+        *(_request(tse, Command="StartTransaction", ClientID=client_id, Password=PASSWORD) for client_id in client_ids)
+    )
+    # the artificial delays of the requests overlap
+    assert time.monotonic() - start < 0.5
+    assert sorted(s["TransactionNumber"] for s in started) == [1, 2, 3, 4, 5]
+
+    finished = await asyncio.gather(
+        *(
+            _request(
+                tse,
+                Command="FinishTransaction",
+                ClientID=client_id,
+                Password=PASSWORD,
+                TransactionNumber=s["TransactionNumber"],
+                Typ="Kassenbeleg-V1",
+                Data="Beleg^1.00_0.00_0.00_0.00_0.00^1.00:Bar",
+            )
+            for client_id, s in zip(client_ids, started)
+        )
+    )
+
+    # the signatures verify against the message built from the ASN.1 sequences, like in the tse_verifier
+    verifying_key = ecdsa.VerifyingKey.from_string(tse.public_key, curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384)
+    for client_id, s, f in zip(client_ids, started, finished):
+        assert f["Status"] == "ok"
+        signature_algorithm = SignatureAlgorithm_seq()
+        signature_algorithm["signatureAlgorithm"] = "0.4.0.127.0.7.1.1.4.1.4"
+        certified_data = CertifiedData()
+        certified_data["operationType"] = "FinishTransaction"
+        certified_data["clientId"] = client_id
+        certified_data["ProcessData"] = b"Beleg^1.00_0.00_0.00_0.00_0.00^1.00:Bar"
+        certified_data["ProcessType"] = "Kassenbeleg-V1"
+        certified_data["transactionNumber"] = s["TransactionNumber"]
+        data = TransactionData()
+        data["Version"] = 2
+        data["CertifiedDataType"] = "0.4.0.127.0.7.3.7.1.1"
+        data["CertifiedData"] = certified_data
+        data["SerialNumber"] = sha256(tse.public_key).digest()
+        data["signatureAlgorithm"] = signature_algorithm
+        data["signatureCounter"] = f["SignatureCounter"]
+        data["LogTime"] = int(datetime.fromisoformat(f["LogTime"]).timestamp())
+        message = (
+            data["Version"].dump()
+            + data["CertifiedDataType"].dump()
+            + certified_data["operationType"].dump()
+            + certified_data["clientId"].dump()
+            + certified_data["ProcessData"].dump()
+            + certified_data["ProcessType"].dump()
+            + certified_data["transactionNumber"].dump()
+            + data["SerialNumber"].dump()
+            + data["signatureAlgorithm"].dump()
+            + data["signatureCounter"].dump()
+            + data["LogTime"].dump()
+        )
+        assert verifying_key.verify(bytes.fromhex(f["Signature"]), message)
+
+    # additional simulated TSEs have their own keys
+    other_tse = VirtualTSE(
+        delay=0, fast=True, real=True, private_key_hex=None, gen_key=False, broken=False, key_index=1
+    )
+    assert other_tse.public_key != tse.public_key
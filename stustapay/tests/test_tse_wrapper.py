@@ -0,0 +1,211 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,protected-access
+import asyncio
+
+import asyncpg
+from sftkit.database import Connection
+
+from stustapay.core.schema.tse import TseStatus
+from stustapay.tse.handler import (
+    TSEHandler,
+    TSEMasterData,
+    TSESignature,
+    TSESignatureRequest,
+)
+from stustapay.tse.wrapper import TSEWrapper
+
+from .conftest import CreateSignatureRequest, CreateTill, CreateTse
+
+
+class FakeTSEHandler(TSEHandler):
+    """
+    signs after a delay, keeping track of the concurrently signed requests
+    """
+
+    def __init__(self, serial: str, delay: float = 0.05):
+        self.serial = serial
+        self.delay = delay
+        self.client_ids: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.signing_till_ids: set[str] = set()
+        # till id, order id of all signed requests, in the order they were started
+        self.started: list[tuple[str, int]] = []
+        self.timed_out_order_ids: set[int] = set()
+
+    async def start(self) -> bool:
+        return True
+
+    async def stop(self):
+        pass
+
+    async def register_client_id(self, client_id: str):
+        self.client_ids.append(client_id)
+
+    async def deregister_client_id(self, client_id: str):
+        self.client_ids.remove(client_id)
+
+    async def sign(self, request: TSESignatureRequest) -> TSESignature:
+        assert request.till_id in self.client_ids
+        assert request.till_id not in self.signing_till_ids
+        self.started.append((request.till_id, request.order_id))
+        self.signing_till_ids.add(request.till_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+            self.signing_till_ids.remove(request.till_id)
+        if request.order_id in self.timed_out_order_ids:
+            raise asyncio.TimeoutError()
+        return TSESignature(
+            tse_transaction=str(request.order_id),
+            tse_signaturenr=str(request.order_id),
+            tse_start="2023-04-24T14:46:54.000Z",
+            tse_end="2023-04-24T14:46:55.000Z",
+            tse_signature="c2lnbmF0dXJl",
+        )
+
+    async def get_client_ids(self) -> list[str]:
+        return list(self.client_ids)
+
+    def get_master_data(self) -> TSEMasterData:
+        return TSEMasterData(
+            tse_serial=self.serial,
+            tse_hashalgo="ecdsa-plain-SHA384",
+            tse_time_format="unixTime",
+            tse_public_key="key",
+            tse_certificate="certificate",
+            tse_process_data_encoding="UTF-8",
+        )
+
+    def is_stop_set(self) -> bool:
+        return False
+
+    def __str__(self):
+        return f"FakeTSEHandler({self.serial})"
+
+
+async def test_pipelined_signing(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    create_tse: CreateTse,
+    create_till: CreateTill,
+    create_signature_request: CreateSignatureRequest,
+):
+    tse = await create_tse(status=TseStatus.new)
+    order_ids: dict[str, list[int]] = {}
+    for _ in range(5):
+        till = await create_till(tse_id=tse.id)
+        order_ids[str(till.id)] = [await create_signature_request(till.id) for _ in range(3)]
+    timed_out_order_id = order_ids[min(order_ids)][0]
+
+    handler = FakeTSEHandler(serial=tse.serial)
+    handler.timed_out_order_ids.add(timed_out_order_id)
+    wrapper = TSEWrapper(tse_id=tse.id, factory_function=lambda: handler, max_in_flight=3)
+    wrapper.start(setup_test_db_pool)
+    try:
+        all_order_ids = [order_id for ids in order_ids.values() for order_id in ids]
+        async with asyncio.timeout(10):
+            while await db_connection.fetchval(
+                "select count(*) from tse_signature where id = any($1) and signature_status in ('new', 'pending')",
+                all_order_ids,
+            ):
+                await asyncio.sleep(0.05)
+    finally:
+        await wrapper.stop()
+
+    # requests of different tills are signed concurrently, but never more than max_in_flight
+    assert handler.max_in_flight == 3
+    # the requests of each till are signed one after another in order, also after a failed request
+    for till_id, ids in order_ids.items():
+        assert [order_id for started_till_id, order_id in handler.started if started_till_id == till_id] == ids
+    statuses = dict(
+        await db_connection.fetch("select id, signature_status from tse_signature where id = any($1)", all_order_ids)
+    )
+    assert statuses.pop(timed_out_order_id) == "failure"
+    assert set(statuses.values()) == {"done"}
+
+
+async def _finish_requests(conn: Connection, order_ids: list[int]):
+    await conn.execute(
+        "update tse_signature set signature_status = 'failure', result_message = 'test' where id = any($1)",
+        order_ids,
+    )
+
+
+async def test_claim_next_requests(
+    db_connection: Connection,
+    create_tse: CreateTse,
+    create_till: CreateTill,
+    create_signature_request: CreateSignatureRequest,
+):
+    tse = await create_tse()
+    order_ids: dict[str, list[int]] = {}
+    for _ in range(4):
+        till = await create_till(tse_id=tse.id)
+        order_ids[str(till.id)] = [await create_signature_request(till.id) for _ in range(2)]
+    busy_till_id, *idle_till_ids = order_ids
+    await db_connection.execute(
+        "update tse_signature set signature_status = 'pending', tse_id = $2 where id = $1",
+        order_ids[busy_till_id][0],
+        tse.id,
+    )
+
+    wrapper = TSEWrapper(tse_id=tse.id, factory_function=lambda: None)
+    # the limit is respected, the oldest request of each till is claimed first
+    requests = await wrapper._grab_next_requests(db_connection, limit=2, timeout=0)
+    assert [(request.till_id, request.order_id) for request in requests] == [
+        (till_id, order_ids[till_id][0]) for till_id in idle_till_ids[:2]
+    ]
+    # at most one request is claimed per till, tills with a request in flight are skipped
+    requests += await wrapper._grab_next_requests(db_connection, limit=10, timeout=0)
+    assert [(request.till_id, request.order_id) for request in requests] == [
+        (till_id, order_ids[till_id][0]) for till_id in idle_till_ids
+    ]
+    assert await wrapper._grab_next_requests(db_connection, limit=10, timeout=0) == []
+
+    await _finish_requests(db_connection, [order_ids[busy_till_id][0]])
+    requests = await wrapper._grab_next_requests(db_connection, limit=10, timeout=0)
+    assert [(request.till_id, request.order_id) for request in requests] == [(busy_till_id, order_ids[busy_till_id][1])]
+
+
+async def test_concurrent_claims(
+    setup_test_db_pool: asyncpg.Pool,
+    create_tse: CreateTse,
+    create_till: CreateTill,
+    create_signature_request: CreateSignatureRequest,
+):
+    tse = await create_tse()
+    order_ids: dict[str, list[int]] = {}
+    for _ in range(20):
+        till = await create_till(tse_id=tse.id)
+        order_ids[str(till.id)] = [await create_signature_request(till.id) for _ in range(3)]
+
+    claimed: list[tuple[str, int]] = []
+
+    async def claimer():
+        wrapper = TSEWrapper(tse_id=tse.id, factory_function=lambda: None)
+        async with setup_test_db_pool.acquire() as conn:
+            while True:
+                requests = await wrapper._grab_next_requests(conn, limit=4, timeout=0)
+                if not requests:
+                    return
+                claimed.extend((request.till_id, request.order_id) for request in requests)
+                assert not await conn.fetchval(
+                    "select count(*) from ("
+                    "   select ordr.till_id from tse_signature join ordr on ordr.id = tse_signature.id "
+                    "   where tse_signature.signature_status = 'pending' group by ordr.till_id having count(*) > 1"
+                    ") as t"
+                )
+                await asyncio.sleep(0.01)
+                await _finish_requests(conn, [request.order_id for request in requests])
+
+    await asyncio.gather(claimer(), claimer())
+
+    # every request was claimed exactly once, the requests of each till in order
+    assert sorted(order_id for _, order_id in claimed) == sorted(
+        order_id for ids in order_ids.values() for order_id in ids
+    )
+    for till_id, ids in order_ids.items():
+        assert [order_id for claimed_till_id, order_id in claimed if claimed_till_id == till_id] == ids
@@ -1,9 +1,21 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import asyncio
+import secrets
+
+import asyncpg
 import pytest
+from sftkit.database import Connection
 
-from stustapay.core.service.common.error import AccessDenied
+from stustapay.core.schema.tree import NewNode, Node
+from stustapay.core.schema.user import NewUser, NewUserRole, NewUserToRoles, Privilege
+from stustapay.core.service.auth import AuthService, fetch_user_privileges_at_node
+from stustapay.core.service.common.cache import TokenCache, run_token_cache_invalidation
+from stustapay.core.service.common.error import AccessDenied, Unauthorized
+from stustapay.core.service.tree.service import TreeService
 from stustapay.core.service.user import UserService
 
+from .conftest import CreateRandomUserTag
+
 
 async def test_change_password(user_service: UserService, event_admin_user, event_admin_token: str):
     usr, password = event_admin_user
@@ -12,3 +24,162 @@ async def test_change_password(user_service: UserService, event_admin_user, even
     await user_service.change_password(token=event_admin_token, old_password=password, new_password="asdf")
 
     await user_service.login_user(username=usr.login, password="asdf")
+
+
+async def test_user_token_cache_evicted_on_logout(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    auth_service: AuthService,
+    user_service: UserService,
+    event_admin_user,
+):
+    usr, password = event_admin_user
+    invalidation_task = asyncio.create_task(run_token_cache_invalidation(setup_test_db_pool))
+    try:
+        while not TokenCache.is_active():
+            await asyncio.sleep(0.01)
+
+        login = await user_service.login_user(username=usr.login, password=password)
+        assert login.success is not None
+        token = login.success.token
+
+        hits = TokenCache.stats()["user_tokens"]["hits"]
+        first = await auth_service.get_user_from_token(token=token)
+        second = await auth_service.get_user_from_token(token=token)
+        assert first is not None and first == second and first is not second
+        # the login itself already validated and cached the new token
+        assert TokenCache.stats()["user_tokens"]["hits"] == hits + 2
+
+        await user_service.logout_user(token=token)
+        async with asyncio.timeout(5):
+            while await auth_service.get_user_from_token(token=token) is not None:
+                await asyncio.sleep(0.01)
+        with pytest.raises(Unauthorized):
+            await user_service.logout_user(token=token)
+
+        # a session read from a snapshot taken before the logout must not be cached, even if the eviction
+        # arrived before it was read
+        login = await user_service.login_user(username=usr.login, password=password)
+        assert login.success is not None
+        token = login.success.token
+        with TokenCache.transaction():
+            async with db_connection.transaction(isolation="repeatable_read"):
+                await db_connection.execute("select 1")
+                version = TokenCache.version
+                await user_service.logout_user(token=token)
+                async with asyncio.timeout(5):
+                    while TokenCache.version == version:
+                        await asyncio.sleep(0.01)
+                assert await auth_service.get_user_from_token(conn=db_connection, token=token) is not None
+        assert await auth_service.get_user_from_token(token=token) is None
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
+
+    assert not TokenCache.is_active()
+
+
+async def test_user_privileges_follow_role_changes(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    user_service: UserService,
+    tree_service: TreeService,
+    event_node: Node,
+    event_admin_token: str,
+    create_random_user_tag: CreateRandomUserTag,
+):
+    user_tag = await create_random_user_tag()
+    usr = await user_service.create_user(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_user=NewUser(
+            login=f"privileged-user {secrets.token_hex(16)}",
+            display_name="",
+            user_tag_uid=user_tag.uid,
+            user_tag_pin=user_tag.pin,
+        ),
+    )
+    invalidation_task = asyncio.create_task(run_token_cache_invalidation(setup_test_db_pool))
+    try:
+        while not TokenCache.is_active():
+            await asyncio.sleep(0.01)
+
+        async def privileges_at(node_id: int) -> frozenset[str]:
+            with TokenCache.transaction():
+                return await fetch_user_privileges_at_node(conn=db_connection, user_id=usr.id, node_id=node_id)
+
+        async def wait_for_privileges(node_id: int, expected: set[str]):
+            async with asyncio.timeout(5):
+                while await privileges_at(node_id) != expected:
+                    await asyncio.sleep(0.01)
+
+        child_node = await tree_service.create_node(
+            token=event_admin_token, node_id=event_node.id, new_node=NewNode(name="child", description="")
+        )
+        assert await privileges_at(child_node.id) == frozenset()
+
+        role = await user_service.create_user_role(
+            token=event_admin_token,
+            node_id=event_node.id,
+            new_role=NewUserRole(name="child-role", privileges=[Privilege.can_book_orders]),
+        )
+        await user_service.update_user_to_roles(
+            token=event_admin_token,
+            node_id=child_node.id,
+            user_to_roles=NewUserToRoles(user_id=usr.id, role_ids=[role.id]),
+        )
+        await wait_for_privileges(child_node.id, {Privilege.can_book_orders.name})
+        assert await privileges_at(event_node.id) == frozenset()
+
+        # privileges are inherited by newly created nodes
+        grandchild_node = await tree_service.create_node(
+            token=event_admin_token, node_id=child_node.id, new_node=NewNode(name="grandchild", description="")
+        )
+        assert await privileges_at(grandchild_node.id) == {Privilege.can_book_orders.name}
+
+        # changing the privileges of a role updates all users having this role
+        await user_service.update_user_role_privileges(
+            token=event_admin_token,
+            node_id=event_node.id,
+            role_id=role.id,
+            is_privileged=False,
+            privileges=[Privilege.cash_transport],
+        )
+        await wait_for_privileges(child_node.id, {Privilege.cash_transport.name})
+        await wait_for_privileges(grandchild_node.id, {Privilege.cash_transport.name})
+
+        await user_service.update_user_to_roles(
+            token=event_admin_token,
+            node_id=child_node.id,
+            user_to_roles=NewUserToRoles(user_id=usr.id, role_ids=[]),
+        )
+        await wait_for_privileges(grandchild_node.id, set())
+
+        # privileges read from a snapshot taken before a role change must not be cached, even if the eviction
+        # arrived before they were read
+        await user_service.update_user_to_roles(
+            token=event_admin_token,
+            node_id=child_node.id,
+            user_to_roles=NewUserToRoles(user_id=usr.id, role_ids=[role.id]),
+        )
+        await wait_for_privileges(child_node.id, {Privilege.cash_transport.name})
+        with TokenCache.transaction():
+            async with db_connection.transaction(isolation="repeatable_read"):
+                await db_connection.execute("select 1")
+                version = TokenCache.version
+                await user_service.update_user_to_roles(
+                    token=event_admin_token,
+                    node_id=child_node.id,
+                    user_to_roles=NewUserToRoles(user_id=usr.id, role_ids=[]),
+                )
+                async with asyncio.timeout(5):
+                    while TokenCache.version == version:
+                        await asyncio.sleep(0.01)
+                stale_privileges = await fetch_user_privileges_at_node(
+                    conn=db_connection, user_id=usr.id, node_id=child_node.id
+                )
+                assert stale_privileges == {Privilege.cash_transport.name}
+        assert await privileges_at(child_node.id) == frozenset()
+    finally:
+        invalidation_task.cancel()
+        await invalidation_task
@@ -0,0 +1,206 @@
+"""
+Distributes the tills over the connected TSEs according to their load
+"""
+
+import asyncio
+import dataclasses
+import logging
+import statistics
+import typing
+
+import asyncpg
+from sftkit.database import Connection
+
+from .wrapper import TSEWrapper
+
+LOGGER = logging.getLogger(__name__)
+
+# assumed signature latency of TSEs which have not signed anything yet, if no other TSE has either
+DEFAULT_SIGNATURE_LATENCY = 1.0
+
+
+@dataclasses.dataclass
+class TSELoad:
+    tse_id: int
+    name: str
+    # number of tills assigned to the TSE
+    n_tills: int
+    # number of new and pending signature requests of the assigned tills
+    queue_depth: int
+    # mean duration of the recent signatures in seconds
+    latency: float
+
+    def expected_wait(self) -> float:
+        """
+        time until a new request is signed
+        """
+        return (self.queue_depth + 1) * self.latency
+
+    def till_load(self, n_tills: int) -> float:
+        """
+        signing time spent per round of requests from n_tills tills
+        """
+        return n_tills * self.latency
+
+
+class TSEBalancer:
+    """
+    Assigns tills without a TSE to the active TSE with the shortest expected wait.
+
+    Optionally, idle tills are moved from the most loaded TSE to the least loaded one, one till per round.
+    Only tills without a logged in user are idle, so a till never changes its TSE within a closure.
+    The move itself is done by the wrapper of the old TSE, see TSEWrapper.request_till_move.
+    """
+
+    def __init__(
+        self,
+        db_pool: asyncpg.Pool,
+        tses: dict[int, TSEWrapper],
+        interval: float = 10,
+        rebalance_idle_tills: bool = False,
+    ):
+        self.db_pool = db_pool
+        self.tses = tses
+        self.interval = interval
+        self.rebalance_idle_tills = rebalance_idle_tills
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                async with self.db_pool.acquire() as conn:
+                    await self.assign_unassigned_tills(conn)
+                    if self.rebalance_idle_tills:
+                        await self.rebalance(conn)
+            except asyncpg.PostgresError:
+                LOGGER.exception("TSE balancing failed")
+
+    async def fetch_loads(self, conn: Connection) -> list[TSELoad]:
+        """
+        loads of all active TSEs which are handled by this signature processor
+        """
+        rows = await conn.fetch(
+            """
+            select
+                tse.id as tse_id,
+                tse.name,
+                (select count(*) from till where till.tse_id = tse.id) as n_tills,
+                (
+                    select count(*)
+                    from tse_signature join ordr on ordr.id=tse_signature.id join till on ordr.till_id=till.id
+                    where tse_signature.signature_status='new' and till.tse_id = tse.id
+                ) + (
+                    select count(*)
+                    from tse_signature join ordr on ordr.id=tse_signature.id join till on ordr.till_id=till.id
+                    where tse_signature.signature_status='pending' and till.tse_id = tse.id
+                ) as queue_depth
+            from
+                tse
+            where
+                tse.status='active' and
+                tse.id = any($1)
+            order by tse.id
+            """,
+            list(self.tses.keys()),
+        )
+        latencies = {tse_id: tse.mean_signature_duration() for tse_id, tse in self.tses.items()}
+        known_latencies = [latency for latency in latencies.values() if latency is not None]
+        fallback_latency = statistics.mean(known_latencies) if known_latencies else DEFAULT_SIGNATURE_LATENCY
+        loads = []
+        for row in rows:
+            latency = latencies.get(row["tse_id"])
+            loads.append(TSELoad(**row, latency=fallback_latency if latency is None else latency))
+        return loads
+
+    async def assign_unassigned_tills(self, conn: Connection):
+        """
+        Assigns tills with signature requests but no TSE.
+        The TSE registers the till when signing its first request.
+        """
+        unassigned_tills = await conn.fetch(
+            """
+            select distinct
+                till.id as till_id
+            from
+                tse_signature
+                join ordr on ordr.id=tse_signature.id
+                join till on ordr.till_id=till.id
+            where
+                tse_signature.signature_status='new' and
+                till.tse_id is null
+            order by till.id
+            """
+        )
+        if len(unassigned_tills) == 0:
+            return
+
+        LOGGER.info(f"{len(unassigned_tills)} till(s) need a TSE")
+        loads = await self.fetch_loads(conn)
+        if len(loads) == 0:
+            LOGGER.error("ERROR: no more active TSEs available")
+            LOGGER.warning("will set all signature requests to 'failure'")
+            await conn.execute(
+                "update tse_signature set signature_status='failure',result_message='TSE failure, no active TSE available', tse_id=1 where signature_status='new'"
+            )
+            return
+
+        for till in unassigned_tills:
+            target = min(loads, key=lambda load: (load.expected_wait(), load.n_tills))
+            assigned = await conn.fetchval(
+                "update till set tse_id = $1 where id = $2 and tse_id is null returning true",
+                target.tse_id,
+                till["till_id"],
+            )
+            if assigned:
+                LOGGER.info(
+                    f"Till with ID={till['till_id']} is assigned to TSE: {target.name} "
+                    f"(expected wait {target.expected_wait():.3f}s, {target.n_tills} tills)"
+                )
+                target.n_tills += 1
+                target.queue_depth += 1
+
+    async def rebalance(self, conn: Connection):
+        """
+        Moves one idle till from the most loaded TSE to the least loaded one, if that lowers the maximum load.
+        """
+        loads = await self.fetch_loads(conn)
+        if len(loads) < 2:
+            return
+        busiest = max(loads, key=lambda load: load.till_load(load.n_tills))
+        least = min(loads, key=lambda load: load.till_load(load.n_tills))
+        if busiest.till_load(busiest.n_tills - 1) <= least.till_load(least.n_tills + 1):
+            return
+
+        idle_till_id: typing.Optional[int] = await conn.fetchval(
+            """
+            select
+                till.id
+            from
+                till
+            where
+                till.tse_id = $1 and
+                till.active_user_id is null and
+                not till.is_virtual and
+                not exists (
+                    select 1
+                    from tse_signature join ordr on ordr.id=tse_signature.id
+                    where tse_signature.signature_status='new' and ordr.till_id=till.id
+                ) and
+                not exists (
+                    select 1
+                    from tse_signature join ordr on ordr.id=tse_signature.id
+                    where tse_signature.signature_status='pending' and ordr.till_id=till.id
+                )
+            order by till.id
+            limit 1
+            """,
+            busiest.tse_id,
+        )
+        if idle_till_id is None:
+            return
+        LOGGER.info(
+            f"moving idle till {idle_till_id} from TSE {busiest.name} ({busiest.n_tills} tills, "
+            f"{busiest.latency:.3f}s per signature) to TSE {least.name} ({least.n_tills} tills, "
+            f"{least.latency:.3f}s per signature)"
+        )
+        self.tses[busiest.tse_id].request_till_move(str(idle_till_id), least.tse_id)
@@ -4,6 +4,7 @@ import binascii
 import contextlib
 import json
 import logging
+import time
 import typing
 
 import aiohttp
@@ -133,17 +134,24 @@ class DieboldNixdorfUSBTSE(TSEHandler):
         await self._ws.send_str(f"\x02{json.dumps(request)}\x03\n")
         future: asyncio.Future[dict] = asyncio.Future()
         self.pending_requests[request_id] = future
+        start = time.monotonic()
         try:
             response = await asyncio.wait_for(future, timeout=timeout)
+            if self.metrics is not None:
+                self.metrics.observe_request(command, time.monotonic() - start)
             LOGGER.info(f"{self}: << {response}")
             command_back = response.pop("Command")
             if command_back != command:
                 raise RuntimeError(f"{self}: wrong command returned while processing {request}: {response}")
             status = response.pop("Status")
             if status != "ok":
+                if self.metrics is not None:
+                    self.metrics.request_failed(command)
                 raise RequestError(self._name, request, response)
             return response
         except asyncio.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.request_timed_out(command)
             error_message = f"{self}: timeout while waiting for response to {request}"
             LOGGER.error(error_message)
             raise asyncio.TimeoutError(error_message) from None
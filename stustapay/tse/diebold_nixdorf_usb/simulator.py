@@ -4,32 +4,35 @@ this code will simulate the dn TSE webservice (more or less)
 
 # TODO should we rename Transaction to Order here as well?
 
+import asyncio
 import base64
 import binascii
+import concurrent.futures
+import functools
 import json
 import logging
 import re
-import time
+import socket
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256, sha384
-from inspect import stack
 from random import randbytes, randrange
 from typing import Optional
 
 import ecdsa
 import uvicorn
 from asn1crypto.core import (
-    Any,
     Integer,
     ObjectIdentifier,
     OctetString,
     PrintableString,
     Sequence,
 )
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 
 from stustapay.tse.diebold_nixdorf_usb.protocol import TseResponse, TseSuccess, dnerror
 
+LOGGER = logging.getLogger(__name__)
+
 
 class SignatureAlgorithm_seq(Sequence):
     _fields = [
@@ -38,41 +41,46 @@ class SignatureAlgorithm_seq(Sequence):
     ]
 
 
-class CertifiedData(Sequence):
-    _fields = [
-        ("operationType", PrintableString, {"implicit": 0}),
-        ("clientId", PrintableString, {"implicit": 1}),
-        ("ProcessData", OctetString, {"implicit": 2}),
-        ("ProcessType", PrintableString, {"implicit": 3}),
-        ("additionalExternalData", OctetString, {"implicit": 4, "optional": True}),
-        ("transactionNumber", Integer, {"implicit": 5}),
-        ("additionalInternalData", OctetString, {"implicit": 6, "optional": True}),
-    ]
+MAGIC_PRODUCTION_CLIENT = "DN TSEProduction ef82abcedf"
 
 
-class TransactionData(Sequence):
-    _fields = [
-        ("Version", Integer),
-        ("CertifiedDataType", ObjectIdentifier),
-        ("CertifiedData", Any),
-        ("SerialNumber", OctetString),
-        ("signatureAlgorithm", Sequence),
-        ("signatureCounter", Integer),
-        ("LogTime", Integer),  # unixTime!
-    ]
+@functools.lru_cache(maxsize=None)
+def _signing_key(private_key: bytes) -> ecdsa.SigningKey:
+    return ecdsa.SigningKey.from_string(private_key, curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384)
 
 
-MAGIC_PRODUCTION_CLIENT = "DN TSEProduction ef82abcedf"
+def sign_message(private_key: bytes, message: bytes) -> str:
+    """
+    runs in the worker processes of the signing pool, each process parses a key only once
+    """
+    return _signing_key(private_key).sign(message).hex()
 
 
 class VirtualTSE:
+    """
+    Requests are processed concurrently, the artificial signing delay and the signing itself don't block other requests.
+    All checks and state changes of a request happen before its first await, so they are atomic.
+    """
+
     def __init__(
-        self, delay: float, fast: bool, real: bool, private_key_hex: Optional[str], gen_key: bool, broken: bool
+        self,
+        delay: float,
+        fast: bool,
+        real: bool,
+        private_key_hex: Optional[str],
+        gen_key: bool,
+        broken: bool,
+        key_index: int = 0,
+        signing_pool: Optional[concurrent.futures.Executor] = None,
     ):
         self._fast: bool = fast
         self._real: bool = real
         self._delay: float = delay
         self._broken: bool = broken
+        # the broken TSE stops answering at some point
+        self._hung = False
+        # real signatures are computed in this pool if set, in the event loop otherwise
+        self._signing_pool = signing_pool
 
         self.password_block_counter = 0
         self.puk_block_counter = 0
@@ -102,11 +110,28 @@ class VirtualTSE:
                     curve=ecdsa.BRAINPOOLP384r1,
                     hashfunc=sha384,
                 )
+        if key_index > 0 and not gen_key:
+            # each additional TSE of a simulator gets its own key, derived from the configured one
+            secret = int.from_bytes(sha384(self.sk.to_string() + key_index.to_bytes(4, "big")).digest(), "big")
+            self.sk = ecdsa.SigningKey.from_secret_exponent(
+                secret % (ecdsa.BRAINPOOLP384r1.order - 1) + 1, curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384
+            )
+        self._private_key = self.sk.to_string()
 
         vk = self.sk.get_verifying_key()
         self.public_key = Sequence.load(vk.to_der())[1].dump()[3:]
         self.serial = sha256(self.public_key).hexdigest()
 
+        # the parts of the signed FinishTransaction message which are the same for every transaction
+        signaturealgorithm = SignatureAlgorithm_seq()
+        signaturealgorithm["signatureAlgorithm"] = "0.4.0.127.0.7.1.1.4.1.4"
+        self._finish_message_head = (
+            Integer(2).dump()
+            + ObjectIdentifier("0.4.0.127.0.7.3.7.1.1").dump()
+            + PrintableString("FinishTransaction", implicit=0).dump()
+        )
+        self._finish_message_serial = OctetString(sha256(self.public_key).digest()).dump() + signaturealgorithm.dump()
+
         print(f"Serial Number: {self.serial}")
         self.certificate = b"THIS IS A VERY LONG CERTIFICATE!!!!"
         self.password_admin = "12345"
@@ -129,31 +154,38 @@ class VirtualTSE:
             "SetLimits",
         ]
 
-    def parse_input(self, msgdata):
+    async def parse_input(self, msgdata) -> Optional[str]:
+        """
+        returns the framed response, or None if the TSE does not answer
+        """
+        if self._hung:
+            return None
         msg = json.loads(msgdata.strip("\x02").strip("\n").strip("\x03"))
 
         # extract command
         if "Command" not in msg:
             response = {"Status": "error"}
         else:
-            response = self.act_on_command(msg)
+            response = await self.act_on_command(msg)
+        if self._hung:
+            return None
 
         if "PingPong" in msg:
             response["PingPong"] = msg["PingPong"]
 
         return f"\x02{json.dumps(response)}\x03\n"
 
-    def act_on_command(self, msg):
+    async def act_on_command(self, msg):
         response = {"Command": msg["Command"]}
         if msg["Command"] == "PingPong":
             response["Status"] = "ok"
 
         elif msg["Command"] == "StartTransaction":
-            response.update(self.starttrans(msg))
+            response.update(await self.starttrans(msg))
         elif msg["Command"] == "UpdateTransaction":
-            response.update(self.updatetrans(msg))
+            response.update(await self.updatetrans(msg))
         elif msg["Command"] == "FinishTransaction":
-            response.update(self.finishtrans(msg))
+            response.update(await self.finishtrans(msg))
         elif msg["Command"] == "ChangePassword":
             response.update(self.changepassword(msg))
         elif msg["Command"] == "UnblockUser":
@@ -176,7 +208,7 @@ class VirtualTSE:
         return response
 
     # transactions
-    def starttrans(self, msg) -> TseResponse:
+    async def starttrans(self, msg) -> TseResponse:
         # check if all Parameters are here
         if "ClientID" not in msg or "Password" not in msg:
             return dnerror(3)  # param missing
@@ -214,21 +246,24 @@ class VirtualTSE:
         # generate transaction
         self.signctr += 1
         self.transnr += 1
-        self.current_transactions[msg["ClientID"]].add(self.transnr)
+        transaction_nr, signature_counter = self.transnr, self.signctr
+        self.current_transactions[msg["ClientID"]].add(transaction_nr)
 
         log_time = datetime.now(timezone(timedelta(hours=2)))
         response: TseResponse = {
             "Status": "ok",
-            "TransactionNumber": self.transnr,
+            "TransactionNumber": transaction_nr,
             "SerialNumber": self.serial,
-            "SignatureCounter": self.signctr,
-            "Signature": self.generate_signature(msg, str(self.transnr), log_time),
+            "SignatureCounter": signature_counter,
+            "Signature": await self.generate_signature(
+                msg, "StartTransaction", transaction_nr, signature_counter, log_time
+            ),
             "LogTime": log_time.isoformat(timespec="seconds"),
         }
 
         return response
 
-    def updatetrans(self, msg) -> TseResponse:
+    async def updatetrans(self, msg) -> TseResponse:
         # check if all Parameters are here
         if "ClientID" not in msg or "Password" not in msg or "TransactionNumber" not in msg:
             return dnerror(3)  # param missing
@@ -261,14 +296,17 @@ class VirtualTSE:
                 return response  # do not create a signature
 
         self.signctr += 1
-        response["SignatureCounter"] = self.signctr
+        signature_counter = self.signctr
+        response["SignatureCounter"] = signature_counter
         log_time = datetime.now(timezone(timedelta(hours=1)))
-        response["Signature"] = self.generate_signature(msg, str(self.transnr), log_time)
+        response["Signature"] = await self.generate_signature(
+            msg, "UpdateTransaction", msg["TransactionNumber"], signature_counter, log_time
+        )
         response["LogTime"] = log_time.isoformat(timespec="seconds")
 
         return response
 
-    def finishtrans(self, msg) -> TseResponse:
+    async def finishtrans(self, msg) -> TseResponse:
         # check if all Parameters are here
         if "ClientID" not in msg or "Password" not in msg or "TransactionNumber" not in msg:
             return dnerror(3)  # param missing
@@ -300,15 +338,18 @@ class VirtualTSE:
             if self.transnr >= 20:
                 self.transnr = 40
                 print("TIIIIIIIME TOOOOOOOOO SAY GOODBYE........")
-                while True:
-                    time.sleep(1)
+                self._hung = True
+                return {}
 
         self.signctr += 1
+        signature_counter = self.signctr
         log_time = datetime.now(timezone(timedelta(hours=1)))
         response: TseResponse = {
             "Status": "ok",
-            "SignatureCounter": self.signctr,
-            "Signature": self.generate_signature(msg, msg["TransactionNumber"], log_time),
+            "SignatureCounter": signature_counter,
+            "Signature": await self.generate_signature(
+                msg, "FinishTransaction", msg["TransactionNumber"], signature_counter, log_time
+            ),
             "LogTime": log_time.isoformat(timespec="seconds"),
         }
 
@@ -497,86 +538,50 @@ class VirtualTSE:
 
         return {"Status": "ok", "Name": name, "Value": value_enc, "Length": len(value)}
 
-    def generate_signature(self, msg, transaction_nr, log_time):
-        del transaction_nr
-        signature: str = ""
-
+    async def generate_signature(
+        self, msg, operation: str, transaction_nr: int, signature_counter: int, log_time: datetime
+    ) -> str:
         # simulate time required for signing process
         if not self._fast:
-            time.sleep(self._delay)
+            await asyncio.sleep(self._delay)
 
         # generate bs signature
         if not self._real:
             if randrange(5) == 0:
-                signature = (
-                    "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
-                )
-            else:
-                signature = "ca8968b306a0" + randbytes(90).hex()
-            return signature
+                return "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
+            return "ca8968b306a0" + randbytes(90).hex()
 
         # now for the real deal
+        if operation == "StartTransaction":
+            return "ca8968b306a0" + randbytes(90).hex()
+        elif operation != "FinishTransaction":
+            return "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
 
-        # check from where we are called
-        transaction_type = stack()[1].function
-        if transaction_type == "updatetrans":
-            signature = "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
-            return signature
-        elif transaction_type == "starttrans":
-            signature = "ca8968b306a0" + randbytes(90).hex()
-            return signature
-        elif transaction_type == "finishtrans":
-            pass
-        else:
-            signature = "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
-            return signature
-
-        signaturealgorithm = SignatureAlgorithm_seq()
-        signaturealgorithm["signatureAlgorithm"] = "0.4.0.127.0.7.1.1.4.1.4"
-
-        certidata = CertifiedData()
-        certidata["operationType"] = "FinishTransaction"
-        certidata["clientId"] = msg["ClientID"]
-        try:
-            certidata["ProcessData"] = bytes(msg["Data"].encode("utf-8"))  # optional field
-        except KeyError:
-            certidata["ProcessData"] = b""
-        try:
-            certidata["ProcessType"] = msg["Typ"]  # optional field
-        except KeyError:
-            certidata["ProcessType"] = ""
-
-        certidata["transactionNumber"] = self.transnr
-
-        data = TransactionData()
-        data["Version"] = 2
-        data["CertifiedDataType"] = "0.4.0.127.0.7.3.7.1.1"
-        data["CertifiedData"] = certidata
-        data["SerialNumber"] = sha256(self.public_key).digest()
-        data["signatureAlgorithm"] = signaturealgorithm
-        data["signatureCounter"] = self.signctr
-        data["LogTime"] = int(log_time.timestamp())
-
+        # the fields of the TransactionData and CertifiedData ASN.1 sequences, dumped one after another.
         # why use a propper ASN.1 SEQUENCE, when you can make it much more complicated?
         message = (
-            data["Version"].dump()
-            + data["CertifiedDataType"].dump()
-            + certidata["operationType"].dump()
-            + certidata["clientId"].dump()
-            + certidata["ProcessData"].dump()
-            + certidata["ProcessType"].dump()
-            + certidata["transactionNumber"].dump()
-            + data["SerialNumber"].dump()
-            + data["signatureAlgorithm"].dump()
-            + data["signatureCounter"].dump()
-            + data["LogTime"].dump()
+            self._finish_message_head
+            + PrintableString(msg["ClientID"], implicit=1).dump()
+            + OctetString(msg.get("Data", "").encode("utf-8"), implicit=2).dump()  # optional field
+            + PrintableString(msg.get("Typ", ""), implicit=3).dump()  # optional field
+            + Integer(transaction_nr, implicit=5).dump()
+            + self._finish_message_serial
+            + Integer(signature_counter).dump()
+            + Integer(int(log_time.timestamp())).dump()
         )
 
-        signature = self.sk.sign(message).hex()
-        return signature
+        if self._signing_pool is None:
+            return sign_message(self._private_key, message)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._signing_pool, sign_message, self._private_key, message
+        )
 
 
 class WebsocketInterface:
+    """
+    Simulates n_tses TSEs in one process, the i-th TSE listens on port + i.
+    """
+
     def __init__(
         self,
         host: str = "localhost",
@@ -587,28 +592,68 @@ class WebsocketInterface:
         private_key_hex: Optional[str] = None,
         gen_key: bool = False,
         broken: bool = False,
+        n_tses: int = 1,
+        signing_workers: Optional[int] = None,
     ):
         self.host: str = host
         self.port: int = port
 
-        self.tse = VirtualTSE(delay, fast, real, private_key_hex, gen_key, broken)
+        # real signatures are computed by all TSEs in a shared process pool,
+        # with signing_workers processes (default: one per cpu), or in the event loop if 0
+        self.signing_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if real and signing_workers != 0:
+            self.signing_pool = concurrent.futures.ProcessPoolExecutor(max_workers=signing_workers)
+
+        # local port -> TSE
+        self.tses = {
+            port
+            + i: VirtualTSE(
+                delay,
+                fast,
+                real,
+                private_key_hex,
+                gen_key,
+                broken,
+                key_index=i,
+                signing_pool=self.signing_pool,
+            )
+            for i in range(n_tses)
+        }
 
     async def websocket_handler(self, websocket: WebSocket):
-        print("Websocket connection starting")
+        tse = self.tses[websocket.scope["server"][1]]
+        print(f"Websocket connection starting for TSE {tse.serial}")
         await websocket.accept()
         print("Websocket connection ready")
 
-        while True:
-            data = await websocket.receive_text()
-            print(f" >>: {str(data).strip()}")
-            # check for STX ETX
-            if data[:1] == "\x02" and data[-2:] == "\x03\n":
-                resp = self.tse.parse_input(data)
+        # requests are answered as soon as they are done, the client matches the responses by their PingPong id
+        send_lock = asyncio.Lock()
+        requests = set[asyncio.Task]()
 
-                print(f"<< : {str(resp).strip()}")
+        async def handle_request(data: str):
+            resp = await tse.parse_input(data)
+            if resp is None:
+                return
+            LOGGER.debug(f"<< : {resp.strip()}")
+            async with send_lock:
                 await websocket.send_text(resp)
-            else:
-                print("ERROR: missing STX and/or ETX framing")
+
+        try:
+            while True:
+                data = await websocket.receive_text()
+                LOGGER.debug(f" >>: {str(data).strip()}")
+                # check for STX ETX
+                if data[:1] == "\x02" and data[-2:] == "\x03\n":
+                    request = asyncio.create_task(handle_request(data))
+                    requests.add(request)
+                    request.add_done_callback(requests.discard)
+                else:
+                    print("ERROR: missing STX and/or ETX framing")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for request in requests:
+                request.cancel()
 
         print("Websocket connection closed")
 
@@ -617,13 +662,19 @@ class WebsocketInterface:
             title="TSE Simulator",
             license_info={"name": "AGPL-3.0"},
         )
-        app.add_websocket_route("/", self.websocket_handler)
+        app.add_api_websocket_route("/", self.websocket_handler)
 
         uvicorn_config = uvicorn.Config(
             app,
-            host=self.host,
-            port=self.port,
             log_level=logging.root.level,
         )
         webserver = uvicorn.Server(uvicorn_config)
-        await webserver.serve()
+        # a single server for all TSEs, the websocket handler picks the TSE by the local port of the connection
+        sockets = [socket.create_server((self.host, port)) for port in self.tses]
+        try:
+            await webserver.serve(sockets=sockets)
+        finally:
+            for sock in sockets:
+                sock.close()
+            if self.signing_pool is not None:
+                self.signing_pool.shutdown(cancel_futures=True)
@@ -6,6 +6,8 @@ import abc
 import dataclasses
 import typing
 
+from .metrics import TSEMetricsRecorder
+
 
 @dataclasses.dataclass
 class TSESignatureRequest:
@@ -40,6 +42,9 @@ class TSEHandler(abc.ABC):
     Abstract base class for various TSE handlers (e.g. DieboldNixdorfUSB)
     """
 
+    # set by the TSEWrapper before start(), handlers record their request round trips and failures here
+    metrics: typing.Optional[TSEMetricsRecorder] = None
+
     @abc.abstractmethod
     async def start(self) -> bool:
         """
@@ -0,0 +1,78 @@
+"""
+In-process latency and failure metrics of the TSEs handled by the signature processor
+"""
+
+import bisect
+import collections
+import datetime
+
+from stustapay.core.schema.tse import TseHistogram, TseMetrics
+
+# upper bucket bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last bucket counts all observations above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # a value equal to a bound belongs to that bucket, like prometheus' 'le'
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> TseHistogram:
+        return TseHistogram(buckets=list(self.buckets), counts=list(self.counts), count=self.count, sum=self.sum)
+
+
+class TSEMetricsRecorder:
+    """
+    Collects the metrics of one TSE over the lifetime of the signature processor,
+    across reconnects of the TSE handler.
+    """
+
+    def __init__(self):
+        self.queue_wait = Histogram()
+        self.request_round_trip: dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.end_to_end = Histogram()
+        self.signatures_done = 0
+        self.signatures_failed = 0
+        self.request_failures: dict[str, int] = collections.defaultdict(int)
+        self.request_timeouts: dict[str, int] = collections.defaultdict(int)
+
+    def observe_request(self, command: str, duration: float):
+        self.request_round_trip[command].observe(duration)
+
+    def request_failed(self, command: str):
+        self.request_failures[command] += 1
+
+    def request_timed_out(self, command: str):
+        self.request_timeouts[command] += 1
+
+    def signature_done(self, end_to_end: float):
+        self.signatures_done += 1
+        self.end_to_end.observe(end_to_end)
+
+    def signature_failed(self):
+        self.signatures_failed += 1
+
+    def snapshot(self, tse_id: int, tse_name: str) -> TseMetrics:
+        return TseMetrics(
+            tse_id=tse_id,
+            tse_name=tse_name,
+            updated_at=datetime.datetime.now(tz=datetime.timezone.utc),
+            queue_wait=self.queue_wait.snapshot(),
+            request_round_trip={
+                command: histogram.snapshot() for command, histogram in sorted(self.request_round_trip.items())
+            },
+            end_to_end=self.end_to_end.snapshot(),
+            signatures_done=self.signatures_done,
+            signatures_failed=self.signatures_failed,
+            request_failures=dict(sorted(self.request_failures.items())),
+            request_timeouts=dict(sorted(self.request_timeouts.items())),
+        )
@@ -3,13 +3,14 @@ import contextlib
 import logging
 
 import asyncpg
-from sftkit.database import Connection, DatabaseHook
+from sftkit.database import DatabaseHook
 
 from stustapay.core.config import Config
 from stustapay.core.healthcheck import run_healthcheck
 from stustapay.core.schema.tse import Tse
 
 from ..core.database import get_database
+from .balancer import TSEBalancer
 from .config import get_tse_handler
 from .wrapper import TSEWrapper
 
@@ -17,8 +18,21 @@ LOGGER = logging.getLogger(__name__)
 
 
 class SignatureProcessor:
-    def __init__(self, config: Config):
+    def __init__(
+        self,
+        config: Config,
+        max_signatures_in_flight: int = 1,
+        rebalance_idle_tills: bool = False,
+        metrics_interval: float = 10,
+    ):
         self.config = config
+        # concurrent signatures per TSE, each for a different till
+        self.max_signatures_in_flight = max_signatures_in_flight
+        # move idle tills from overloaded TSEs to less loaded ones
+        self.rebalance_idle_tills = rebalance_idle_tills
+        # seconds between writing the TSE metrics to the database
+        self.metrics_interval = metrics_interval
+        self.balancer: TSEBalancer | None = None
         self.tses: dict[int, TSEWrapper] = {}  # tse_id -> Tse
         self.db_pool: asyncpg.Pool | None = None
         # contains event objects for each object that is waiting for new events.
@@ -58,18 +72,21 @@ class SignatureProcessor:
                 )
                 for tse_in_db in tses_in_db:
                     factory = get_tse_handler(tse_in_db)
-                    tse = TSEWrapper(tse_id=tse_in_db.id, factory_function=factory)
+                    tse = TSEWrapper(
+                        tse_id=tse_in_db.id, factory_function=factory, max_in_flight=self.max_signatures_in_flight
+                    )
                     tse.start(self.db_pool)
                     aes.push_async_callback(tse.stop)
                     self.tses[tse_in_db.id] = tse
 
-            # TODO Task to assign feral tills to a TSE
             LOGGER.info(f"Configured TSEs: {self.tses}")
 
+            self.balancer = TSEBalancer(self.db_pool, self.tses, rebalance_idle_tills=self.rebalance_idle_tills)
             db_hook = DatabaseHook(self.db_pool, "tse_signature", self.handle_hook, initial_run=True)
-            await db_hook.run()
             await asyncio.gather(
                 db_hook.run(),
+                self.balancer.run(),
+                self.run_metrics_export(),
                 run_healthcheck(db, service_name="tses"),
                 return_exceptions=True,
             )
@@ -81,60 +98,37 @@ class SignatureProcessor:
         del payload  # unused
         LOGGER.info("tse_signature hook")
 
-        # check if it is from a till without an assigned TSE
-        async with contextlib.AsyncExitStack() as aes:
-            psql: Connection = await aes.enter_async_context(self.db_pool.acquire())
-
-            feral_till_id_rows = await psql.fetch(
-                """
-                    select
-                        till.id as till_id
-                    from
-                        tse_signature
-                        join ordr on ordr.id=tse_signature.id
-                        join till on ordr.till_id=till.id
-                    where
-                        tse_signature.signature_status='new' and
-                        till.tse_id is Null
-                    """
-            )
-            if feral_till_id_rows is None:
-                pass  # all fine
-            else:
-                LOGGER.info(f"till(s) without TSE but an order {feral_till_id_rows}")
-                LOGGER.info(f"{len(feral_till_id_rows)} till(s) need a TSE")
-                # assign TSEs
-                for till in feral_till_id_rows:
-                    # get number of assigned tills per tse, but only of active TSEs
-                    tse_stats = dict()
-                    active_tses = await psql.fetch("select name from tse where status='active'")
-                    for tse in active_tses:
-                        # TODO optimize this statement for really really large installations...
-                        tse_stats[tse["name"]] = await psql.fetchval(
-                            "select count(*) from till join tse on till.tse_id = tse.id where tse.name=$1 and tse.status='active'",
-                            tse["name"],
-                        )
-                    tse_ranked = sorted(tse_stats.items(), key=lambda x: x[1])
-                    # assign this till to tse with the lowest number
-                    till_id_to_assign_to_tse = till["till_id"]
-                    try:
-                        tse_name_to_assign_to_till = tse_ranked[0][0]
-
-                        tse_id = await psql.fetchval("select id from tse where name = $1 ", tse_name_to_assign_to_till)
-                        assert tse_id is not None
-                        await psql.execute(
-                            "update till set tse_id = $1 where id = $2", tse_id, till_id_to_assign_to_tse
-                        )
-                        LOGGER.info(
-                            f"Till with ID={till_id_to_assign_to_tse} is assigned to TSE: {tse_name_to_assign_to_till}"
-                        )
-                    except IndexError:
-                        LOGGER.error("ERROR: no more active TSEs available")
-                        LOGGER.warning("will set all signature requests to 'failure'")
-                        await psql.execute(
-                            "update tse_signature set signature_status='failure',result_message='TSE failure, no active TSE available', tse_id=1 where signature_status='new'"
-                        )
+        # assign tills without a TSE right away, instead of waiting for the next balancing round
+        assert self.balancer is not None
+        async with self.db_pool.acquire() as conn:
+            await self.balancer.assign_unassigned_tills(conn)
 
         # notify all TSEs
         for tse in self.tses.values():
             tse.notify_maybe_orders_available()
+
+    async def export_metrics(self):
+        """
+        Stores the current metrics snapshot of each TSE, to be queried by the administration api.
+        """
+        assert self.db_pool is not None
+        async with self.db_pool.acquire() as conn:
+            for tse_id, tse in self.tses.items():
+                if tse.name is None:
+                    continue
+                snapshot = tse.metrics.snapshot(tse_id=tse_id, tse_name=tse.name)
+                await conn.execute(
+                    "insert into tse_metrics (tse_id, metrics, updated_at) values ($1, $2, $3) "
+                    "on conflict (tse_id) do update set metrics = excluded.metrics, updated_at = excluded.updated_at",
+                    tse_id,
+                    snapshot.model_dump(mode="json"),
+                    snapshot.updated_at,
+                )
+
+    async def run_metrics_export(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            try:
+                await self.export_metrics()
+            except asyncpg.PostgresError:
+                LOGGER.exception("storing the TSE metrics failed")
@@ -1,6 +1,6 @@
 import asyncio
+import collections
 import contextlib
-import datetime
 import logging
 import time
 import traceback
@@ -13,6 +13,7 @@ from sftkit.util import create_task_protected
 
 from .handler import TSEHandler, TSESignature, TSESignatureRequest
 from .kassenbeleg_v1 import Kassenbeleg_V1
+from .metrics import TSEMetricsRecorder
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,11 +21,16 @@ PAYMENT_METHOD_TO_ZAHLUNGSART = {"cash": "Bar", "sumup": "Unbar", "tag": "Unbar"
 
 
 class TSEWrapper:
-    def __init__(self, tse_id: int, factory_function: Callable[[], TSEHandler]):
+    def __init__(self, tse_id: int, factory_function: Callable[[], TSEHandler], max_in_flight: int = 1):
         # most of these members will be set in run().
         # The TSE_id (database tse_id), references to tills and transactions
         self.tse_id = tse_id
         self.name: str | None = None
+        # Maximum number of concurrent signatures, each for a different till.
+        # With 1, requests are signed strictly one after another.
+        self._max_in_flight = max_in_flight
+        # Pool for the database writes of concurrent signatures, set in run()
+        self._db_pool: typing.Optional[asyncpg.Pool] = None
         # The factory function that constructs the inner TSE handler object
         self._factory_function = factory_function
         # Inner TSE handler (constructed by factory function)
@@ -37,6 +43,12 @@ class TSEWrapper:
         self._stop = False
         # Set this event to notify that new orders are available in the DB
         self._orders_available_event = asyncio.Event()
+        # Durations of the most recent signatures, used for balancing the tills between the TSEs
+        self._recent_durations = collections.deque[float](maxlen=100)
+        # Tills to be moved to another TSE once they are idle, till id -> target tse id
+        self._till_moves: dict[str, int] = {}
+        # Latency and failure metrics, kept across reconnects
+        self.metrics = TSEMetricsRecorder()
 
     def start(self, db_pool: asyncpg.Pool):
         self._task = create_task_protected(self.run(db_pool), f"tse_wrapper_task {self.name}")
@@ -49,18 +61,34 @@ class TSEWrapper:
     def notify_maybe_orders_available(self):
         self._orders_available_event.set()
 
+    def mean_signature_duration(self) -> typing.Optional[float]:
+        if len(self._recent_durations) == 0:
+            return None
+        return sum(self._recent_durations) / len(self._recent_durations)
+
+    def request_till_move(self, till_id: str, target_tse_id: int):
+        """
+        Moves the till to the target TSE if it has no outstanding signature requests.
+        The move is done in the request loop, so no request of the till can be claimed in the meantime.
+        """
+        self._till_moves[till_id] = target_tse_id
+        self._orders_available_event.set()
+
     async def run(self, db_pool: asyncpg.Pool):
         """
         Connects to the wrapped TSE and calls _tse_handler_loop.
         This repeats until self._stop is set.
         """
+        self._db_pool = db_pool
         async with contextlib.AsyncExitStack() as es:
             conn: Connection = await es.enter_async_context(db_pool.acquire())
             self.name = await conn.fetchval("select name from tse where id = $1", self.tse_id)
             while True:
                 # connect to the TSE
                 try:
-                    async with self._factory_function() as tse_handler:
+                    handler = self._factory_function()
+                    handler.metrics = self.metrics
+                    async with handler as tse_handler:
                         if tse_handler is not None:
                             self._tse_handler = tse_handler
                             await self._tse_handler_loop(conn)
@@ -73,63 +101,59 @@ class TSEWrapper:
                 ##############################################
                 LOGGER.error("checking for new transactions and fail those older than 10 seconds")
 
-                new_sig_requests = await conn.fetch(
+                # skip locked: requests which are just being claimed by a TSE are not timed out
+                timed_out_requests = await conn.fetch(
                     """
                     with currently_signing as (
                         select
-                            till_id
+                            ordr.till_id
                         from
                             tse_signature
                             join ordr on ordr.id=tse_signature.id
                         where
-                            tse_signature.signature_status = 'pending'
+                            tse_signature.signature_status='pending'
+                    ), timed_out as (
+                        select
+                            tse_signature.id
+                        from
+                            tse_signature
+                            join ordr on ordr.id=tse_signature.id
+                            join till on ordr.till_id=till.id
+                        where
+                            tse_signature.signature_status='new' and
+                            till.tse_id = $1 and
+                            ordr.booked_at < now() - interval '10 seconds' and
+                            not exists (
+                                select
+                                    1
+                                from
+                                    currently_signing
+                                where
+                                    currently_signing.till_id=ordr.till_id
+                            )
+                        for update of tse_signature skip locked
                     )
-                    select
-                        ordr.id as order_id,
-                        till.id as till_id,
-                        ordr.booked_at as booked_at
-                    from
+                    update
                         tse_signature
-                        join ordr on ordr.id=tse_signature.id
-                        join till on ordr.till_id=till.id
+                    set
+                        signature_status='failure',
+                        result_message='TSE did not react, signature timeout',
+                        tse_id=$1
+                    from
+                        timed_out
                     where
-                        tse_signature.signature_status='new' and
-                        till.tse_id = $1 and
-                        not exists (
-                            select
-                                1
-                            from
-                                currently_signing
-                            where
-                                currently_signing.till_id=ordr.till_id
-                        )
-                    order by ordr.id
+                        tse_signature.id=timed_out.id
+                    returning
+                        tse_signature.id as order_id
                     """,
                     self.tse_id,
                 )
-                for request in new_sig_requests:
-                    # check order time
-                    delta = datetime.datetime.now().astimezone() - request["booked_at"]
-                    if delta > datetime.timedelta(seconds=10):
-                        LOGGER.warning(f"new signing request for ordr {request['order_id']} is to old -> failing")
-                        await conn.execute(
-                            """ 
-                            update
-                                tse_signature
-                            set
-                                signature_status='failure',
-                                result_message='TSE did not react, signature timeout',
-                                tse_id=$2
-                            where
-                                id=$1
-                            """,
-                            request["order_id"],
-                            self.tse_id,
-                        )
-                        # set tse_status to failed
-                        await conn.execute(
-                            "update tse set status='failed' where id=$1 and status='active'", self.tse_id
-                        )
+                for request in sorted(timed_out_requests, key=lambda row: row["order_id"]):
+                    LOGGER.warning(f"new signing request for ordr {request['order_id']} is to old -> failing")
+                    self.metrics.signature_failed()
+                if len(timed_out_requests) > 0:
+                    # set tse_status to failed
+                    await conn.execute("update tse set status='failed' where id=$1 and status='active'", self.tse_id)
 
                 await asyncio.sleep(2)
 
@@ -226,32 +250,128 @@ class TSEWrapper:
         # The TSE is now ready to be used.
         # Ready to execute signatures from the database.
 
-        while not self._stop and not self._tse_handler.is_stop_set():
-            LOGGER.info(f"TSE {self.name!r}: getting next request")
-            next_request = await self._grab_next_request(conn)
-            LOGGER.info(f"TSE {self.name!r}: {next_request=!r}")
-
-            if next_request is not None:
-                # TODO handle unclean failures (reported via exception)
-                result = await self._sign(conn, next_request)
-                LOGGER.info(f"signature result: {result!r}")
-                if result is None:
-                    # fail this request
-                    await self._fail_request(conn, next_request, "TSE operation failed, timeout")
-                else:
-                    # the signature was completed successfully
-                    await self._request_done(conn, next_request, result)
-
-            # TODO break out of while loop if the TSE connection has failed somehow
-
-    async def _grab_next_request(self, conn: Connection, timeout: float = 2) -> typing.Optional[TSESignatureRequest]:
+        # Signatures currently in progress in pipelined mode.
+        # Each till has at most one pending request, so these are all for distinct tills.
+        in_flight = set[asyncio.Task]()
+        try:
+            while not self._stop and not self._tse_handler.is_stop_set():
+                for task in [task for task in in_flight if task.done()]:
+                    in_flight.remove(task)
+                    # propagate TSE failures just like in sequential mode
+                    task.result()
+                if len(in_flight) >= self._max_in_flight:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                await self._move_tills(conn)
+
+                LOGGER.info(f"TSE {self.name!r}: getting next requests")
+                next_requests = await self._grab_next_requests(conn, limit=self._max_in_flight - len(in_flight))
+                LOGGER.info(f"TSE {self.name!r}: {next_requests=!r}")
+
+                for next_request in next_requests:
+                    if self._max_in_flight == 1:
+                        await self._process_request(conn, next_request)
+                    else:
+                        in_flight.add(asyncio.create_task(self._process_request_pipelined(next_request)))
+
+                # TODO break out of while loop if the TSE connection has failed somehow
+        finally:
+            # let the signatures in progress finish, so their results are written to the database
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def _process_request(self, conn: Connection, request: TSESignatureRequest):
+        """
+        Signs the request and writes the result to the database.
+        """
+        # TODO handle unclean failures (reported via exception)
+        result = await self._sign(conn, request)
+        await self._store_result(conn, request, result)
+
+    async def _process_request_pipelined(self, request: TSESignatureRequest):
+        """
+        Processes the request concurrently to the other requests in flight.
+        Database connections are only held for the writes, not while waiting for the TSE.
+        """
+        assert self._db_pool is not None
+        try:
+            if request.till_id not in self._tills:
+                async with self._db_pool.acquire() as conn:
+                    await self._register_till(conn, request.till_id)
+            result = await self._sign_request(request)
+            async with self._db_pool.acquire() as conn:
+                await self._store_result(conn, request, result)
+        finally:
+            # the till of this request is free again, its next request can be grabbed
+            self._orders_available_event.set()
+
+    async def _store_result(
+        self, conn: Connection, request: TSESignatureRequest, result: typing.Optional[TSESignature]
+    ):
+        LOGGER.info(f"signature result: {result!r}")
+        if result is None:
+            # fail this request
+            await self._fail_request(conn, request, "TSE operation failed, timeout")
+        else:
+            # the signature was completed successfully
+            await self._request_done(conn, request, result)
+
+    async def _move_tills(self, conn: Connection):
+        """
+        Reassigns the tills requested to be moved and deregisters them from this TSE.
+        The target TSE registers them with the next signature.
+
+        Tills are only moved while nobody is logged in, i.e. between two closures, as the DSFinV-K export
+        has to attribute all signatures of a closure to one TSE.
+        """
+        while len(self._till_moves) > 0:
+            till_id, target_tse_id = self._till_moves.popitem()
+            moved = await conn.fetchval(
+                """
+                update
+                    till
+                set
+                    tse_id = $3
+                where
+                    id = $1 and
+                    tse_id = $2 and
+                    active_user_id is null and
+                    not is_virtual and
+                    not exists (
+                        select 1
+                        from tse_signature join ordr on ordr.id=tse_signature.id
+                        where tse_signature.signature_status='new' and ordr.till_id=till.id
+                    ) and
+                    not exists (
+                        select 1
+                        from tse_signature join ordr on ordr.id=tse_signature.id
+                        where tse_signature.signature_status='pending' and ordr.till_id=till.id
+                    )
+                returning true
+                """,
+                int(till_id),
+                self.tse_id,
+                target_tse_id,
+            )
+            if not moved:
+                LOGGER.info(f"{self.name!r}: till {till_id} is busy, not moving it")
+                continue
+            LOGGER.info(f"{self.name!r}: moved till {till_id} to TSE {target_tse_id}")
+            if till_id in self._tills:
+                await self._till_remove(conn, till_id)
+            else:
+                # the till did not sign anything on this TSE yet, record the move nonetheless
+                await self._record_till_change(conn, till_id, "deregister")
+
+    async def _grab_next_requests(self, conn: Connection, limit: int, timeout: float = 2) -> list[TSESignatureRequest]:
         """
         Waits until the 'order available' event is set,
-        then fetches the next TSE signature request for this TSE from the database,
-        marks it as 'pending' and fetches all the details, returning them as a TSESignatureRequest.
+        then claims up to limit TSE signature requests for this TSE from the database,
+        each for a different till, marks them as 'pending' and fetches all the details,
+        returning them as TSESignatureRequests.
 
         Checks anyway after the timeout has elapsed.
-        Returns None if no signature is pending.
+        Returns an empty list if no signature is pending.
         """
         # wait until an order is potentially available
         try:
@@ -262,72 +382,83 @@ class TSEWrapper:
             LOGGER.info(f"TSE wrapper {self.name}: timeout while waiting for orders available, but checking anyway")
 
         if self._stop:
-            return None
+            return []
 
-        async with conn.transaction(isolation="serializable"):
-            next_sig = await conn.fetchrow(
-                """
-                with currently_signing as (
-                    select
-                        till_id
-                    from
-                        tse_signature
-                        join ordr on ordr.id=tse_signature.id
-                    where
-                        tse_signature.signature_status = 'pending'
-                )
+        # Claims the oldest new request of each till which has no pending request.
+        # Rows locked by somebody else are skipped instead of waited for, the status is rechecked on the locked rows,
+        # so no request is claimed twice. Both scans on tse_signature only touch the partial status indices.
+        claimed = await conn.fetch(
+            """
+            with currently_signing as (
                 select
-                    ordr.id as order_id,
-                    till.id as till_id
+                    ordr.till_id
+                from
+                    tse_signature
+                    join ordr on ordr.id=tse_signature.id
+                where
+                    tse_signature.signature_status='pending'
+            ), next_per_till as (
+                select distinct on (ordr.till_id)
+                    tse_signature.id,
+                    ordr.till_id
                 from
                     tse_signature
                     join ordr on ordr.id=tse_signature.id
                     join till on ordr.till_id=till.id
                 where
                     tse_signature.signature_status='new' and
-                    till.tse_id = $1 and
+                    till.tse_id = $1
+                order by ordr.till_id, tse_signature.id
+            ), claimable as (
+                select
+                    tse_signature.id,
+                    next_per_till.till_id
+                from
+                    tse_signature
+                    join next_per_till on next_per_till.id=tse_signature.id
+                where
+                    tse_signature.signature_status='new' and
                     not exists (
                         select
                             1
                         from
                             currently_signing
                         where
-                            currently_signing.till_id=ordr.till_id
+                            currently_signing.till_id=next_per_till.till_id
                     )
-                order by ordr.id
-                limit 1
-                """,
-                self.tse_id,
-            )
-            if next_sig is None:
-                # no orders are available, return None
-                return None
-            else:
-                # set the orders available event;
-                # that way, next time this function is called it will run instantly
-                # instead of first waiting on the event.
-                self._orders_available_event.set()
-
-            order_id = next_sig["order_id"]
-            till_id = str(
-                next_sig["till_id"]
-            )  # use till_id converted to string as TSE ClientID to satisfy naming constraints
-
-            await conn.execute(
-                """
-                update
-                    tse_signature
-                set
-                    signature_status='pending',
-                    tse_id=$1
-                where
-                    id=$2
-                """,
-                self.tse_id,
-                order_id,
+                order by tse_signature.id
+                limit $2
+                for update of tse_signature skip locked
             )
-
-        return await self._make_signature_request(conn, order_id, till_id)
+            update
+                tse_signature
+            set
+                signature_status='pending',
+                tse_id=$1
+            from
+                claimable
+            where
+                tse_signature.id=claimable.id
+            returning
+                claimable.id as order_id,
+                claimable.till_id,
+                extract(epoch from clock_timestamp() - tse_signature.created)::float8 as queue_wait
+            """,
+            self.tse_id,
+            limit,
+        )
+        if len(claimed) == limit:
+            # set the orders available event;
+            # that way, next time this function is called it will run instantly
+            # instead of first waiting on the event.
+            self._orders_available_event.set()
+
+        requests = []
+        for row in sorted(claimed, key=lambda row: row["order_id"]):
+            self.metrics.queue_wait.observe(row["queue_wait"])
+            # use till_id converted to string as TSE ClientID to satisfy naming constraints
+            requests.append(await self._make_signature_request(conn, row["order_id"], str(row["till_id"])))
+        return requests
 
     async def _make_signature_request(self, conn: Connection, order_id: int, till_id: str):
         """
@@ -380,6 +511,7 @@ class TSEWrapper:
             request.order_id,
             reason,
         )
+        self.metrics.signature_failed()
 
     async def _request_done(self, conn: Connection, request: TSESignatureRequest, result: TSESignature):
         """
@@ -387,7 +519,7 @@ class TSEWrapper:
         as done.
         """
         LOGGER.info(f"duration {result.tse_duration}")
-        await conn.execute(
+        end_to_end = await conn.fetchval(
             """
             update
                 tse_signature
@@ -404,6 +536,8 @@ class TSEWrapper:
                 tse_duration=$8
             where
                 id=$9
+            returning
+                extract(epoch from clock_timestamp() - (select booked_at from ordr where ordr.id=$9))::float8
             """,
             request.process_type,
             request.process_data,
@@ -415,13 +549,20 @@ class TSEWrapper:
             result.tse_duration,
             request.order_id,
         )
+        self.metrics.signature_done(end_to_end)
 
     async def _sign(self, conn: Connection, signing_request: TSESignatureRequest) -> typing.Optional[TSESignature]:
-        assert self._tse_handler is not None
         # must be called when the TSE is connected and operational.
         if signing_request.till_id not in self._tills:
-            LOGGER.info(f"registering new ClientID {signing_request.till_id} with TSE {self.name}")
-            await self._till_add(conn, signing_request.till_id)
+            await self._register_till(conn, signing_request.till_id)
+        return await self._sign_request(signing_request)
+
+    async def _register_till(self, conn: Connection, till_id: str):
+        LOGGER.info(f"registering new ClientID {till_id} with TSE {self.name}")
+        await self._till_add(conn, till_id)
+
+    async def _sign_request(self, signing_request: TSESignatureRequest) -> typing.Optional[TSESignature]:
+        assert self._tse_handler is not None
         start = time.monotonic()
         try:
             result = await self._tse_handler.sign(signing_request)
@@ -435,34 +576,35 @@ class TSEWrapper:
         #  e.g. because self._tse_handler is no longer valid)
         LOGGER.info(f"{self.name!r}: signature done ({signing_request}) in TIME {stop - start:.3f}s")
         result.tse_duration = float(stop - start)  # duratoion
+        self._recent_durations.append(result.tse_duration)
         return result
 
     async def _till_add(self, conn: Connection, till):
         assert self._tse_handler is not None
         LOGGER.info(f"{self.name!r}: adding till {till!r}")
         await self._tse_handler.register_client_id(str(till))
-        # get z_nr
-        z_nr = await conn.fetchval("select z_nr from till where id=$1", int(till))
-        await conn.execute(
-            "insert into till_tse_history (till_id, tse_id, what, z_nr) values ($1, $2, 'register', $3)",
-            till,
-            self.tse_id,
-            z_nr,
-        )
+        await self._record_till_change(conn, till, "register")
         self._tills.add(till)
 
     async def _till_remove(self, conn: Connection, till):
         assert self._tse_handler is not None
         LOGGER.info(f"{self.name!r}: removing till {till!r}")
         await self._tse_handler.deregister_client_id(str(till))
+        await self._record_till_change(conn, till, "deregister")
+        self._tills.remove(till)
+
+    async def _record_till_change(self, conn: Connection, till, what: str):
+        """
+        Records the (de)registration of the till in the till tse history, at the till's current z_nr.
+        """
         if str(till).isnumeric():
             z_nr = await conn.fetchval("select z_nr from till where id=$1", int(till))
         else:
             z_nr = 0
         await conn.execute(
-            "insert into till_tse_history (till_id, tse_id, what, z_nr) values ($1, $2, 'deregister', $3)",
-            till,
+            "insert into till_tse_history (till_id, tse_id, what, z_nr) values ($1, $2, $3, $4)",
+            str(till),
             self.tse_id,
+            what,
             z_nr,
         )
-        self._tills.remove(till)